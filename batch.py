@@ -0,0 +1,130 @@
+"""Runs the store location search for many cities in parallel.
+
+Usage:
+    python3 batch.py jobs.json --workers 4
+
+jobs.json is a list of {"city": ..., "country": ..., "store": ..., "n_locations": ...}.
+Every city runs in its own process, a failing job does not stop the others. Jobs of the
+same city run one after another in one process, as they share the city's data files.
+"""
+import argparse
+import json
+import logging
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import pandas as pd
+from threadpoolctl import threadpool_limits
+
+from data.data_preprocessing import city_slug
+from data.snowflake_functions import close_pool, get_pool, run_etl_snowflake_cities
+from main import run_city
+from src.cache import ResultCache
+
+RESULTS_DIR = Path("results")
+LOCATION_COLUMNS = ["lat", "lon", "cust_prox", "store_prox", "ratio", "score", "rank"]
+logger = logging.getLogger(__name__)
+
+
+def _init_worker():
+    # one BLAS thread per process, otherwise the workers oversubscribe the cores
+    threadpool_limits(1)
+
+
+def job_name(job: dict) -> str:
+    """Prefix of the files a job writes to results/, one per city, store and n_locations."""
+    return f"{city_slug(job['city'])}_{city_slug(job['store'])}_{job['n_locations']}"
+
+
+def _summary(job: dict) -> dict:
+    return {"city": job["city"], "country": job["country"], "store": job["store"],
+            "n_locations": job["n_locations"], "name": job_name(job)}
+
+
+def run_job(job: dict, profile: str = None, refresh: bool = False) -> dict:
+    """Runs a single job and returns its summary row; never raises."""
+    start = time.perf_counter()
+    summary = _summary(job)
+    try:
+        new_locations = run_city(job["city"], job["country"], job["store"], job["n_locations"],
+                                 refresh=refresh, profile=profile, name=job_name(job))
+        locations = pd.DataFrame(new_locations, columns=LOCATION_COLUMNS)
+        locations.to_csv(RESULTS_DIR / f"{job_name(job)}_new_locations.csv", index=False)
+        summary.update(status="ok", error=None,
+                       best_score=float(locations["score"].max()),
+                       mean_score=float(locations["score"].mean()))
+    except Exception as e:
+        logger.error(f"Job {job_name(job)} failed: {e}")
+        summary.update(status="failed", error=traceback.format_exc(limit=3),
+                       best_score=None, mean_score=None)
+    summary["runtime_s"] = time.perf_counter() - start
+    return summary
+
+
+def run_city_jobs(jobs: list, profile: str = None, refresh: bool = False) -> list:
+    """run_job for the jobs of one city, one after another."""
+    return [run_job(job, profile, refresh) for job in jobs]
+
+
+def run_batch(jobs: list, workers: int = 2, profile: str = None, refresh: bool = False) -> pd.DataFrame:
+    """Runs the jobs and writes results/batch_summary.csv. Jobs are grouped by city (see
+    run_city_jobs); a job whose worker process died (e.g. out of memory) is recorded as failed."""
+    names = [job_name(job) for job in jobs]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate jobs (same city, store and n_locations): {duplicates}")
+    by_city = {}
+    for job in jobs:
+        by_city.setdefault(city_slug(job["city"]), []).append(job)
+
+    RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        futures = {pool.submit(run_city_jobs, city_jobs, profile, refresh): city_jobs
+                   for city_jobs in by_city.values()}
+        for future in as_completed(futures):
+            try:
+                city_rows = future.result()
+            except Exception as e:  # BrokenProcessPool: a worker was killed, the pending jobs fail with it
+                logger.error(f"Jobs of {futures[future][0]['city']} failed: {e!r}")
+                city_rows = [dict(_summary(job), status="failed", error=repr(e), best_score=None,
+                                  mean_score=None, runtime_s=None) for job in futures[future]]
+            for row in city_rows:
+                logger.info(f"{row['name']}: {row['status']} in {row['runtime_s'] or 0:.1f}s")
+                rows.append(row)
+
+    summary = pd.DataFrame(rows).sort_values(["city", "store", "n_locations"]).reset_index(drop=True)
+    summary.to_csv(RESULTS_DIR / "batch_summary.csv", index=False)
+    logger.info(f"Batch finished: {(summary.status == 'ok').sum()}/{len(summary)} cities succeeded.")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("jobs", help="JSON file with the list of jobs")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--snowflake-etl", action="store_true",
+                        help="refresh the Snowflake tables of all cities in one batched ETL run first")
+    parser.add_argument("--profile", choices=["json", "cprofile"],
+                        help="write per-city stage timings (and cProfile stats) to results/")
+    parser.add_argument("--cache", choices=["refresh", "clear"],
+                        help="recompute the cached optimizer results (refresh) or delete the whole cache first (clear)")
+    args = parser.parse_args()
+
+    with open(args.jobs, encoding="utf-8") as f:
+        jobs = json.load(f)
+    if args.snowflake_etl:
+        pool = get_pool()
+        if pool is None:
+            parser.error("--snowflake-etl needs a Snowflake connection")
+        run_etl_snowflake_cities(pool, jobs)
+        close_pool()  # the workers are forked and open their own connections
+    if args.cache == "clear":
+        ResultCache().invalidate()
+    run_batch(jobs, workers=args.workers, profile=args.profile, refresh=args.cache == "refresh")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""Offline benchmarks of the hot paths on synthetic cities.
+
+Usage:
+    python3 -m benchmarks.run_benchmarks --buildings 50000 --output bench.json
+    python3 -m benchmarks.run_benchmarks --compare bench.json  # fails on >25% slowdowns
+    python3 -m benchmarks.run_benchmarks --only --quality     # bayes vs bayes_batch placements
+
+Every case records the best wall time of --repeat runs and the peak traced
+(tracemalloc) memory of one run. No network access is needed.
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+from sklearn.neighbors import KDTree
+
+from benchmarks.synthetic import synthetic_city
+from data.local_etl import clean_iqr, number_of_residents
+from data.utils import _latlon_to_xy
+from src.SimpleBayesOpt import SimpleBayesOpt
+from src.optimization import find_best_location, make_sobol_candidates, refine_local
+from src.score import evaluate_score, evaluate_score_batch
+from src.store_index import StoreIndex
+from src.visualization import generate_map
+
+REGRESSION_THRESHOLD = 1.25
+
+
+def measure(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": min(times), "peak_mb": peak / 2**20}
+
+
+def build_cases(args):
+    housing, stores = synthetic_city(args.buildings, args.stores, args.clusters, seed=args.seed)
+    ref_lat = float(housing.lat.mean())
+    residents_xy = _latlon_to_xy(housing[["lat", "lon"]].to_numpy(), ref_lat)
+    residents_n = housing[["residents"]].to_numpy()
+    stores_xy = _latlon_to_xy(stores[["lat", "lon"]].to_numpy(), ref_lat)
+    tree_res, tree_store = KDTree(residents_xy), KDTree(stores_xy)
+    candidates = make_sobol_candidates(residents_xy, n_candidates=args.candidates)
+    bounds = list(zip(residents_xy.min(axis=0), residents_xy.max(axis=0)))
+
+    def bayes_run():
+        model = SimpleBayesOpt(bounds, tree_res, StoreIndex(stores_xy), residents_xy, residents_n,
+                               surrogate=args.surrogate)
+        model.run(first_data=candidates[:1024], n_iter=2)
+
+    city = "benchmark"
+    return {
+        "evaluate_score_single": (lambda: [evaluate_score(x, tree_res, tree_store, residents_xy, residents_n,
+                                                          stores_xy) for x in candidates[:256]], 256),
+        "evaluate_score_batch": (lambda: evaluate_score_batch(candidates, tree_res, tree_store, residents_n),
+                                 len(candidates)),
+        "simple_bayes_opt_run": (bayes_run, None),
+        "refine_local": (lambda: refine_local(candidates[:4], 1000, tree_res, tree_store, residents_n), 4),
+        "find_best_location": (lambda: find_best_location(housing, stores, n=args.n_locations,
+                                                          surrogate=args.surrogate), None),
+        "find_best_location_lazy": (lambda: find_best_location(housing, stores, n=args.n_locations,
+                                                               method="lazy_greedy"), None),
+        "find_best_location_grid": (lambda: find_best_location(housing, stores, n=args.n_locations,
+                                                               method="grid"), None),
+        "find_best_location_batch": (lambda: find_best_location(housing, stores, n=args.n_locations,
+                                                                method="bayes_batch", q=args.q,
+                                                                surrogate=args.surrogate), None),
+        "clean_iqr": (lambda: clean_iqr(housing), len(housing)),
+        "number_of_residents": (lambda: number_of_residents(housing.copy()), len(housing)),
+        "generate_map": (lambda: generate_map(housing, stores, np.zeros((0, 7)), city=city), len(housing)),
+    }, Path(f"results/{city}_zabka_map.html")
+
+
+def batch_quality(args):
+    """Placement quality and runtime of the one-at-a-time "bayes" greedy vs "bayes_batch" (q
+    stores per optimizer run), for --quality-locations stores on the same synthetic city."""
+    housing, stores = synthetic_city(args.buildings, args.stores, args.clusters, seed=args.seed)
+    quality = {}
+    for method, q in [("bayes", 1), ("bayes_batch", args.q)]:
+        start = time.perf_counter()
+        locations = find_best_location(housing, stores, n=args.quality_locations, method=method, q=q,
+                                       surrogate=args.surrogate)
+        name = f"{method}_q{q}"
+        quality[name] = {"seconds": time.perf_counter() - start,
+                         "total_score": float(locations[:, 5].sum()),
+                         "min_score": float(locations[:, 5].min())}
+        print(f"{name:28s} {quality[name]['seconds']:9.4f}s  total score {quality[name]['total_score']:.3f}")
+    return quality
+
+
+def compare(results, baseline_path):
+    baseline = json.loads(Path(baseline_path).read_text())["cases"]
+    regressions = []
+    for name, case in results.items():
+        if name not in baseline:
+            continue
+        ratio = case["seconds"] / baseline[name]["seconds"]
+        print(f"{name:28s} {baseline[name]['seconds']:9.4f}s -> {case['seconds']:9.4f}s  x{ratio:.2f}")
+        if ratio > REGRESSION_THRESHOLD:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--buildings", type=int, default=20000)
+    parser.add_argument("--stores", type=int, default=300)
+    parser.add_argument("--clusters", type=int, default=12)
+    parser.add_argument("--candidates", type=int, default=16384)
+    parser.add_argument("--n-locations", type=int, default=2)
+    parser.add_argument("--surrogate", default="gp")
+    parser.add_argument("--q", type=int, default=4, help="stores per round of the bayes_batch cases")
+    parser.add_argument("--quality", action="store_true", help="also compare bayes vs bayes_batch results")
+    parser.add_argument("--quality-locations", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", nargs="*", help="run only these cases")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--compare", help="JSON results of a previous run")
+    args = parser.parse_args()
+
+    Path("results").mkdir(exist_ok=True)
+    cases, map_path = build_cases(args)
+    results = {}
+    for name, (fn, items) in cases.items():
+        if args.only is not None and name not in args.only:
+            continue
+        results[name] = measure(fn, args.repeat)
+        if items:
+            results[name]["items_per_s"] = items / results[name]["seconds"]
+        print(f"{name:28s} {results[name]['seconds']:9.4f}s  peak {results[name]['peak_mb']:8.1f} MB")
+    map_path.unlink(missing_ok=True)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "cases": results,
+    }
+    if args.quality:
+        report["quality"] = batch_quality(args)
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    if args.compare:
+        regressions = compare(results, args.compare)
+        if regressions:
+            print(f"Slower than baseline by more than {REGRESSION_THRESHOLD:.2f}x: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
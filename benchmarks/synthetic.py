@@ -0,0 +1,44 @@
+"""Synthetic cities for offline benchmarks - same columns as the golden parquet files."""
+import numpy as np
+import pandas as pd
+from data.utils import RESIDENTIAL_TYPES
+
+CENTER = (52.2297, 21.0122)  # Warsaw
+SPREAD_DEG = 0.08
+
+
+def synthetic_city(n_buildings=20000, n_stores=300, n_clusters=12, seed=0, center=CENTER):
+    """Returns (housing, stores) DataFrames. Buildings are a mix of Gaussian clusters
+    (dense districts) and a uniform background, stores follow the buildings.
+    Housing is in silver shape (levels, area_m2) plus residents, as in the golden layer.
+    """
+    rng = np.random.default_rng(seed)
+    lat0, lon0 = center
+    n_clustered = int(n_buildings * 0.8)
+    centers = rng.uniform(-SPREAD_DEG, SPREAD_DEG, size=(n_clusters, 2))
+    scales = rng.uniform(0.004, 0.015, size=n_clusters)
+    which = rng.integers(0, n_clusters, n_clustered)
+    clustered = centers[which] + rng.standard_normal((n_clustered, 2)) * scales[which, None]
+    background = rng.uniform(-SPREAD_DEG, SPREAD_DEG, size=(n_buildings - n_clustered, 2))
+    offsets = np.vstack([clustered, background])
+
+    housing = pd.DataFrame({
+        "housenumber": None,
+        "street": None,
+        "levels": rng.integers(1, 11, n_buildings).astype(float),
+        "area_m2": rng.lognormal(5, 0.6, n_buildings),
+        "lat": lat0 + offsets[:, 0],
+        "lon": lon0 + offsets[:, 1],
+        "building_type": rng.choice(RESIDENTIAL_TYPES, n_buildings),
+    })
+    housing["residents"] = housing.levels * np.ceil(housing.area_m2 / 25)
+
+    store_rows = rng.choice(n_buildings, size=n_stores, replace=False)
+    stores = pd.DataFrame({
+        "name": "Żabka",
+        "lat": housing.lat.to_numpy()[store_rows] + rng.normal(0, 0.0005, n_stores),
+        "lon": housing.lon.to_numpy()[store_rows] + rng.normal(0, 0.0005, n_stores),
+        "housenumber": None,
+        "street": None,
+    })
+    return housing, stores
@@ -0,0 +1,120 @@
+"""Pre-projected, memory-mappable copy of the golden housing layer.
+
+Next to data/golden/<city>_housing.parquet the golden step writes a directory
+<city>_housing.columnar/ with plain .npy arrays (x/y in meters, residents) and the
+KDTree over them. Loading maps the files instead of reading them, so it costs almost
+nothing and worker processes loading the same city share the pages.
+"""
+import json
+import pickle
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import sklearn
+from sklearn.neighbors import KDTree
+from data.utils import _latlon_to_xy
+from src.profiling import timed, timer
+from src.surface import resident_rasters
+
+FORMAT_VERSION = 1
+OPTIMIZER_COLUMNS = ["lat", "lon", "residents"]  # all find_best_location needs from the housing
+# KDTree.__getstate__ entries stored as separate .npy files (the first one is the xy data itself)
+TREE_ARRAYS = ["xy", "idx_array", "node_data", "node_bounds"]
+MAX_RASTERS = 2  # cell sizes whose resident rasters a GoldenHousing keeps
+
+
+class GoldenHousing:
+    """Optimizer inputs for one city: projected residents, their counts and KD-tree.
+    rasters - resident_rasters (src/surface.py) of the MAX_RASTERS most recently used cell
+    sizes (see grid_rasters), so a long-lived instance (OptimizationSession) builds them once."""
+    def __init__(self, ref_lat, residents_xy, residents_n, tree):
+        self.ref_lat = ref_lat
+        self.residents_xy = residents_xy
+        self.residents_n = residents_n
+        self.tree = tree
+        self.rasters = {}
+
+    @classmethod
+    def from_dataframe(cls, housing: pd.DataFrame):
+        """Projects housing (lat, lon, residents) and builds the KD-tree in memory."""
+        ref_lat = float(np.mean(housing['lat'].to_numpy()))
+        residents_xy = _latlon_to_xy(housing[['lat', 'lon']].to_numpy(), ref_lat)
+        with timer("kdtree_build", items=len(residents_xy)):
+            tree = KDTree(residents_xy)
+        return cls(ref_lat, residents_xy, housing[['residents']].to_numpy(), tree)
+
+    def grid_rasters(self, cell_size):
+        """resident_rasters for cell_size, from the memo if it was used recently."""
+        rasters = self.rasters.pop(cell_size, None)
+        if rasters is None:
+            rasters = resident_rasters(self.residents_xy, self.residents_n, cell_size)
+        self.rasters[cell_size] = rasters  # most recently used last
+        while len(self.rasters) > MAX_RASTERS:
+            del self.rasters[next(iter(self.rasters))]
+        return rasters
+
+    def __len__(self):
+        return len(self.residents_xy)
+
+
+def columnar_path(parquet_path) -> Path:
+    return Path(parquet_path).with_suffix(".columnar")
+
+
+@timed("columnar_write", items=lambda housing, *args, **kwargs: len(housing))
+def write_columnar(housing: pd.DataFrame, path, source_hash=None):
+    """Projects housing like find_best_location does and writes the arrays and KD-tree to `path`."""
+    path = Path(path)
+    ref_lat = float(np.mean(housing['lat'].to_numpy()))
+    residents_xy = _latlon_to_xy(housing[['lat', 'lon']].to_numpy(), ref_lat)
+    state = KDTree(residents_xy).__getstate__()
+
+    tmp = path.with_name(path.name + ".tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    for name, array in zip(TREE_ARRAYS, state[:len(TREE_ARRAYS)]):
+        np.save(tmp / f"{name}.npy", np.asarray(array))
+    np.save(tmp / "residents.npy", housing['residents'].to_numpy(dtype=float))
+    with open(tmp / "tree_state.pkl", "wb") as f:
+        pickle.dump(state[len(TREE_ARRAYS):], f)
+    (tmp / "meta.json").write_text(json.dumps({
+        "format_version": FORMAT_VERSION,
+        "sklearn_version": sklearn.__version__,
+        "ref_lat": ref_lat,
+        "rows": len(housing),
+        "source_hash": source_hash,
+    }, indent=2))
+
+    shutil.rmtree(path, ignore_errors=True)
+    tmp.rename(path)
+
+
+def read_columnar_meta(path):
+    path = Path(path) / "meta.json"
+    return json.loads(path.read_text()) if path.exists() else None
+
+
+@timed("columnar_load")
+def load_columnar(path, mmap=True) -> GoldenHousing:
+    """Maps the arrays of a columnar directory (read-only). The KD-tree is restored from
+    the stored state; if that is not possible (e.g. another sklearn version) it is rebuilt."""
+    path = Path(path)
+    meta = read_columnar_meta(path)
+    mode = "r" if mmap else None
+    arrays = [np.load(path / f"{name}.npy", mmap_mode=mode) for name in TREE_ARRAYS]
+    residents_n = np.load(path / "residents.npy", mmap_mode=mode).reshape(-1, 1)
+
+    tree = None
+    if meta["sklearn_version"] == sklearn.__version__:
+        try:
+            with open(path / "tree_state.pkl", "rb") as f:
+                rest = pickle.load(f)
+            tree = KDTree.__new__(KDTree)
+            tree.__setstate__((*arrays, *rest))
+        except Exception:
+            tree = None
+    if tree is None:
+        tree = KDTree(arrays[0])
+    return GoldenHousing(meta["ref_lat"], arrays[0], residents_n, tree)
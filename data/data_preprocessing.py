@@ -1,10 +1,15 @@
 import logging
 import pandas as pd
 from pathlib import Path
-from data.local_etl import run_etl_housing, run_etl_stores
+from data.local_etl import refresh_etl_housing, refresh_etl_stores, MAX_AGE, read_meta
+from src.profiling import timed
+from data.columnar import GoldenHousing, OPTIMIZER_COLUMNS, columnar_path, load_columnar, read_columnar_meta
 from data.snowflake_functions import (
-    get_connection_snowflake,
+    get_pool,
     read_table,
+    read_housing_arrays,
+    HOUSING_READ_COLUMNS,
+    STORE_READ_COLUMNS,
     run_etl_snowflake_stores,
     run_etl_snowflake_housing,
 )
@@ -20,57 +25,109 @@ def parquet_path(city: str, kind: str) -> Path:
     return DATA_DIR / f"golden/{city_slug(city)}_{kind}.parquet"
 
 
-def load_dataframe(path: Path) -> pd.DataFrame:
-    return pd.read_parquet(path)
+def load_dataframe(path: Path, columns=None) -> pd.DataFrame:
+    """columns - read only these columns (e.g. data.columnar.OPTIMIZER_COLUMNS), None reads all."""
+    return pd.read_parquet(path, columns=columns)
 
 
-def load_stores_data(city: str, country: str, store: str) -> pd.DataFrame:
+def load_stores_data(city: str, country: str, store: str, max_age=MAX_AGE) -> pd.DataFrame:
+    """Golden store locations, refreshed first (incrementally if possible) when older than max_age;
+    used as they are if Overpass cannot be reached."""
     out_path = parquet_path(city, "store_locations")
     logger.info(f"Loading store data from {out_path}")
-    if out_path.exists():
-        logger.info(f"{out_path} already exists. Loading cached data.")
-        return load_dataframe(out_path)
-    else:
-        logger.info(f"{out_path} not found. Running ETL for {store} in {city}, {country}.")
-        run_etl_stores(city, country, store)
-        return load_dataframe(out_path)
+    status = refresh_etl_stores(city, country, store, max_age=max_age)
+    logger.info(f"{out_path}: {status} ({store} in {city}, {country}).")
+    return load_dataframe(out_path)
 
 
-def load_housing_data(city: str, country: str) -> pd.DataFrame:
+def load_housing_data(city: str, country: str, max_age=MAX_AGE, columns=None) -> pd.DataFrame:
+    """Golden housing, refreshed first (incrementally if possible) when older than max_age."""
     out_path = parquet_path(city, "housing")
-    if out_path.exists():
-        logger.info(f"{out_path} already exists. Loading cached data.")
-        return load_dataframe(out_path)
-    else:
-        logger.info(f"{out_path} not found. Running ETL for housing in {city}, {country}.")
-        run_etl_housing(city, country)
-        return load_dataframe(out_path)
+    status = refresh_etl_housing(city, country, max_age=max_age)
+    logger.info(f"{out_path}: {status} (housing in {city}, {country}).")
+    return load_dataframe(out_path, columns=columns)
+
+
+def load_golden_columnar(city: str, mmap=True) -> GoldenHousing:
+    """Memory-mapped, pre-projected golden housing (see data/columnar.py) for find_best_location.
+    None if it does not exist or is out of sync with the golden parquet."""
+    path = parquet_path(city, "housing")
+    meta, columnar_meta = read_meta(path), read_columnar_meta(columnar_path(path))
+    if meta is None or columnar_meta is None or columnar_meta["source_hash"] != meta["content_hash"]:
+        return None
+    return load_columnar(columnar_path(path), mmap=mmap)
+
+
+def load_housing_arrays(city: str, country: str, max_age=MAX_AGE) -> GoldenHousing:
+    """load_housing_data for the optimizer only: the columnar copy of the golden housing
+    (the parquet's optimizer columns if it is missing)."""
+    status = refresh_etl_housing(city, country, max_age=max_age)
+    logger.info(f"{parquet_path(city, 'housing')}: {status} (housing in {city}, {country}).")
+    housing = load_golden_columnar(city)
+    if housing is None:
+        housing = GoldenHousing.from_dataframe(load_dataframe(parquet_path(city, "housing"), OPTIMIZER_COLUMNS))
+    return housing
+
+
+def optimizer_housing(city: str, housing: pd.DataFrame) -> GoldenHousing:
+    """GoldenHousing of the housing load_and_filter_data returned: its columnar copy when it
+    came from the local golden parquet, projected from the frame when it came from Snowflake."""
+    golden = load_golden_columnar(city) if get_pool() is None else None
+    return golden if golden is not None else GoldenHousing.from_dataframe(housing)
 
 
 def load_snowflake_stores(conn, city: str, country: str, store: str):
     schema = "STORE_LOC"
-    golden = read_table(conn, schema, "L3_GOLDEN")
+    golden = read_table(conn, schema, "L3_GOLDEN", columns=STORE_READ_COLUMNS, city=city)
+    if golden is None:  # tables loaded before stores had osm_id
+        golden = read_table(conn, schema, "L3_GOLDEN", columns=["lat", "lon"], city=city)
     if golden is not None and not golden.empty:
         return golden
     else:
-        run_etl_snowflake_stores(conn, city, country, store, schema)
+        return run_etl_snowflake_stores(conn, city, country, store, schema)
 
 
 def load_snowflake_housing(conn, city: str, country: str):
     schema = "HOUSE_LOC"
-    golden = read_table(conn, schema, "L3_GOLDEN")
+    golden = read_table(conn, schema, "L3_GOLDEN", columns=HOUSING_READ_COLUMNS, city=city)
     if golden is not None and not golden.empty:
         return golden
     else:
-        run_etl_snowflake_housing(conn, city, country, schema)
+        return run_etl_snowflake_housing(conn, city, country, schema)
 
 
+def load_snowflake_housing_arrays(conn, city: str, country: str) -> GoldenHousing:
+    """load_snowflake_housing for the optimizer only, streamed into its arrays (read_housing_arrays)."""
+    schema = "HOUSE_LOC"
+    housing = read_housing_arrays(conn, schema, "L3_GOLDEN", city=city)
+    if housing is not None:
+        return housing
+    return GoldenHousing.from_dataframe(run_etl_snowflake_housing(conn, city, country, schema))
+
+
+@timed("load_and_filter_data")
 def load_and_filter_data(city: str = "Warszawa", country: str = "Polska", store = "Żabka"):
-    conn = get_connection_snowflake()
-    if conn:
-        store_locations = load_snowflake_stores(conn, city, country, store)
-        housing = load_snowflake_housing(conn, city, country)
+    pool = get_pool()
+    if pool is not None:
+        with pool.connection() as conn:
+            store_locations = load_snowflake_stores(conn, city, country, store)
+            housing = load_snowflake_housing(conn, city, country)
     else:
         store_locations = load_stores_data(city, country, store)
         housing = load_housing_data(city, country)
     return housing, store_locations
+
+
+@timed("load_optimizer_data")
+def load_optimizer_data(city: str = "Warszawa", country: str = "Polska", store="Żabka"):
+    """load_and_filter_data without the full housing frame (e.g. for OptimizationSession):
+    returns the housing as GoldenHousing and the store locations."""
+    pool = get_pool()
+    if pool is not None:
+        with pool.connection() as conn:
+            store_locations = load_snowflake_stores(conn, city, country, store)
+            housing = load_snowflake_housing_arrays(conn, city, country)
+    else:
+        store_locations = load_stores_data(city, country, store)
+        housing = load_housing_arrays(city, country)
+    return housing, store_locations
@@ -1,65 +1,205 @@
+import hashlib
+import json
 import logging
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from data.utils import fetch_stores_data, fetch_housing_data
+from requests.exceptions import RequestException
+from data.utils import fetch_stores_data, fetch_housing_data, OverpassError
 from data.utils import DEFAULT_LEVELS, DEFAULT_AREA
+from data.columnar import OPTIMIZER_COLUMNS, columnar_path, read_columnar_meta, write_columnar
+from data.quantiles import StreamingQuantiles
+from src.profiling import timed
 
 SQR_METER_PER_PERSON = 25
+MAX_AGE = timedelta(days=7)            # older golden data is refreshed incrementally
+FULL_REFRESH_AGE = timedelta(days=30)  # since the last full fetch; refetch all (drops deleted buildings)
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+CHUNK_ROWS = 100_000  # rows per chunk of the housing transforms
 logger = logging.getLogger(__name__)
 
+
+def layer_path(layer: str, city: str, kind: str) -> Path:
+    return Path("data") / layer / f"{city.lower().replace(' ', '_')}_{kind}.parquet"
+
+
+def meta_path(path) -> Path:
+    return Path(path).with_suffix(".meta.json")
+
+
+def write_layer(df: pd.DataFrame, path, source: str, fetched_at: str = None, **extra):
+    """Writes the parquet file of a layer and its metadata next to it:
+    fetch time (of the underlying bronze data), source, row count and content hash."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    df.to_parquet(path, index=False)
+    h = hashlib.sha256(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return _write_meta(path, source, fetched_at, len(df), list(df.columns), h, extra)
+
+
+def _write_meta(path, source, fetched_at, rows, columns, content_hash, extra):
+    meta = {
+        "fetched_at": fetched_at or _now(),
+        "source": source,
+        "rows": rows,
+        "columns": columns,
+        "content_hash": content_hash.hexdigest(),
+        **extra,
+    }
+    meta_path(path).write_text(json.dumps(meta, indent=2))
+    return meta
+
+
+class LayerWriter:
+    """ write_layer for data that arrives in chunks: chunks are appended as parquet row
+    groups with the given arrow schema, the metadata (same content hash as write_layer of
+    the concatenated frame) is written by close().
+    """
+    def __init__(self, path, schema: pa.Schema, source: str, fetched_at: str = None, **extra):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.schema = schema
+        self.meta_args = (source, fetched_at, extra)
+        self.rows = 0
+        self.hash = hashlib.sha256()
+        self.writer = pq.ParquetWriter(self.path, schema)
+
+    def write(self, df: pd.DataFrame):
+        self.writer.write_table(pa.Table.from_pandas(df, schema=self.schema, preserve_index=False))
+        self.hash.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+        self.rows += len(df)
+
+    def close(self):
+        self.writer.close()
+        source, fetched_at, extra = self.meta_args
+        return _write_meta(self.path, source, fetched_at, self.rows, self.schema.names, self.hash, extra)
+
+
+def read_meta(path):
+    """Metadata written by write_layer, None for layers written without it."""
+    path = meta_path(path)
+    return json.loads(path.read_text()) if path.exists() else None
+
+
+def fetched_at(path):
+    meta = read_meta(path)
+    return meta["fetched_at"] if meta else None
+
+
+def layer_age(path, key="fetched_at"):
+    """Time since the data in the layer was fetched (file mtime for layers without
+    metadata), None if the layer does not exist."""
+    path = Path(path)
+    if not path.exists():
+        return None
+    meta = read_meta(path)
+    if meta is None:
+        return datetime.now(timezone.utc) - datetime.fromtimestamp(path.stat().st_mtime, timezone.utc)
+    fetched = datetime.strptime(meta.get(key, meta["fetched_at"]), TIME_FORMAT).replace(tzinfo=timezone.utc)
+    return datetime.now(timezone.utc) - fetched
+
+
+def _now():
+    return datetime.now(timezone.utc).strftime(TIME_FORMAT)
+
+
 def run_etl_stores(city:str, country: str, store: str):
     bronze_stores(city, country, store)
     silver_stores(city)
     golden_stores(city)
 
 
+@timed("etl_bronze_stores")
 def bronze_stores(city:str, country: str, store: str):
-    out_path = Path("data/bronze") / f"{city.lower().replace(' ', '_')}_store_locations.parquet"
-    out_path.parent.mkdir(parents=True, exist_ok=True)
+    out_path = layer_path("bronze", city, "store_locations")
+    now = _now()
     df = fetch_stores_data(city, country, store)
-    df.to_parquet(out_path, index=False)
+    write_layer(df, out_path, source=f"overpass: {store} stores in {city}, {country}", fetched_at=now,
+                full_fetched_at=now)
 
 
+@timed("etl_silver_stores")
 def silver_stores(city):
-    path = f"data/bronze/{city.lower().replace(' ', '_')}_store_locations.parquet"
+    path = layer_path("bronze", city, "store_locations")
     df = pd.read_parquet(path)
     if not df.empty:
         df = df.dropna(subset=["lat", "lon"])
-    df = clean_iqr(df)
-    out_path = Path("data/silver") / f"{city.lower().replace(' ', '_')}_store_locations.parquet"
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    df.to_parquet(out_path, index=False)
+    bounds = iqr_filter_bounds(df)
+    df = clean_iqr(df, bounds=bounds)
+    write_layer(df, layer_path("silver", city, "store_locations"), source=str(path),
+                fetched_at=fetched_at(path), iqr_bounds=bounds)
 
 
+@timed("etl_golden_stores")
 def golden_stores(city):
-    path = f"data/silver/{city.lower().replace(' ', '_')}_store_locations.parquet"
+    path = layer_path("silver", city, "store_locations")
     df = pd.read_parquet(path)
-    out_path = Path("data/golden")/f"{city.lower().replace(' ', '_')}_store_locations.parquet"
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    df.to_parquet(out_path, index=False)
+    write_layer(df, layer_path("golden", city, "store_locations"), source=str(path),
+                fetched_at=fetched_at(path))
 
 
 def run_etl_housing(city:str, country: str):
     bronze_housing(city, country)
-    silver_housing(city)
-    golden_housing(city)
+    transform_housing(city)
 
 
+@timed("etl_bronze_housing")
 def bronze_housing(city:str, country: str):
+    now = _now()  # before the fetch, so changes made while it runs are picked up by the next delta
     housing = fetch_housing_data(city, country)
-    out_path = Path("data/bronze") / f"{city.lower().replace(' ', '_')}_housing.parquet"
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    housing.to_parquet(out_path, index=False)
+    out_path = layer_path("bronze", city, "housing")
+    write_layer(housing, out_path, source=f"overpass: residential buildings in {city}, {country}",
+                fetched_at=now, full_fetched_at=now)
     logger.info(f"Saved housing data to {out_path}")
 
 
-def silver_housing(city):
-    path = f"data/bronze/{city.lower().replace(' ', '_')}_housing.parquet"
-    df = pd.read_parquet(path)
-    if not df.empty:
-        df = df.dropna(subset=["lat", "lon"])
-    df = clean_iqr(df)
+@timed("etl_transform_housing")
+def transform_housing(city, chunk_rows=CHUNK_ROWS):
+    """Bronze -> silver -> golden housing in two passes over row-group chunks of bronze, so
+    memory does not grow with the city: the first pass feeds lat/lon into streaming
+    quantile sketches for the IQR bounds, the second one filters and cleans each chunk and
+    appends it to silver and (with the residents) to golden. For up to SKETCH_SIZE
+    buildings the bounds, and so the output, are exactly those of clean_iqr."""
+    path = layer_path("bronze", city, "housing")
+    bronze = pq.ParquetFile(path)
+    sketches = {col: StreamingQuantiles() for col in ("lat", "lon")}
+    for batch in bronze.iter_batches(batch_size=chunk_rows, columns=list(sketches)):
+        chunk = batch.to_pandas().dropna()
+        for col, sketch in sketches.items():
+            sketch.update(chunk[col].to_numpy())
+    bounds = {col: _iqr_from_quartiles(sketch.quantile(0.25), sketch.quantile(0.75))
+              for col, sketch in sketches.items()}
+
+    fields = [pa.field(f.name, pa.float64()) if f.name in ("area_m2", "levels") else f
+              for f in bronze.schema_arrow]
+    silver_schema = pa.schema(fields)
+    silver = LayerWriter(layer_path("silver", city, "housing"), silver_schema, source=str(path),
+                         fetched_at=fetched_at(path), iqr_bounds=bounds)
+    golden_schema = silver_schema.append(pa.field("residents", pa.float64()))
+    golden = LayerWriter(layer_path("golden", city, "housing"), golden_schema, source=str(silver.path),
+                         fetched_at=fetched_at(path))
+    removed = 0
+    for batch in bronze.iter_batches(batch_size=chunk_rows):
+        chunk = batch.to_pandas().dropna(subset=["lat", "lon"])
+        mask = np.ones(len(chunk), dtype=bool)
+        for col, (lower, upper) in bounds.items():
+            mask &= (chunk[col] >= lower) & (chunk[col] <= upper)
+        removed += int((~mask).sum())
+        chunk = clean_housing(chunk.loc[mask].reset_index(drop=True))
+        silver.write(chunk)
+        golden.write(number_of_residents(chunk))
+    silver.close()
+    golden_meta = golden.close()
+    logger.info(f"Removed {removed} outliers out of {bronze.metadata.num_rows} rows.")
+    write_columnar(pd.read_parquet(golden.path, columns=OPTIMIZER_COLUMNS), columnar_path(golden.path),
+                   source_hash=golden_meta["content_hash"])
+
+
+def clean_housing(df: pd.DataFrame) -> pd.DataFrame:
+    """Row-wise silver cleaning: defaults for missing or zero area and levels."""
     df["area_m2"] = df["area_m2"].fillna(DEFAULT_AREA)
     df.loc[df["area_m2"] == 0, "area_m2"] = DEFAULT_AREA
     df["area_m2"] = df["area_m2"].astype(float)
@@ -67,16 +207,107 @@ def silver_housing(city):
     df["levels"] = df["levels"].fillna(DEFAULT_LEVELS)
     df.loc[df["levels"] == 0, "levels"] = DEFAULT_LEVELS
     df["levels"] = df["levels"].astype(float)
-    out_path = f"data/silver/{city.lower().replace(' ', '_')}_housing.parquet"
-    df.to_parquet(out_path, index=False)
+    return df
 
 
-def golden_housing(city):
-    path = f"data/silver/{city.lower().replace(' ', '_')}_housing.parquet"
-    df = pd.read_parquet(path)
-    df = number_of_residents(df)
-    out_path = f"data/golden/{city.lower().replace(' ', '_')}_housing.parquet"
-    df.to_parquet(out_path, index=False)
+def sync_golden_columnar(city) -> bool:
+    """Rewrites the columnar copy of the golden housing if it is missing or was written
+    from other golden data. Returns True if it was rewritten."""
+    path = layer_path("golden", city, "housing")
+    meta, columnar_meta = read_meta(path), read_columnar_meta(columnar_path(path))
+    if meta is None or (columnar_meta is not None and columnar_meta["source_hash"] == meta["content_hash"]):
+        return False
+    write_columnar(pd.read_parquet(path, columns=OPTIMIZER_COLUMNS), columnar_path(path),
+                   source_hash=meta["content_hash"])
+    return True
+
+
+def refresh_etl_housing(city: str, country: str, max_age: timedelta = MAX_AGE,
+                        full_refresh_age: timedelta = FULL_REFRESH_AGE) -> str:
+    """Brings the housing layers up to date according to the max-age policy.
+    Returns what was done: "fresh", "incremental", "full" or "stale" (the refresh failed,
+    the existing golden data is kept).
+    """
+    status = _refresh(city, "housing", max_age, full_refresh_age,
+                      run_full=lambda: run_etl_housing(city, country),
+                      fetch_changed=lambda since: fetch_housing_data(city, country, newer=since),
+                      to_silver=clean_housing,
+                      to_golden=number_of_residents)
+    sync_golden_columnar(city)
+    return status
+
+
+def refresh_etl_stores(city: str, country: str, store: str, max_age: timedelta = MAX_AGE,
+                       full_refresh_age: timedelta = FULL_REFRESH_AGE) -> str:
+    """refresh_etl_housing for the store locations."""
+    return _refresh(city, "store_locations", max_age, full_refresh_age,
+                    run_full=lambda: run_etl_stores(city, country, store),
+                    fetch_changed=lambda since: fetch_stores_data(city, country, store, newer=since),
+                    to_silver=lambda df: df,
+                    to_golden=lambda df: df)
+
+
+@timed("etl_refresh")
+def _refresh(city, kind, max_age, full_refresh_age, run_full, fetch_changed, to_silver, to_golden):
+    """Fresh golden data is left alone. Stale data is refreshed with an Overpass `newer:`
+    query for the elements changed since the last fetch; only those rows are cleaned,
+    recomputed and upserted (by osm_id) into bronze, silver and golden. The IQR bounds
+    of the last full silver run are reused for the changed rows. Without metadata, without
+    osm_id or when older than full_refresh_age, all layers are rebuilt.
+    If Overpass cannot be reached, existing golden data is used as it is ("stale").
+    """
+    paths = {layer: layer_path(layer, city, kind) for layer in ("bronze", "silver", "golden")}
+    golden_age = layer_age(paths["golden"])
+    if golden_age is not None and golden_age <= max_age:
+        return "fresh"
+    try:
+        return _update(city, kind, paths, full_refresh_age, run_full, fetch_changed, to_silver, to_golden)
+    except (OverpassError, RequestException) as e:
+        if golden_age is None:
+            raise
+        logger.warning(f"Refresh of {kind} for {city} failed, using the stale golden data: {e}")
+        return "stale"
+
+
+def _update(city, kind, paths, full_refresh_age, run_full, fetch_changed, to_silver, to_golden):
+    """Full or incremental update of the layers of _refresh; the fetch comes before any write."""
+    bronze_age = layer_age(paths["bronze"], key="full_fetched_at")
+    metas = {layer: read_meta(path) for layer, path in paths.items()}
+    if (bronze_age is None or bronze_age > full_refresh_age or None in metas.values()
+            or "osm_id" not in metas["bronze"].get("columns", [])):
+        logger.info(f"Full refresh of {kind} for {city}")
+        run_full()
+        return "full"
+
+    now = _now()  # fetch_changed raises if it is incomplete, then no metadata is advanced
+    changed = fetch_changed(metas["bronze"]["fetched_at"])
+    logger.info(f"Incremental refresh of {kind} for {city}: {len(changed)} changed rows")
+
+    bronze = _upsert(pd.read_parquet(paths["bronze"]), changed)
+    write_layer(bronze, paths["bronze"], source=metas["bronze"]["source"], fetched_at=now,
+                full_fetched_at=metas["bronze"].get("full_fetched_at", metas["bronze"]["fetched_at"]))
+
+    bounds = metas["silver"]["iqr_bounds"]
+    dropped = changed["osm_id"] if not changed.empty else pd.Series(dtype=object)
+    changed = changed.dropna(subset=["lat", "lon"]) if not changed.empty else changed
+    changed_silver = to_silver(clean_iqr(changed, bounds=bounds)) if not changed.empty else changed
+    silver = _upsert(pd.read_parquet(paths["silver"]), changed_silver, dropped)
+    write_layer(silver, paths["silver"], source=metas["silver"]["source"], fetched_at=now,
+                iqr_bounds=bounds)
+
+    changed_golden = to_golden(changed_silver) if not changed_silver.empty else changed_silver
+    golden = _upsert(pd.read_parquet(paths["golden"]), changed_golden, dropped)
+    write_layer(golden, paths["golden"], source=metas["golden"]["source"], fetched_at=now)
+    return "incremental"
+
+
+def _upsert(old: pd.DataFrame, changed: pd.DataFrame, replaced=None) -> pd.DataFrame:
+    """Replaces the rows of `old` whose osm_id is in `replaced` (default: changed.osm_id) by `changed`."""
+    if changed.empty and replaced is None:
+        return old
+    replaced = changed["osm_id"] if replaced is None else replaced
+    kept = old[~old["osm_id"].isin(replaced)]
+    return pd.concat([kept, changed], ignore_index=True) if not changed.empty else kept.reset_index(drop=True)
 
 
 def number_of_residents(housing: pd.DataFrame) -> pd.DataFrame:
@@ -86,18 +317,24 @@ def number_of_residents(housing: pd.DataFrame) -> pd.DataFrame:
 
 
 def iqr_bounds(series, factor = 3):
-            q1 = series.quantile(0.25)
-            q3 = series.quantile(0.75)
-            iqr = q3 - q1
-            lower = q1 - factor * iqr
-            upper = q3 + factor * iqr
-            return lower, upper
+            return _iqr_from_quartiles(series.quantile(0.25), series.quantile(0.75), factor)
+
+
+def _iqr_from_quartiles(q1, q3, factor=3):
+    iqr = q3 - q1
+    return [float(q1 - factor * iqr), float(q3 + factor * iqr)]
+
+
+def iqr_filter_bounds(df, cols=["lat", "lon"], factor=3) -> dict:
+    return {col: [float(b) for b in iqr_bounds(df[col], factor=factor)] for col in cols}
 
 
-def clean_iqr(df, cols=["lat", "lon"], factor=3):
+def clean_iqr(df, cols=["lat", "lon"], factor=3, bounds=None):
+    """Drops rows outside the IQR bounds of cols; `bounds` ({col: [lower, upper]}) are
+    computed from df when not given."""
+    bounds = bounds or iqr_filter_bounds(df, cols, factor)
     mask = np.ones(len(df), dtype=bool)
-    for col in cols:
-        lower, upper = iqr_bounds(df[col], factor=factor)
+    for col, (lower, upper) in bounds.items():
         mask &= (df[col] >= lower) & (df[col] <= upper)
 
     cleaned = df.loc[mask].reset_index(drop=True)
@@ -0,0 +1,51 @@
+import numpy as np
+
+SKETCH_SIZE = 2 ** 15  # values kept per level
+
+
+class StreamingQuantiles:
+    ''' Quantiles of a stream of arrays in bounded memory (a KLL-style sketch).
+    Level h holds values of weight 2**h; a level that grows beyond `size` is sorted and
+    every second value (random offset) moves up one level. While no more than `size`
+    values were seen nothing is compacted and quantile() equals np.quantile / pandas
+    (linear interpolation). After that the rank error is a few multiples of n / size
+    and memory is O(size * log2(n / size)).
+    '''
+    def __init__(self, size=SKETCH_SIZE, random_state=0):
+        self.size = size
+        self.levels = [np.empty(0)]
+        self.count = 0
+        self.rng = np.random.default_rng(random_state)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        self.count += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        h = 0
+        while h < len(self.levels):
+            if len(self.levels[h]) > self.size:
+                self._compact(h)
+            h += 1
+        return self
+
+    def _compact(self, h):
+        level = np.sort(self.levels[h])
+        if len(level) % 2:  # the largest value stays, so an even number moves up
+            level, self.levels[h] = level[:-1], level[-1:]
+        else:
+            self.levels[h] = np.empty(0)
+        if h + 1 == len(self.levels):
+            self.levels.append(np.empty(0))
+        self.levels[h + 1] = np.concatenate([self.levels[h + 1], level[self.rng.integers(2)::2]])
+
+    def quantile(self, q):
+        if self.count == 0:
+            return np.nan
+        if len(self.levels) == 1:
+            return float(np.quantile(self.levels[0], q))
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level), 2.0 ** h) for h, level in enumerate(self.levels)])
+        order = np.argsort(values)
+        ranks = np.cumsum(weights[order]) - weights[order] / 2  # rank of each value's middle
+        return float(np.interp(q * weights.sum(), ranks, values[order]))
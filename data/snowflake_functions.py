@@ -1,63 +1,266 @@
 import os
+import queue
+import threading
+import numpy as np
 import pandas as pd
 import logging
 import snowflake.connector
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from typing import Optional
 from dotenv import load_dotenv
+from sklearn.neighbors import KDTree
 from snowflake.connector.pandas_tools import write_pandas
-from data.utils import fetch_stores_data, fetch_housing_data
+from data.utils import fetch_stores_data, fetch_housing_data, _latlon_to_xy
 from data.utils import DEFAULT_LEVELS, DEFAULT_AREA
+from data.columnar import GoldenHousing, OPTIMIZER_COLUMNS
 
 load_dotenv()
 logger = logging.getLogger(__name__)
+# golden housing columns used by the optimizer and the map
+HOUSING_READ_COLUMNS = OPTIMIZER_COLUMNS + ["building_type", "area_m2"]
+# golden store columns: the location and osm_id to exclude stores by (OptimizationSession)
+STORE_READ_COLUMNS = ["osm_id", "lat", "lon"]
+POOL_SIZE = 4
+_pool = None
+_pool_pid = None  # process that opened _pool, a forked child must not use its sockets
+_pool_failed = False
+_pool_lock = threading.Lock()
+UPLOAD_CHUNK = 100_000  # rows per write_pandas file
 
 
-def get_connection_snowflake():
-    """Establish connection to Snowflake if credentials are available."""
+def _connect_params() -> dict:
+    return dict(user=os.getenv("SNOWFLAKE_USER"), password=os.getenv("SNOWFLAKE_PASSWORD"),
+                account=os.getenv("SNOWFLAKE_ACCOUNT"))
+
+
+def setup_environment(conn, warehouse: str, database: str):
+    """Creates the warehouse and database if missing and switches the session to them."""
+    cur = conn.cursor()
+    cur.execute(f"""
+        CREATE WAREHOUSE IF NOT EXISTS {warehouse} WITH WAREHOUSE_SIZE = 'XSMALL'
+        AUTO_SUSPEND = 300 AUTO_RESUME = TRUE;
+        """
+    )
+    cur.execute(f"CREATE DATABASE IF NOT EXISTS {database}")
+    cur.execute(f"USE WAREHOUSE {warehouse}")
+    cur.execute(f"USE DATABASE {database}")
+    logger.info(f"Connected to Snowflake. Environment ready: {warehouse} / {database}")
+    cur.close()
+
+
+class PooledConnection:
+    """ Connection of a SnowflakePool. cursor() always returns the same cursor, whose close()
+    is a no-op, so the helpers below reuse it. Everything else is passed to the connection.
+    """
+    def __init__(self, conn):
+        self.raw = conn
+        self._cursor = None
+
+    def cursor(self):
+        if self._cursor is None:
+            self._cursor = _SharedCursor(self.raw.cursor())
+        return self._cursor
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+class _SharedCursor:
+    def __init__(self, cursor):
+        self._cur = cursor
+
+    def close(self):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+
+class SnowflakePool:
+    """ Thread-safe pool of at most `size` Snowflake connections, opened on demand and reused.
+    The environment (warehouse, database) is set up once by the first connection; the
+    later ones get warehouse and database as connect() parameters instead.
+    """
+    def __init__(self, size=POOL_SIZE, connect=None, **params):
+        self.size = size
+        self.params = params or _connect_params()
+        self.warehouse = os.getenv("SNOWFLAKE_WAREHOUSE")
+        self.database = os.getenv("SNOWFLAKE_DATABASE")
+        self._connect = connect or snowflake.connector.connect
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._setup_lock = threading.Lock()
+        self._ready = False
+
+    def _open(self):
+        with self._setup_lock:
+            if not self._ready:
+                conn = self._connect(**self.params)
+                setup_environment(conn, self.warehouse, self.database)
+                self._ready = True
+                return PooledConnection(conn)
+        return PooledConnection(self._connect(**self.params, warehouse=self.warehouse, database=self.database))
+
+    @contextmanager
+    def connection(self):
+        """Borrows a connection, blocks while all `size` connections are in use."""
+        with self._slots:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._open()
+            try:
+                yield conn
+            finally:
+                if conn.is_closed():
+                    logger.warning("Dropping closed Snowflake connection from the pool")
+                else:
+                    self._idle.put(conn)
+
+    def close(self):
+        while not self._idle.empty():
+            self._idle.get_nowait().close()
+
+
+def get_pool(size=POOL_SIZE) -> Optional[SnowflakePool]:
+    """Connection pool shared by the whole process. None if Snowflake is not reachable -
+    this is only tried once, later calls return None right away (local mode).
+    A pool inherited through fork is dropped (not closed, its sockets are the parent's)
+    and a new one is opened."""
+    global _pool, _pool_pid, _pool_failed
+    with _pool_lock:
+        if _pool is not None and _pool_pid != os.getpid():
+            _pool = None
+        if _pool is None and not _pool_failed:
+            pool = SnowflakePool(size)
+            try:
+                with pool.connection():
+                    pass
+                logger.info(f"Sucessfully connected to Snowflake as user {os.getenv('SNOWFLAKE_USER')}")
+                _pool, _pool_pid = pool, os.getpid()
+            except Exception as e:
+                logger.warning(f"Could not connect to Snowflake: {e}. Will proceed in local mode.")
+                _pool_failed = True
+    return _pool
+
+
+def close_pool():
+    """Closes the idle connections of the process pool and forgets it, e.g. before forking workers."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.close()
+        _pool = None
+
+
+def run_etl_snowflake_cities(pool: SnowflakePool, jobs: list, max_workers: int = POOL_SIZE) -> dict:
+    """Nightly batch for many cities: Overpass data of all cities is fetched concurrently, then
+    stores and housing (in parallel, each on a pooled connection) get one upload and one
+    silver / golden transform for all cities together. jobs are dicts with city, country and
+    store. Returns {(city, kind): error or None}; cities whose fetch failed are left out."""
+    fetchers = {
+        "stores": lambda job: fetch_stores_data(job["city"], job["country"], job["store"]),
+        "housing": lambda job: fetch_housing_data(job["city"], job["country"]),
+    }
+    pipelines = {
+        "stores": ("STORE_LOC", transform_stores_silver, transform_stores_golden),
+        "housing": ("HOUSE_LOC", transform_housing_silver, transform_housing_golden),
+    }
+
+    def load(kind, frames):
+        schema, to_silver, to_golden = pipelines[kind]
+        with pool.connection() as conn:
+            run_etl_snowflake_batch(conn, schema, frames, to_silver, to_golden)
+
+    errors, frames = {}, {kind: {} for kind in fetchers}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {(job["city"], kind): executor.submit(fetch, job)
+                   for job in jobs for kind, fetch in fetchers.items()}
+        for (city, kind), future in futures.items():
+            errors[city, kind] = future.exception()
+            if errors[city, kind] is None:
+                frames[kind][city] = future.result()
+
+        loads = {kind: executor.submit(load, kind, kind_frames) for kind, kind_frames in frames.items() if kind_frames}
+        for kind, future in loads.items():
+            for city in frames[kind]:
+                errors[city, kind] = future.exception()
+    for (city, kind), error in errors.items():
+        if error is not None:
+            logger.error(f"Snowflake {kind} pipeline for {city} failed: {error}")
+    return errors
+
+
+def select_query(schema: str, table: str, columns=None, city: str = None, bbox=None, select=None):
+    """SELECT with the column projection and the city / (south, west, north, east) bbox filters
+    in SQL. Returns the query and its parameters (pyformat, bound by the connector)."""
+    select = select or (", ".join(f'"{col}"' for col in columns) if columns else "*")
+    where, params = [], {}
+    if city is not None:
+        where.append('"city" = %(city)s')
+        params["city"] = city
+    if bbox is not None:
+        where.append('"lat" BETWEEN %(south)s AND %(north)s AND "lon" BETWEEN %(west)s AND %(east)s')
+        params.update(zip(["south", "west", "north", "east"], map(float, bbox)))
+    query = f"SELECT {select} FROM {schema}.{table}"
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    return query, params
+
+
+def read_table(conn, schema: str, table: str, columns=None, city: str = None, bbox=None) -> Optional[pd.DataFrame]:
+    """Table (only `columns`, rows of `city` inside `bbox` if given) fetched as Arrow,
+    None if it does not exist or cannot be read."""
     try:
-        conn = snowflake.connector.connect(
-            user=os.getenv("SNOWFLAKE_USER"),
-            password=os.getenv("SNOWFLAKE_PASSWORD"),
-            account=os.getenv("SNOWFLAKE_ACCOUNT")
-        )
-        logger.info(f"Sucessfully connected to Snowflake as user {os.getenv('SNOWFLAKE_USER')}")
-
-        warehouse = os.getenv("SNOWFLAKE_WAREHOUSE")
-        database = os.getenv("SNOWFLAKE_DATABASE")
         cur = conn.cursor()
-        cur.execute(f"""
-            CREATE WAREHOUSE IF NOT EXISTS {warehouse} WITH WAREHOUSE_SIZE = 'XSMALL'
-            AUTO_SUSPEND = 300 AUTO_RESUME = TRUE;
-            """
-        )
-        cur.execute(f"CREATE DATABASE IF NOT EXISTS {database}")
-        cur.execute(f"USE WAREHOUSE {warehouse}")
-        cur.execute(f"USE DATABASE {database}")
-        logger.info(
-            f"Connected to Snowflake. Environment ready: {warehouse} / {database}"
-        )
+        cur.execute(*select_query(schema, table, columns, city, bbox))
+        df = cur.fetch_pandas_all()
         cur.close()
-        return conn
+        logger.info(f"Retrieved {len(df)} rows from {schema}.{table}")
+        return df
     except Exception as e:
-        logger.warning(f"Could not connect to Snowflake: {e}. Will proceed in local mode.")
+        logger.warning(e)
         return None
 
 
-def read_table(conn, schema: str, table: str) -> Optional[pd.DataFrame]:
-    """Return True if table exists and can be read, False otherwise."""
+def iter_table_batches(conn, schema: str, table: str, columns=None, city: str = None, bbox=None):
+    """Like read_table, but yields the result in the DataFrame batches the connector
+    downloads (Arrow result chunks), so the whole table is never held at once."""
+    cur = conn.cursor()
+    try:
+        cur.execute(*select_query(schema, table, columns, city, bbox))
+        yield from cur.fetch_pandas_batches()
+    finally:
+        cur.close()
+
+
+def read_housing_arrays(conn, schema: str, table: str, city: str = None, bbox=None) -> Optional[GoldenHousing]:
+    """Golden housing streamed straight into the optimizer's arrays (see find_best_location).
+    Row count and reference latitude are computed in SQL first, then every batch is
+    projected into preallocated arrays. None if there are no rows or the table cannot be read."""
     try:
         cur = conn.cursor()
-        query = f"SELECT * FROM {schema}.{table}"
-        cur.execute(query)
-        rows = cur.fetchall()
-        columns = [desc[0] for desc in cur.description]
-        df = pd.DataFrame(rows, columns=columns)
+        cur.execute(*select_query(schema, table, city=city, bbox=bbox, select='COUNT(*), AVG("lat")'))
+        n_rows, ref_lat = cur.fetchone()
         cur.close()
-        logger.info(f"Retrieved {len(df)} rows from {schema}.{table}")
-        return df
     except Exception as e:
         logger.warning(e)
         return None
+    if not n_rows:
+        return None
+    ref_lat = float(ref_lat)
+    residents_xy = np.empty((n_rows, 2))
+    residents_n = np.empty((n_rows, 1))
+    pos = 0
+    for batch in iter_table_batches(conn, schema, table, OPTIMIZER_COLUMNS, city, bbox):
+        end = pos + len(batch)
+        residents_xy[pos:end] = _latlon_to_xy(batch[["lat", "lon"]].to_numpy(dtype=float), ref_lat)
+        residents_n[pos:end, 0] = batch["residents"].to_numpy(dtype=float)
+        pos = end
+    residents_xy, residents_n = residents_xy[:pos], residents_n[:pos]
+    logger.info(f"Streamed {pos} residents from {schema}.{table}")
+    return GoldenHousing(ref_lat, residents_xy, residents_n, KDTree(residents_xy))
 
 
 def ensure_schema_exists(conn, schema: str):
@@ -70,64 +273,124 @@ def ensure_schema_exists(conn, schema: str):
 
 def run_etl_snowflake_stores(conn, city: str, country: str, store: str, schema: str):
     stores = fetch_stores_data(city, country, store)
-    upload_to_snowflake(conn, stores, schema, "L1_RAW")
-    transform_stores_silver(conn, schema, "L1_RAW", "L2_CLEANED")
-    transform_stores_golden(conn, schema, "L2_CLEANED", "L3_GOLDEN")
-    return read_table(conn, schema, "L3_GOLDEN")
+    run_etl_snowflake_batch(conn, schema, {city: stores}, transform_stores_silver, transform_stores_golden)
+    return read_table(conn, schema, "L3_GOLDEN", city=city)
 
 
 def run_etl_snowflake_housing(conn, city: str, country: str, schema: str):
     housing = fetch_housing_data(city, country)
-    upload_to_snowflake(conn, housing, schema, "L1_RAW")
-    transform_housing_silver(conn, schema, "L1_RAW", "L2_CLEANED")
-    transform_housing_golden(conn, schema, "L2_CLEANED", "L3_GOLDEN")
-    return read_table(conn, schema, "L3_GOLDEN")
+    run_etl_snowflake_batch(conn, schema, {city: housing}, transform_housing_silver, transform_housing_golden)
+    return read_table(conn, schema, "L3_GOLDEN", columns=HOUSING_READ_COLUMNS, city=city)
+
+
+def run_etl_snowflake_batch(conn, schema: str, frames: dict, to_silver, to_golden):
+    """Replaces the rows of the cities in `frames` ({city: raw DataFrame}) in all three layers:
+    one upload and one silver / golden statement for all of them, other cities are untouched."""
+    cities = list(frames)
+    raw = pd.concat([df.assign(city=city) for city, df in frames.items()], ignore_index=True)
+    upload_to_snowflake(conn, raw, schema, "L1_RAW", cities=cities)
+    to_silver(conn, schema, "L1_RAW", "L2_CLEANED", cities)
+    to_golden(conn, schema, "L2_CLEANED", "L3_GOLDEN", cities)
+
+
+def city_filter(cities) -> tuple:
+    """'"city" IN (...)' with one bound parameter per city."""
+    params = {f"city{i}": city for i, city in enumerate(cities)}
+    return '"city" IN (' + ", ".join(f"%({name})s" for name in params) + ")", params
 
 
-def upload_to_snowflake(conn, df: pd.DataFrame, schema: str, table: str):
+def table_exists(conn, schema: str, table: str) -> bool:
+    cur = conn.cursor()
+    cur.execute(f"SHOW TABLES LIKE '{table}' IN SCHEMA {schema}")
+    exists = bool(cur.fetchall())
+    cur.close()
+    return exists
+
+
+def drop_single_city_table(conn, schema: str, table: str):
+    """Drops schema.table if it has no "city" column, i.e. was written by the single-city ETL
+    (which replaced the whole table on every run); the caller recreates it keyed by city."""
+    if not table_exists(conn, schema, table):
+        return
+    cur = conn.cursor()
+    cur.execute(f"DESCRIBE TABLE {schema}.{table}")
+    if "city" not in [row[0] for row in cur.fetchall()]:
+        logger.warning(f"{schema}.{table} has no city column (single-city ETL), recreating it")
+        cur.execute(f"DROP TABLE {schema}.{table}")
+    cur.close()
+
+
+def replace_city_rows(conn, schema: str, table: str, select: str, cities, columns=None):
+    """Replaces the rows of `cities` in schema.table by the result of `select` (a query that
+    filters by city_filter(cities)) in one transaction. columns - the column list of the
+    INSERT, None inserts by position. The table is created clustered by city on first use."""
+    where, params = city_filter(cities)
+    select = select.format(city_filter=where)
+    drop_single_city_table(conn, schema, table)
+    cur = conn.cursor()
+    cur.execute(f'CREATE TABLE IF NOT EXISTS {schema}.{table} CLUSTER BY ("city") AS {select} LIMIT 0', params)
+    cur.execute("BEGIN")
+    try:
+        cur.execute(f"DELETE FROM {schema}.{table} WHERE {where}", params)
+        cur.execute(f"INSERT INTO {schema}.{table} {f'({columns}) ' if columns else ''}{select}", params)
+        cur.execute("COMMIT")
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+    finally:
+        cur.close()
+    logger.info(f"Replaced {len(cities)} cities in {schema}.{table}")
+
+
+def upload_to_snowflake(conn, df: pd.DataFrame, schema: str, table: str, cities=None, chunk_size=UPLOAD_CHUNK):
+    """Writes df in chunks of chunk_size rows. With `cities` only their rows are replaced
+    (i.e. merges by city): df goes to a temporary table first and replace_city_rows swaps
+    it in, so a failed upload keeps the old rows. Without cities the table is overwritten."""
     ensure_schema_exists(conn, schema)
+    target = table if cities is None else f"{table}_UPLOAD"
     success, _, nrows, _ = write_pandas(
-        conn=conn,
+        conn=getattr(conn, "raw", conn),
         df=df,
-        table_name=table,
+        table_name=target,
         schema=schema,
-        overwrite=True
+        chunk_size=chunk_size,
+        auto_create_table=True,
+        overwrite=True,
+        table_type="" if cities is None else "temporary"
     )
+    if cities is not None:
+        columns = ", ".join(f'"{col}"' for col in df.columns)
+        try:
+            replace_city_rows(conn, schema, table, f"SELECT {columns} FROM {schema}.{target} WHERE {{city_filter}}",
+                              cities, columns=columns)
+        finally:
+            cur = conn.cursor()
+            cur.execute(f"DROP TABLE IF EXISTS {schema}.{target}")
+            cur.close()
     logger.info(f"Uploaded {nrows} rows to {schema}.{table} (success={success})")
     return success
 
 
-def transform_stores_silver(conn, schema: str, table_old: str, table_new: str):
-    cur = conn.cursor()
+def transform_stores_silver(conn, schema: str, table_old: str, table_new: str, cities):
     logger.info("Transforming L1_RAW → L2_CLEANED")
-    cur.execute(f"""
-        CREATE OR REPLACE TABLE {schema}.{table_new} AS
+    replace_city_rows(conn, schema, table_new, f"""
         SELECT *
         FROM {schema}.{table_old}
-        WHERE 'lat' IS NOT NULL AND 'lon' IS NOT NULL
-    """)
-    cur.close()
+        WHERE "lat" IS NOT NULL AND "lon" IS NOT NULL AND {{city_filter}}
+    """, cities)
 
 
-def transform_stores_golden(conn, schema: str, table_old: str, table_new: str):
-    cur = conn.cursor()
+def transform_stores_golden(conn, schema: str, table_old: str, table_new: str, cities):
     logger.info("Transforming L2_CLEANED → L3_GOLDEN")
-
-    cur.execute(f"""
-        CREATE OR REPLACE TABLE {schema}.{table_new} CLONE {schema}.{table_old};
-    """)
-    cur.close()
-
-
-def transform_housing_silver(conn, schema: str, table_old: str, table_new: str):
-    cur = conn.cursor()
+    replace_city_rows(conn, schema, table_new, f"SELECT * FROM {schema}.{table_old} WHERE {{city_filter}}", cities)
 
 
+def transform_housing_silver(conn, schema: str, table_old: str, table_new: str, cities):
     logger.info("Transforming HOUSING L1_RAW → L2_CLEANED")
 
     query = f"""
-    CREATE OR REPLACE TABLE {schema}.{table_new} AS
     SELECT
+        "city",
         "housenumber",
         "street",
         "building_type",
@@ -144,26 +407,20 @@ def transform_housing_silver(conn, schema: str, table_old: str, table_new: str):
             ELSE TRY_TO_NUMBER("levels")
         END AS "levels"
     FROM {schema}.{table_old}
-    WHERE "lat" IS NOT NULL AND "lon" IS NOT NULL;
+    WHERE "lat" IS NOT NULL AND "lon" IS NOT NULL AND {{city_filter}}
     """
-    cur.execute(query)
-    cur.close()
-    logger.info(f"Created {schema}.{table_new}")
+    replace_city_rows(conn, schema, table_new, query, cities)
 
 
-def transform_housing_golden(conn, schema: str, table_old: str, table_new: str):
-    cur = conn.cursor()
+def transform_housing_golden(conn, schema: str, table_old: str, table_new: str, cities):
     logger.info("Transforming HOUSING L2_CLEANED → L3_GOLDEN")
 
     query = f"""
-    CREATE OR REPLACE TABLE {schema}.{table_new} AS
     SELECT
         *,
         /* Example heuristic: residents = area_m2 * levels / 30 */
         ("area_m2" * "levels") / 30 AS "residents"
-    FROM {schema}.{table_old};
-    """.strip()
-
-    cur.execute(query)
-    cur.close()
-    logger.info(f"Created {schema}.{table_new}")
+    FROM {schema}.{table_old}
+    WHERE {{city_filter}}
+    """
+    replace_city_rows(conn, schema, table_new, query, cities)
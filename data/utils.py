@@ -1,10 +1,20 @@
+import os
+import re
+import tempfile
+from array import array
+import ijson
 import numpy as np
 import pandas as pd
 import time
 import logging
 import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from pathlib import Path
 from shapely.geometry import Polygon
 from requests.exceptions import RequestException
+from src.profiling import timed
 
 logger = logging.getLogger(__name__)
 EARTH_RADIUS = 6371000 #in (m)
@@ -12,11 +22,24 @@ EARTH_RADIUS = 6371000 #in (m)
 RESIDENTIAL_TYPES = ["house","detached", "semidetached_house",
                     "terrace", "bungalow", "apartments", "residential"]
 
+HOUSING_COLUMNS = ["osm_id", "housenumber", "street", "levels", "area_m2", "lon", "lat", "building_type"]
+
 DEFAULT_AREA = 25
 DEFAULT_LEVELS = 2
 
 MAX_RETRIES = 3
 RETRY_DELAY = 5
+MAX_CONCURRENCY = 2  # parallel Overpass queries - the public instance allows a couple of slots per IP
+OVERPASS_URL = os.getenv("OVERPASS_URL", "https://overpass-api.de/api/interpreter")
+# held during every Overpass request, so all fetches of the process together stay within MAX_CONCURRENCY
+_overpass_slots = threading.BoundedSemaphore(MAX_CONCURRENCY)
+CHECKPOINT_DIR = Path("data/bronze/parts")
+CHECKPOINT_MAX_AGE = 24 * 3600  # seconds; older checkpoints are refetched instead of resumed
+TILE_DEG = 0.25               # areas larger than this (degrees) are split into tiles up front
+MAX_TILE_DEPTH = 4            # a tile that times out or is too large is split in 4, at most this deep
+TILE_TIMEOUT = 300            # Overpass [timeout] per tile query (s)
+TILE_MAXSIZE = 512 * 2**20    # Overpass [maxsize] per tile query (bytes)
+DOWNLOAD_CHUNK = 2**20
 
 def _latlon_to_xy(coords, ref_lat=None):
     """coords: list[(lon, lat)]
@@ -69,124 +92,368 @@ def calculate_area(coords: list):
     return area_m2, centroid
 
 
-def fetch_stores_data(city:str, country: str, store: str):
+class OverpassTooLarge(Exception):
+    """The query for a tile ran out of time or memory on the Overpass side."""
+
+
+class OverpassError(RuntimeError):
+    """Overpass data could not be fetched (after retries)."""
+
+
+def _overpass_json(resp) -> dict:
+    resp.raise_for_status()
+    data = resp.json()
+    # Overpass reports timeouts / [maxsize] overruns as a remark with status 200
+    remark = data.get("remark") or ""
+    if "runtime error" in remark:
+        raise OverpassTooLarge(remark)
+    return data
+
+
+def _bbox_filter(bbox) -> str:
+    return "" if bbox is None else "({:.7f},{:.7f},{:.7f},{:.7f})".format(*bbox)
+
+
+def _newer_filter(newer) -> str:
+    """Overpass filter for elements changed after `newer` (ISO 8601 UTC timestamp)."""
+    return "" if newer is None else f'(newer:"{newer}")'
+
+
+def fetch_city_bboxes(city: str, country: str, session=None):
+    """(south, west, north, east) of each administrative boundary named `city` in `country`
+    (boxes inside another one are dropped). None if none can be found - the area is then
+    queried as a whole."""
     query = f"""
     [out:json][timeout:60];
     area["name"="{country}"]["boundary"="administrative"]->.country;
+    rel["name"="{city}"]["boundary"="administrative"](area.country);
+    out bb;
+    """
+    try:
+        with _overpass_slots:
+            resp = (session or requests).get(OVERPASS_URL, params={'data': query}, timeout=120)
+        bounds = [el["bounds"] for el in _overpass_json(resp).get("elements", []) if "bounds" in el]
+    except (RequestException, OverpassTooLarge) as e:
+        logger.warning(f"Could not fetch the bounding box of {city}: {e}")
+        return None
+    boxes = {(b["minlat"], b["minlon"], b["maxlat"], b["maxlon"]) for b in bounds}
+    boxes = [box for box in boxes if not any(other != box and _contains(other, box) for other in boxes)]
+    return sorted(boxes) or None
+
+
+def _contains(outer, inner) -> bool:
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and outer[2] >= inner[2] and outer[3] >= inner[3]
+
+
+def split_bbox(bbox, tile_deg=TILE_DEG):
+    """Splits (south, west, north, east) into a regular grid of tiles at most tile_deg wide."""
+    south, west, north, east = bbox
+    lats = np.linspace(south, north, max(1, int(np.ceil((north - south) / tile_deg))) + 1)
+    lons = np.linspace(west, east, max(1, int(np.ceil((east - west) / tile_deg))) + 1)
+    return [(lats[i], lons[j], lats[i + 1], lons[j + 1])
+            for i in range(len(lats) - 1) for j in range(len(lons) - 1)]
+
+
+def _is_too_large(e: Exception) -> bool:
+    if isinstance(e, (OverpassTooLarge, requests.exceptions.Timeout)):
+        return True
+    response = getattr(e, "response", None)
+    return response is not None and response.status_code == 504
+
+
+def fetch_tiled(fetch_tile, bbox, depth=0) -> pd.DataFrame:
+    """Runs fetch_tile(bbox) with retries on network errors. A tile that times out or is
+    too large is split into 4 quadrants, up to MAX_TILE_DEPTH times.
+    Rows are deduplicated by osm_id (ways straddling tile borders are returned twice).
+    """
+    for attempt in range(1, MAX_RETRIES + 1):
+        try:
+            return fetch_tile(bbox)
+        except RequestException as e:
+            if _is_too_large(e) and bbox is not None and depth < MAX_TILE_DEPTH:
+                break
+            logger.warning(f"Overpass tile {_bbox_filter(bbox)} attempt {attempt}/{MAX_RETRIES} failed: {e}")
+            if attempt == MAX_RETRIES:
+                raise
+            time.sleep(RETRY_DELAY)
+        except OverpassTooLarge:
+            if bbox is None or depth >= MAX_TILE_DEPTH:
+                raise
+            break
+
+    logger.info(f"Overpass tile {_bbox_filter(bbox)} too large, splitting into 4")
+    south, west, north, east = bbox
+    mid_lat, mid_lon = (south + north) / 2, (west + east) / 2
+    quadrants = [(south, west, mid_lat, mid_lon), (south, mid_lon, mid_lat, east),
+                 (mid_lat, west, north, mid_lon), (mid_lat, mid_lon, north, east)]
+    parts = [fetch_tiled(fetch_tile, quadrant, depth + 1) for quadrant in quadrants]
+    return _concat_unique(parts)
+
+
+def fetch_region(fetch_tile, bboxes) -> pd.DataFrame:
+    """fetch_tiled over each of the bboxes pre-split into TILE_DEG tiles (one query for the
+    whole area if bboxes is None)."""
+    tiles = [tile for bbox in bboxes for tile in split_bbox(bbox)] if bboxes else [None]
+    return _concat_unique([fetch_tiled(fetch_tile, tile) for tile in tiles])
+
+
+def _concat_unique(parts) -> pd.DataFrame:
+    parts = [part for part in parts if not part.empty]
+    if not parts:
+        return pd.DataFrame()
+    return pd.concat(parts, ignore_index=True).drop_duplicates(subset=["osm_id"]).reset_index(drop=True)
+
+
+def load_stores_tile(city: str, country: str, store: str, bbox=None, session=None, newer=None) -> pd.DataFrame:
+    query = f"""
+    [out:json][timeout:{TILE_TIMEOUT}][maxsize:{TILE_MAXSIZE}];
+    area["name"="{country}"]["boundary"="administrative"]->.country;
     area["name"="{city}"]["boundary"="administrative"]->.searchArea;
-    nwr["shop"="convenience"]["brand"~"{store}",i](area.searchArea);
+    nwr["shop"="convenience"]["brand"~"{store}",i](area.searchArea){_bbox_filter(bbox)}{_newer_filter(newer)};
     out center;
     """
-    for attempt in range(1, 3):
-        try:
-            resp = requests.get("https://overpass-api.de/api/interpreter", params={'data': query}, timeout=120)
-            resp.raise_for_status()
-            logger.info("Connection to overpass-api - response status code: %d", resp.status_code)
-
-
-            data = resp.json()
-            rows = []
-            for el in data.get("elements", []):
-                tags = el.get("tags", {})
-                # some 'way/rel' dont have lat/lon, byt has center.{lat,lon}
-                lat = el.get("lat") or (el.get("center") or {}).get("lat")
-                lon = el.get("lon") or (el.get("center") or {}).get("lon")
-                rows.append({
-                    "name": tags.get("name"),
-                    "lat": lat,
-                    "lon": lon,
-                    "housenumber": tags.get("addr:housenumber"),
-                    "street": tags.get("addr:street"),
-                })
-            return pd.DataFrame(rows)
-        except requests.exceptions.RequestException as e:
-                logger.warning(f"Overpass attempt {attempt} failed: {e}")
-                if attempt < 3:
-                    time.sleep(10)
-                else:
-                    logger.error("Overpass API failed after 3 attempts.")
-                    raise SystemExit
-
-
-def load_housing_type(city: str, btype: str, country: str) -> pd.DataFrame:
-    """Fetches buildings of type `btype` (e.g., "house" or "apartments") for a given city.
+    with _overpass_slots:
+        resp = (session or requests).get(OVERPASS_URL, params={'data': query}, timeout=TILE_TIMEOUT + 60)
+    data = _overpass_json(resp)
+    logger.info("Connection to overpass-api - response status code: %d", resp.status_code)
+
+    rows = []
+    for el in data.get("elements", []):
+        tags = el.get("tags", {})
+        # some 'way/rel' dont have lat/lon, byt has center.{lat,lon}
+        lat = el.get("lat") or (el.get("center") or {}).get("lat")
+        lon = el.get("lon") or (el.get("center") or {}).get("lon")
+        rows.append({
+            "osm_id": f"{el.get('type')}/{el.get('id')}",
+            "name": tags.get("name"),
+            "lat": lat,
+            "lon": lon,
+            "housenumber": tags.get("addr:housenumber"),
+            "street": tags.get("addr:street"),
+        })
+    return pd.DataFrame(rows)
+
+
+@timed("fetch_stores")
+def fetch_stores_data(city:str, country: str, store: str, newer=None):
+    """All stores of the city, or only those changed after `newer` (ISO timestamp)."""
+    try:
+        with requests.Session() as session:
+            bboxes = fetch_city_bboxes(city, country, session)
+            return fetch_region(lambda tile: load_stores_tile(city, country, store, tile, session, newer), bboxes)
+    except (RequestException, OverpassTooLarge) as e:
+        logger.error(f"Overpass API failed: {e}")
+        raise OverpassError(f"Could not fetch {store} stores in {city}, {country}: {e}") from e
+
+
+def load_housing_type(city: str, btype: str, country: str, session=None, bbox=None,
+                      newer=None) -> pd.DataFrame:
+    """Fetches buildings of type `btype` (e.g., "house" or "apartments") for a given city,
+    optionally only within bbox = (south, west, north, east) and changed after `newer`.
     Returns the centroid, approximate area in square meters, and related attributes.
     """
     query = f"""
-    [out:json][timeout:300];
+    [out:json][timeout:{TILE_TIMEOUT}][maxsize:{TILE_MAXSIZE}];
     area["name"="{country}"]["boundary"="administrative"]->.country;
     area["name"="{city}"]["boundary"="administrative"]->.searchArea;
     (
-      way["building"="{btype}"](area.searchArea);
+      way["building"="{btype}"](area.searchArea){_bbox_filter(bbox)}{_newer_filter(newer)};
     );
     out body;
     >;
     out skel qt;
     """
-    resp = requests.get("https://overpass-api.de/api/interpreter", params={'data': query})
+    with tempfile.TemporaryFile() as f:
+        with _overpass_slots, (session or requests).get(OVERPASS_URL, params={'data': query},
+                                                        timeout=TILE_TIMEOUT + 60, stream=True) as resp:
+            _overpass_download(resp, f)
+        ways = read_ways(ijson.items(f, "elements.item", use_float=True))
+
+    area_m2, centroid_lon, centroid_lat = polygon_area_centroid(ways.lon, ways.lat, ways.offsets)
+    return pd.DataFrame({
+        "osm_id": [f"way/{way_id}" for way_id in ways.ids],
+        "housenumber": ways.housenumber,
+        "street": ways.street,
+        "levels": ways.levels,
+        "area_m2": area_m2,
+        "lon": centroid_lon,
+        "lat": centroid_lat,
+        "building_type": btype,
+    }, columns=HOUSING_COLUMNS)
+
+
+def _overpass_download(resp, f):
+    """Streams the response body to the file f, then checks it like _overpass_json."""
     resp.raise_for_status()
-    data = resp.json()
+    for chunk in resp.iter_content(chunk_size=DOWNLOAD_CHUNK):
+        f.write(chunk)
+    # Overpass puts the "remark" key after the elements, so the end of the file is enough
+    f.seek(max(0, f.tell() - 4096))
+    remark = re.search(rb'"remark"\s*:\s*"([^"]*)"', f.read())
+    if remark and b"runtime error" in remark.group(1):
+        raise OverpassTooLarge(remark.group(1).decode(errors="replace"))
+    f.seek(0)
 
-    rows = []
-    nodes = {}
-    for element in data.get("elements", []):
-        if element.get("type") == "node":
-            nodes[element["id"]] = (element["lon"], element["lat"])
 
-    for element in data.get("elements", []):
-        if element.get("type") == "way":
-            tags = element.get("tags", {})
-            try:
-                coords = [nodes[node_id] for node_id in element.get("nodes", [])]
-            except KeyError:
-                continue
-            if len(coords) < 2:
+class Ways:
+    """Ways of an Overpass response with their node coordinates in ragged arrays:
+    the vertices of way i are lon/lat[offsets[i]:offsets[i + 1]]."""
+    def __init__(self, ids, housenumber, street, levels, lon, lat, offsets):
+        self.ids = ids
+        self.housenumber = housenumber
+        self.street = street
+        self.levels = levels
+        self.lon = lon
+        self.lat = lat
+        self.offsets = offsets
+
+
+def read_ways(elements) -> Ways:
+    """Reads (streamed) Overpass elements into compact arrays. Nodes are kept as sorted
+    id / lon / lat arrays instead of a dict; ways referring to a missing node are skipped."""
+    node_ids, node_lon, node_lat = array("q"), array("d"), array("d")
+    way_ids, refs, counts = array("q"), array("q"), array("q")
+    housenumber, street, levels = [], [], []
+    for element in elements:
+        kind = element.get("type")
+        if kind == "node":
+            node_ids.append(element["id"])
+            node_lon.append(element["lon"])
+            node_lat.append(element["lat"])
+        elif kind == "way":
+            nodes = element.get("nodes", [])
+            if len(nodes) < 2:
                 continue
+            tags = element.get("tags", {})
+            way_ids.append(element["id"])
+            refs.extend(nodes)
+            counts.append(len(nodes))
+            housenumber.append(tags.get("addr:housenumber"))
+            street.append(tags.get("addr:street"))
+            levels.append(tags.get("building:levels"))
 
-            area_m2, centroid = calculate_area(coords)
-            if centroid is not None:
-                centroid_lon, centroid_lat = centroid.x, centroid.y
-            else:
-                centroid_lon, centroid_lat = None, None
-
-            rows.append({
-                "housenumber": tags.get("addr:housenumber"),
-                "street": tags.get("addr:street"),
-                "levels": tags.get("building:levels"),
-                "area_m2": area_m2,
-                "lon": centroid_lon,
-                "lat": centroid_lat,
-                "building_type": btype,
-            })
-    return pd.DataFrame(rows)
+    node_ids = np.frombuffer(node_ids, dtype=np.int64) if node_ids else np.empty(0, dtype=np.int64)
+    order = np.argsort(node_ids, kind="stable")
+    sorted_ids = node_ids[order]
+    refs = np.frombuffer(refs, dtype=np.int64) if refs else np.empty(0, dtype=np.int64)
+    pos = np.minimum(np.searchsorted(sorted_ids, refs), max(len(sorted_ids) - 1, 0))
+    found = sorted_ids[pos] == refs if len(sorted_ids) else np.zeros(len(refs), dtype=bool)
+
+    counts = np.frombuffer(counts, dtype=np.int64) if counts else np.empty(0, dtype=np.int64)
+    way_of_ref = np.repeat(np.arange(len(counts)), counts)
+    complete = np.bincount(way_of_ref, weights=(~found).astype(float), minlength=len(counts)) == 0
+    keep_refs = complete[way_of_ref]
+    node_rows = order[pos[keep_refs]]
+    offsets = np.concatenate([[0], np.cumsum(counts[complete])])
+
+    ways_kept = np.flatnonzero(complete)
+    return Ways(
+        ids=np.frombuffer(way_ids, dtype=np.int64)[complete] if way_ids else np.empty(0, dtype=np.int64),
+        housenumber=[housenumber[i] for i in ways_kept],
+        street=[street[i] for i in ways_kept],
+        levels=[levels[i] for i in ways_kept],
+        lon=np.frombuffer(node_lon, dtype=float)[node_rows] if node_lon else np.empty(0),
+        lat=np.frombuffer(node_lat, dtype=float)[node_rows] if node_lat else np.empty(0),
+        offsets=offsets,
+    )
+
+
+@timed("polygon_geometry", items=lambda lon, lat, offsets: len(offsets) - 1)
+def polygon_area_centroid(lon, lat, offsets):
+    """Vectorized calculate_area for many polygons given as ragged arrays.
+    Area (m2) is the shoelace formula in the equirectangular projection around each
+    polygon's mean latitude, the centroid is taken in lon/lat like the shapely version.
+    Returns (area_m2, centroid_lon, centroid_lat) arrays, one value per polygon.
+    """
+    starts, counts = offsets[:-1], np.diff(offsets)
+    if len(counts) == 0:
+        return np.empty(0), np.empty(0), np.empty(0)
+    polygon = np.repeat(np.arange(len(counts)), counts)
+    # next vertex within the same ring, the last one wraps to the first
+    nxt = np.arange(len(lon)) + 1
+    nxt[offsets[1:] - 1] = starts
+
+    # coordinates relative to the first vertex of each polygon, for precision
+    u = lon - lon[starts][polygon]
+    v = lat - lat[starts][polygon]
+
+    ref_lat = np.add.reduceat(lat, starts) / counts
+    x = EARTH_RADIUS * np.radians(u) * np.cos(np.radians(ref_lat))[polygon]
+    y = EARTH_RADIUS * np.radians(v)
+    area_m2 = np.abs(np.bincount(polygon, weights=x * y[nxt] - x[nxt] * y, minlength=len(counts))) / 2
 
+    cross = u * v[nxt] - u[nxt] * v
+    a6 = 3 * np.bincount(polygon, weights=cross, minlength=len(counts))
+    cu = np.bincount(polygon, weights=(u + u[nxt]) * cross, minlength=len(counts))
+    cv = np.bincount(polygon, weights=(v + v[nxt]) * cross, minlength=len(counts))
+    degenerate = np.abs(a6) < 1e-20
+    with np.errstate(invalid="ignore", divide="ignore"):
+        centroid_u = np.where(degenerate, np.bincount(polygon, weights=u) / counts, cu / a6)
+        centroid_v = np.where(degenerate, np.bincount(polygon, weights=v) / counts, cv / a6)
+    return area_m2, lon[starts] + centroid_u, lat[starts] + centroid_v
 
-def fetch_housing_data(city:str, country: str) -> pd.DataFrame:
-    dfs = []
-    for idx, btype in enumerate(RESIDENTIAL_TYPES, start=1):
-        logger.info(f'Collecting housing type {btype} - {idx}/{len(RESIDENTIAL_TYPES)})')
-        # Retry logic
-        attempt = 1
-        success = False
-        while attempt <= MAX_RETRIES and not success:
+
+def _load_housing_tile(city, btype, country, session, newer, bbox):
+    return load_housing_type(city, btype, country, session=session, bbox=bbox, newer=newer)
+
+
+@timed("fetch_housing")
+def fetch_housing_data(city:str, country: str, max_workers: int = MAX_CONCURRENCY,
+                       checkpoint_dir: Path = CHECKPOINT_DIR, newer=None) -> pd.DataFrame:
+    """Fetches all RESIDENTIAL_TYPES, at most max_workers queries at a time over one HTTP session.
+    Each type is fetched tile by tile over the city bounding boxes (see fetch_region).
+    Every finished type is saved to checkpoint_dir, so a rerun after a failure only fetches
+    the missing ones; if any type failed, OverpassError is raised once the others are saved.
+    The checkpoints are removed once all types are collected, checkpoints older than
+    CHECKPOINT_MAX_AGE are not resumed from.
+    newer - only buildings changed after this ISO timestamp (incremental refresh).
+    """
+    checkpoint_dir = Path(checkpoint_dir)
+    checkpoint_dir.mkdir(parents=True, exist_ok=True)
+    slug = city.lower().replace(' ', '_')
+    suffix = "_delta_" + re.sub(r"\W", "", newer) if newer else ""  # parts of one `newer` only
+    parts = {btype: checkpoint_dir / f"{slug}_{btype}{suffix}.parquet" for btype in RESIDENTIAL_TYPES}
+    # delta parts of another `newer` are never resumed: a retry asks for the same one
+    abandoned = {path for btype in RESIDENTIAL_TYPES
+                 for path in checkpoint_dir.glob(f"{slug}_{btype}_delta_*.parquet")} - set(parts.values())
+    for path in abandoned:
+        logger.info(f"Dropping abandoned checkpoint {path}")
+        path.unlink()
+    for path in parts.values():
+        if path.exists() and time.time() - path.stat().st_mtime > CHECKPOINT_MAX_AGE:
+            logger.info(f"Dropping stale checkpoint {path}")
+            path.unlink()
+    todo = [btype for btype, path in parts.items() if not path.exists()]
+    if len(todo) < len(parts):
+        logger.info(f"Resuming: {len(parts) - len(todo)}/{len(parts)} housing types already fetched")
+
+    failed = []
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=max_workers) as pool:
+        bboxes = fetch_city_bboxes(city, country, session) if todo else None
+        futures = {
+            pool.submit(fetch_region, partial(_load_housing_tile, city, btype, country, session, newer), bboxes): btype
+            for btype in todo
+        }
+        for future in as_completed(futures):
+            btype = futures[future]
             try:
-                df_part = load_housing_type(city, btype, country)
-                if df_part is not None and not df_part.empty:
-                    dfs.append(df_part)
-                    logger.info(f"Successfully fetched data for '{btype}' ({len(df_part)} rows)")
-                else:
-                    logger.warning(f"No data returned for '{btype}'")
-                success = True
-
-            except RequestException as e:
-                logger.warning(f"Network error for '{btype}' (attempt {attempt}/{MAX_RETRIES}): {e}")
-                attempt += 1
-                if attempt <= MAX_RETRIES:
-                    time.sleep(RETRY_DELAY)
+                df_part = future.result()
             except Exception as e:
-                logger.error(f"Failed to process '{btype}': {e}", exc_info=True)
-                break  # no retry for logical errors
-        time.sleep(2)
+                logger.error(f"Failed to process '{btype}': {e}")
+                failed.append(btype)
+                continue
+            if df_part is None or df_part.empty:
+                logger.warning(f"No data returned for '{btype}'")
+                df_part = pd.DataFrame(columns=HOUSING_COLUMNS)
+            else:
+                logger.info(f"Successfully fetched data for '{btype}' ({len(df_part)} rows)")
+            df_part.to_parquet(parts[btype], index=False)
+
+    if failed:
+        raise OverpassError(f"Housing types not fetched: {sorted(failed)} - rerun to resume from the checkpoints")
+    dfs = [df for df in (pd.read_parquet(parts[b]) for b in RESIDENTIAL_TYPES) if not df.empty]
+    for path in parts.values():
+        path.unlink()
 
     if dfs:
         housing = pd.concat(dfs, axis=0, ignore_index=True).drop_duplicates(
@@ -195,8 +462,5 @@ def fetch_housing_data(city:str, country: str) -> pd.DataFrame:
         logger.info(f"Collected {len(housing)} total rows across {len(dfs)} building types.")
     else:
         logger.warning("No data collected for any building type.")
-        housing = pd.DataFrame(columns=[
-            "housenumber", "street", "levels", "area_m2",
-            "lon", "lat", "building_type"
-        ])
+        housing = pd.DataFrame(columns=HOUSING_COLUMNS)
     return housing
@@ -1,6 +1,11 @@
 import logging
-from data.data_preprocessing import load_and_filter_data
+import os
+from contextlib import nullcontext
+from pathlib import Path
+from data.data_preprocessing import load_and_filter_data, optimizer_housing, city_slug
+from src.profiling import profile_run
 from src.optimization import find_best_location
+from src.cache import ResultCache
 from src.visualization import generate_map
 
 logging.basicConfig(
@@ -9,24 +14,47 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def main():
-    # how many new locations to create
-    n_locations = 10
-    city = "Warszawa"
-    country = "Poland"
-    store = "Żabka"
+def run_city(city: str, country: str, store: str, n_locations: int, refresh: bool = False,
+             profile: str = None, name: str = None):
+    """Loads the data for one city, finds new locations and saves the map.
+    Results are cached in data/cache, refresh=True recomputes them.
+    profile - "json" writes the stage timings to results/<name>_profile.json, "cprofile"
+    also dumps cProfile stats to results/<name>_profile.prof (see src/profiling.py).
+    name - prefix of the files written to results/ (default: the city)."""
+    base = Path("results") / f"{name or city_slug(city)}_profile"
+    cprofile_path = base.with_suffix(".prof") if profile == "cprofile" else None
+    with profile_run(base.with_suffix(".json"), cprofile_path) if profile else nullcontext():
+        return _run_city(city, country, store, n_locations, refresh, name)
+
+
+def _run_city(city, country, store, n_locations, refresh, name=None):
     logger.info("Searching for %d new %s store locations in %s, %s.", n_locations, store, city, country)
 
     housing, zabka_locations = load_and_filter_data(city, country, store)
     new_locations = find_best_location(
-        housing=housing,
+        housing=optimizer_housing(city, housing),
         store_locations=zabka_locations,
-        n=n_locations, use_grid=True
+        n=n_locations, use_grid=True,
+        cache=ResultCache(refresh=refresh)
     )
 
     for i, (lat, lon, _, _, _, score, _) in enumerate(new_locations, 1):
         logger.info(f"Location {i}: ({lat:.5f}, {lon:.5f}) | Score: {score:.2f})")
-    generate_map(housing, zabka_locations, new_locations)
+    generate_map(housing, zabka_locations, new_locations, city=name or city)
+    return new_locations
+
+
+def main():
+    # how many new locations to create
+    n_locations = 10
+    city = "Warszawa"
+    country = "Poland"
+    store = "Żabka"
+    # CACHE=refresh recomputes the cached results, CACHE=clear deletes the whole cache first
+    if os.getenv("CACHE") == "clear":
+        ResultCache().invalidate()
+    run_city(city, country, store, n_locations, refresh=os.getenv("CACHE") == "refresh",
+             profile=os.getenv("PROFILE"))
 
 
 if __name__ == "__main__":
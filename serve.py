@@ -0,0 +1,194 @@
+"""Local HTTP/JSON API over warm OptimizationSessions, so many users share one process.
+
+Usage:
+    python3 serve.py --port 8000
+
+    POST /place  {"city": ..., "country": ..., "store": ..., "n": 5, "method": "lazy_greedy",
+                  "weights": {"w_store": 2.0}, "exclude": ["node/123"]}
+    POST /score  {"city": ..., "country": ..., "store": ..., "points": [[lat, lon], ...],
+                  "weights": {...}, "exclude": [...]}
+    GET  /health
+
+Requests go through one bounded queue and are answered by a single worker thread in
+arrival order (the scoring weights are process-wide); a full queue answers 503.
+A running query cannot be stopped, so n and the number of points are capped (MAX_N, MAX_POINTS).
+Sessions are loaded on first use and the MAX_SESSIONS most recently used are kept.
+"""
+import argparse
+import json
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src.cache import ResultCache
+from src.session import OptimizationSession
+
+MAX_QUEUE = 64
+MAX_SESSIONS = 4
+REQUEST_TIMEOUT = 600  # seconds a request waits for its answer, queueing included
+PLACE_OPTIONS = ["method", "use_grid", "surface_cell", "surrogate", "q"]  # passed on to find_best_location
+SURFACE_CELLS = [10.0, 20.0, 25.0, 50.0]  # allowed surface_cell values (m), each keeps rasters in memory
+MAX_N = 50            # locations per /place request
+MAX_POINTS = 10_000   # points per /score request
+logger = logging.getLogger(__name__)
+
+
+class QueryQueue:
+    ''' Bounded FIFO of queries answered by one worker thread that owns the sessions.'''
+    def __init__(self, load_session, max_queue=MAX_QUEUE, max_sessions=MAX_SESSIONS):
+        self.load_session = load_session
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+        self._sessions_lock = threading.Lock()  # the worker changes sessions while handlers list them
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def submit(self, fn, city, country, store) -> Future:
+        """Queues fn(session); raises queue.Full when the queue is full."""
+        future = Future()
+        self._queue.put_nowait((future, fn, (city, country, store)))
+        return future
+
+    def session(self, key):
+        with self._sessions_lock:
+            session = self.sessions.get(key)
+            if session is not None:
+                self.sessions.move_to_end(key)
+                return session
+        logger.info("Loading session for %s", key)
+        session = self.load_session(*key)
+        with self._sessions_lock:
+            self.sessions[key] = session
+            if len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        return session
+
+    def loaded(self) -> list:
+        """Keys of the loaded sessions, least recently used first."""
+        with self._sessions_lock:
+            return list(self.sessions)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, fn, key = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(self.session(key)))
+            except BaseException as e:  # e.g. SystemExit from a fetch, the worker must survive it
+                future.set_exception(e)
+
+    def close(self):
+        self._queue.put(None)
+        self._worker.join()
+
+
+def place(body):
+    options = {name: body[name] for name in PLACE_OPTIONS if name in body}
+    if options.get("surface_cell") is not None and options["surface_cell"] not in SURFACE_CELLS:
+        raise ValueError(f"surface_cell must be one of {SURFACE_CELLS}")
+    n = int(body.get("n", 5))
+    if not 1 <= n <= MAX_N:  # a running query cannot be stopped, it would hold the only worker
+        raise ValueError(f"n must be between 1 and {MAX_N}")
+    return lambda session: {"locations": session.place(n=n, weights=body.get("weights"),
+                                                       exclude=body.get("exclude"), **options)
+                            .to_dict(orient="records")}
+
+
+def score(body):
+    points = body["points"]
+    if len(points) > MAX_POINTS:
+        raise ValueError(f"At most {MAX_POINTS} points per request")
+    return lambda session: {"scores": session.score(points, weights=body.get("weights"),
+                                                    exclude=body.get("exclude")).to_dict(orient="records")}
+
+
+ROUTES = {"/place": place, "/score": score}
+
+
+class Handler(BaseHTTPRequestHandler):
+    queries = None  # QueryQueue, set by make_server
+
+    def _send(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self._send(404, {"error": f"Unknown path {self.path}"})
+        self._send(200, {"queued": len(self.queries), "sessions": [list(key) for key in self.queries.loaded()]})
+
+    def do_POST(self):
+        if self.path not in ROUTES:
+            return self._send(404, {"error": f"Unknown path {self.path}"})
+        start = time.perf_counter()
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            future = self.queries.submit(ROUTES[self.path](body), body["city"], body["country"], body["store"])
+        except queue.Full:
+            return self._send(503, {"error": "Too many queued requests, retry later"})
+        except (ValueError, KeyError, TypeError) as e:
+            return self._send(400, {"error": f"Bad request: {e!r}"})
+        try:
+            result = future.result(timeout=REQUEST_TIMEOUT)
+        except TimeoutError:
+            future.cancel()  # no-op if it is already running
+            return self._send(504, {"error": f"No answer within {REQUEST_TIMEOUT} s"})
+        except (ValueError, KeyError, TypeError) as e:
+            return self._send(400, {"error": str(e)})
+        except BaseException as e:
+            logger.exception("Query failed")
+            return self._send(500, {"error": f"{type(e).__name__}: {e}"})
+        self._send(200, dict(result, seconds=time.perf_counter() - start))
+
+    def log_message(self, format, *args):
+        logger.info("%s - " + format, self.address_string(), *args)
+
+
+def make_server(host="127.0.0.1", port=8000, load_session=None) -> ThreadingHTTPServer:
+    """HTTP server with its own QueryQueue (server.queries); load_session(city, country, store)
+    defaults to OptimizationSession.from_city with the on-disk ResultCache."""
+    if load_session is None:
+        load_session = partial(OptimizationSession.from_city, cache=ResultCache())
+    queries = QueryQueue(load_session)
+    server = ThreadingHTTPServer((host, port), type("BoundHandler", (Handler,), {"queries": queries}))
+    server.queries = queries
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    server = make_server(args.host, args.port)
+    logger.info("Serving on http://%s:%d", args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.queries.close()
+
+
+if __name__ == "__main__":
+    main()
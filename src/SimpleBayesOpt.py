@@ -1,52 +1,82 @@
-from sklearn.gaussian_process import GaussianProcessRegressor
-from sklearn.gaussian_process.kernels import Matern, ConstantKernel
 import numpy as np
-from src.utils import Sobol
-from src.score import evaluate_fn
+from src.utils import sobol_chunks
+from src.surrogates import make_surrogate
+from src.score import evaluate_fn_batch
+from src.profiling import timed
+
+MEMORY_BUDGET_MB = 256  # for the surrogate predictions on one chunk of candidates
+
 
 class SimpleBayesOpt:
-    def __init__(self, bounds, tree_res, tree_store, residents_xy, residents_n, stores_xy, k=1):
+    def __init__(self, bounds, tree_res, tree_store, residents_xy, residents_n, k=1,
+                 scorer=None, surrogate="gp", memory_budget_mb=MEMORY_BUDGET_MB):
         self.bounds = np.array(bounds)
         self.residents_xy = residents_xy
         self.residents_n = residents_n
-        self.stores_xy = stores_xy
         self.tree_res=tree_res
         self.tree_store=tree_store
         self.k = k
+        self.scorer = scorer  # optional ScoreSurface / ParallelScorer used instead of the exact serial scoring
         self.X, self.y = [], []
-        kernel = Matern(nu=2.5) * ConstantKernel(1.0, (1e-3, 1e3))
-        self.gp = GaussianProcessRegressor(kernel=kernel, normalize_y=True)
+        # "gp" (exact, warm-started), "rff" (random Fourier features) or a surrogate instance;
+        # passing the same instance to several models carries the hyperparameters over
+        self.surrogate = make_surrogate(surrogate)
+        self.memory_budget_mb = memory_budget_mb
 
-    def add_point(self, x):
-        y = evaluate_fn(x, self.tree_res,
-                        self.tree_store, self.residents_xy,
-                        self.residents_n, self.stores_xy)
-        self.X.append(x)
-        self.y.append(y)
+    def add_points(self, X):
+        if self.scorer is not None:
+            y = self.scorer.evaluate_fn_batch(X, self.tree_store)
+        else:
+            y = evaluate_fn_batch(X, self.tree_res, self.tree_store, self.residents_n)
+        self.X.extend(X)
+        self.y.extend(y.tolist())
 
     def fit(self, X):
-        for x in X:
-            self.add_point(x)
-        self.gp.fit(np.array(self.X), np.array(self.y))
+        self.add_points(X)
+        self.surrogate.fit(np.array(self.X), np.array(self.y))
         #print("GP fitted on", len(self.X), "points")
 
+    def chunk_size(self):
+        """Candidates per prediction chunk - the cross-covariance (or feature) matrix
+        of a chunk, plus temporaries, has to fit in memory_budget_mb."""
+        width = getattr(self.surrogate, "n_features", len(self.X))
+        return max(1024, int(self.memory_budget_mb * 2**20 // (3 * 8 * max(width, 1))))
+
     def suggest_next(self, X_cand, n_best):
         """Predict UCB for candidates and return the best"""
-        mu, sigma = self.gp.predict(X_cand, return_std=True) # type: ignore
-        ucb = mu.ravel() + self.k * sigma
-        top_idx = np.argsort(ucb)[-n_best:][::-1]  # indices of top n UCB values
-        return X_cand[top_idx]
+        chunk = self.chunk_size()
+        return self._top_ucb((X_cand[i:i + chunk] for i in range(0, len(X_cand), chunk)), n_best)
 
     def suggest(self, n_best, n_candidates=65536):
-        # sample Sobol candidates
-        Xcand = Sobol(n_candidates, bound_x=self.bounds[:,0], bound_y=self.bounds[:,1])
-        #print(f"suggested 50 out of {int(2 ** np.ceil(np.log2(n_candidates)))} points")
-        return self.suggest_next(Xcand, n_best)
+        # stream Sobol candidates chunk by chunk, only the running top n_best is kept
+        chunks = sobol_chunks(n_candidates, self.bounds[:,0], self.bounds[:,1], self.chunk_size())
+        return self._top_ucb(chunks, n_best)
+
+    def _top_ucb(self, chunks, n_best):
+        best_x, best_ucb = np.empty((0, 2)), np.empty(0)
+        for X_chunk in chunks:
+            mu, sigma = self.surrogate.predict(X_chunk, return_std=True) # type: ignore
+            ucb = np.concatenate([best_ucb, mu.ravel() + self.k * sigma])
+            X_all = np.vstack([best_x, X_chunk])
+            keep = np.argpartition(ucb, -n_best)[-n_best:] if len(ucb) > n_best else np.arange(len(ucb))
+            best_x, best_ucb = X_all[keep], ucb[keep]
+        order = np.argsort(best_ucb)[::-1]  # top n UCB values, best first
+        return best_x[order]
 
-    def run(self, first_data, n_iter=3):
+    @timed("bayes_opt_run")
+    def run(self, first_data, n_iter=3, known=None):
+        """known - (X, y) pairs already evaluated with the same residents, stores and scoring
+        (e.g. from the cache). They replace first_data as the initial design if there are at
+        least as many, otherwise first_data is evaluated and added to them."""
         for i in range(n_iter):
             if i == 0:
-                self.fit(first_data)
+                if known is not None:
+                    self.X.extend(known[0])
+                    self.y.extend(np.asarray(known[1]).tolist())
+                if known is None or len(known[0]) < len(first_data):
+                    self.fit(first_data)
+                else:
+                    self.surrogate.fit(np.array(self.X), np.array(self.y))
             else:
                 best_loc = self.suggest(n_best = 50)
                 self.fit(best_loc)
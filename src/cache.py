@@ -0,0 +1,96 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+from src import score
+
+CACHE_DIR = Path("data/cache")
+MAX_CACHE_MB = 512
+logger = logging.getLogger(__name__)
+
+
+def score_params() -> dict:
+    """Scoring constants from src/score.py, part of every cache key."""
+    return {name: getattr(score, name) for name in
+            ["W_CUSTOM", "W_STORE", "W_RATIO", "MAX_RADIUS", "EXPECTED_CUST_PER_STORE"]}
+
+
+class ResultCache:
+    ''' Content-addressed on-disk cache of optimizer results (one .npz file per key).
+    Keys are hashes of the input arrays and parameters, so any change of the golden
+    data, the scoring constants or the optimizer settings gives a new key.
+    The least recently used entries are evicted once the cache exceeds max_mb.
+    refresh=True ignores existing entries (they are overwritten by the new run).
+    '''
+    def __init__(self, path=CACHE_DIR, max_mb=MAX_CACHE_MB, refresh=False):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_mb * 2**20
+        self.refresh = refresh
+
+    @staticmethod
+    def key(*parts) -> str:
+        h = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                part = np.ascontiguousarray(part)
+                h.update(f"{part.dtype}{part.shape}".encode())
+                h.update(part.tobytes())
+            elif isinstance(part, dict):
+                h.update(json.dumps(part, sort_keys=True, default=str).encode())
+            else:
+                h.update(str(part).encode())
+            h.update(b"|")
+        return h.hexdigest()
+
+    def _file(self, key):
+        return self.path / f"{key}.npz"
+
+    def load(self, key):
+        """Returns the stored arrays as a dict, or None on a miss."""
+        path = self._file(key)
+        if self.refresh or not path.exists():
+            return None
+        try:
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in data.files}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Dropping unreadable cache entry {path.name}: {e}")
+            path.unlink(missing_ok=True)
+            return None
+        os.utime(path)  # mark as recently used
+        return arrays
+
+    def save(self, key, **arrays):
+        # write to a temporary file first, so parallel runs never see half-written entries
+        tmp = self.path / f"{key}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, self._file(key))
+        self._evict()
+
+    def invalidate(self, key=None):
+        """Removes one entry, or the whole cache when key is None."""
+        paths = [self._file(key)] if key is not None else list(self.path.glob("*.npz"))
+        for path in paths:
+            path.unlink(missing_ok=True)
+        logger.info(f"Invalidated {len(paths)} cache entries in {self.path}")
+
+    def _evict(self):
+        entries = []
+        for path in self.path.glob("*.npz"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # removed by another process meanwhile
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
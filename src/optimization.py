@@ -1,12 +1,28 @@
+import heapq
+import logging
 import pandas as pd
 import numpy as np
 from src.utils import Sobol
 from src.SimpleBayesOpt import SimpleBayesOpt
 from data.utils import _latlon_to_xy, _xy_to_latlon
-from src.score import evaluate_score, evaluate_fn
+from src.score import evaluate_score_batch, evaluate_fn_batch, MAX_RADIUS, ParallelScorer
+from src.surface import ScoreSurface, ScoreGrid, GRID_CELL, MIN_CELL
+from src.store_index import StoreIndex
+from src.surrogates import make_surrogate
+from src.cache import score_params
+from data.columnar import GoldenHousing
+from src.profiling import timed, timer
 from sklearn.neighbors import KDTree
 
 MARGIN = 1000.0
+LAZY_POOL = 16384  # candidate pool size for the lazy greedy mode
+RESCORE_BLOCK = 64  # lazy greedy: surface estimates from the heap top re-scored exactly per call
+REFINE_FIRST_POINTS = 256  # refine_local: offsets in the first (full size) box
+REFINE_POINTS = 64         # ... and in every shrunk box
+REFINE_TOL = 0.5           # meters, refine_local stops below this box half-width
+KNOWN_POINTS = 2048  # "bayes": cached evaluations kept per store set (the most recent ones)
+BATCH_POOL = 1024  # top UCB suggestions added to the candidate pool of a "bayes_batch" round
+logger = logging.getLogger(__name__)
 
 def make_sobol_candidates(residents_xy, n_candidates = 600, margin_m=MARGIN):
     xmin, ymin = residents_xy.min(axis=0) - margin_m
@@ -14,67 +30,285 @@ def make_sobol_candidates(residents_xy, n_candidates = 600, margin_m=MARGIN):
     return Sobol(candidates = n_candidates, bound_x = [xmin, ymin], bound_y =[xmax, ymax])
 
 
-def find_best_location(housing: pd.DataFrame, store_locations: pd.DataFrame, n=5,
-                       use_grid=True):
+@timed("find_best_location")
+def find_best_location(housing: pd.DataFrame | GoldenHousing, store_locations: pd.DataFrame, n=5,
+                       use_grid=True, surface_cell=None, method="bayes", n_jobs=1,
+                       surrogate="gp", cache=None, q=4):
     """Returns DataFrame with the best n picks
+    housing - DataFrame with lat, lon and residents, or a GoldenHousing (data/columnar.py)
+    that is already projected and has its KD-tree.
+    method - "bayes" runs SimpleBayesOpt for every new store, "lazy_greedy" scores
+    one candidate pool and only re-scores candidates affected by each placement,
+    "bayes_batch" places q stores per SimpleBayesOpt run (see bayes_batch_locations),
+    "grid" takes the argmax of the objective on a dense ScoreGrid for every store.
+    surface_cell - if set, the optimizer scores candidates on a precomputed ScoreSurface
+    with this cell size (m); local search and the final scores stay exact. For "grid"
+    it is the grid resolution (default GRID_CELL). Cells below MIN_CELL are rejected.
+    n_jobs - if not 1, candidate batches are scored in that many processes (None - all cores).
+    surrogate - SimpleBayesOpt surrogate model, "gp" or "rff" (see src/surrogates.py).
+    cache - optional ResultCache; finished runs and (for "bayes") every greedy step are
+    stored under a hash of the inputs and parameters and reused by later runs.
     """
-    ref_lat = float(np.mean(housing['lat'].to_numpy()))
-    residents_xy = _latlon_to_xy(housing[['lat',  'lon']].to_numpy(), ref_lat)
-    residents_n = housing[['residents']].to_numpy()
+    if surface_cell is not None and surface_cell < MIN_CELL:
+        raise ValueError(f"surface_cell must be at least {MIN_CELL} m, got {surface_cell}")
+    if not isinstance(housing, GoldenHousing):
+        housing = GoldenHousing.from_dataframe(housing)
+    ref_lat, residents_xy, residents_n = housing.ref_lat, housing.residents_xy, housing.residents_n
+    tree_residents = housing.tree
     store_locations = store_locations[['lat', 'lon']]
     stores_xy = _latlon_to_xy(store_locations.to_numpy(), ref_lat) # for later
+    store_index = StoreIndex(stores_xy)  # new locations are appended, tree is not rebuilt
+
+    # n_jobs is left out on purpose - it does not change the results
+    params = dict(score_params(), use_grid=use_grid, surface_cell=surface_cell, method=method,
+                  surrogate=surrogate if isinstance(surrogate, str) else type(surrogate).__name__,
+                  refine=[REFINE_FIRST_POINTS, REFINE_POINTS, REFINE_TOL])
+    if method == "bayes_batch":
+        params.update(q=q, batch_pool=BATCH_POOL)
+    run_key = step_key = eval_key = None
+    if cache is not None:
+        run_key = cache.key(residents_xy, residents_n, stores_xy, params, n)
+        cached = cache.load(run_key)
+        if cached is not None:
+            logger.info("Loaded %d new locations from cache", n)
+            return cached["locations"]
+        step_key = cache.key(residents_xy, residents_n, params)
+        # objective values depend on the inputs and the scoring only, not on the optimizer settings
+        eval_key = cache.key(residents_xy, residents_n, score_params(), surface_cell)
     if use_grid:
         candidates_xy = make_sobol_candidates(residents_xy, margin_m=MARGIN)
     else:
         candidates_xy = residents_xy
     #show_candidates(candidates_xy, ref_lat)
 
-    tree_residents = KDTree(residents_xy)
+    scorer = None
+    if method == "grid":
+        pass  # scores every grid cell itself
+    elif surface_cell is not None:
+        scorer = ScoreSurface(residents_xy, residents_n, cell_size=surface_cell)
+        max_err = scorer.max_error(candidates_xy, tree_residents, store_index, residents_n)
+        logger.info("Score surface (%.0f m cells): max error %.4f on %d candidates",
+                    surface_cell, max_err, len(candidates_xy))
+    elif n_jobs != 1:
+        scorer = ParallelScorer(residents_xy, residents_n, n_jobs=n_jobs)
+
+    try:
+        if method == "lazy_greedy":
+            pool_xy = make_sobol_candidates(residents_xy, n_candidates=LAZY_POOL) if use_grid else candidates_xy
+            new_locations_all, scores_detailed = lazy_greedy_locations(pool_xy, n, tree_residents, store_index,
+                                                                       residents_n, scorer=scorer)
+        elif method == "bayes":
+            new_locations_all, scores_detailed = bayes_greedy_locations(candidates_xy, n, residents_xy,
+                                                                        tree_residents, store_index,
+                                                                        residents_n, scorer=scorer,
+                                                                        surrogate=surrogate, cache=cache,
+                                                                        step_key=step_key, eval_key=eval_key)
+        elif method == "grid":
+            cell = float(surface_cell or GRID_CELL)
+            grid = ScoreGrid(residents_xy, residents_n, stores_xy, cell_size=cell, rasters=housing.grid_rasters(cell))
+            new_locations_all, scores_detailed = grid_greedy_locations(grid, n, tree_residents, store_index,
+                                                                       residents_n)
+        elif method == "bayes_batch":
+            new_locations_all, scores_detailed = bayes_batch_locations(candidates_xy, n, q, residents_xy,
+                                                                       tree_residents, store_index, residents_n,
+                                                                       scorer=scorer, surrogate=surrogate)
+        else:
+            raise ValueError(f"Unknown method: {method}")
+    finally:
+        if isinstance(scorer, ParallelScorer):
+            scorer.close()
+
+    new_locations_latlon = _xy_to_latlon(new_locations_all, ref_lat)
+    locations = np.column_stack([new_locations_latlon, scores_detailed])
+    if cache is not None:
+        cache.save(run_key, locations=locations)
+    return locations
+
+
+@timed("bayes_greedy_locations")
+def bayes_greedy_locations(candidates_xy, n, residents_xy, tree_residents, store_index, residents_n,
+                           scorer=None, surrogate="gp", cache=None, step_key=None, eval_key=None):
+    """Places n stores one by one, running SimpleBayesOpt for each of them.
+    With a cache, each step is stored under (step_key, current stores), so an interrupted or
+    longer run resumes from there. The points the optimizer evaluated are stored separately
+    under (eval_key, current stores) and seed the next model for the same store set, also
+    from runs with other optimizer settings (e.g. a surrogate sweep).
+    """
+    surrogate = make_surrogate(surrogate)  # shared, so hyperparameters are warm-started between stores
     new_locations_all = np.empty((0,2))
     scores_detailed = []
 
     for iteration_global in range(n):
-        tree_store = KDTree(stores_xy)
+        if cache is not None:
+            key = cache.key(step_key, store_index.points)
+            cached = cache.load(key)
+            if cached is not None:
+                new_locations_all = np.vstack([new_locations_all, cached["location"]])
+                scores_detailed.append([*cached["scores"].tolist(), iteration_global+1])
+                store_index.add(cached["location"])
+                continue
+
         model = SimpleBayesOpt(bounds=[
                                     (residents_xy[:,0].min(), residents_xy[:,0].max()),
                                     (residents_xy[:,1].min(), residents_xy[:,1].max())
                                 ],
                                 residents_xy=residents_xy,
                                 residents_n=residents_n,
-                                stores_xy=stores_xy,
                                 tree_res=tree_residents,
-                                tree_store=tree_store)
-        model.run(n_iter = 2, first_data = candidates_xy)
+                                tree_store=store_index,
+                                scorer=scorer,
+                                surrogate=surrogate)
+        evaluated = cache.load(cache.key(eval_key, store_index.points)) if cache is not None else None
+        model.run(n_iter = 2, first_data = candidates_xy,
+                  known=None if evaluated is None else (evaluated["x"], evaluated["y"]))
         new_locations_xy = model.show_best(1)
-        new_locations_xy = random_search_local(new_locations_xy, 1000, tree_residents, tree_store,
-                                                        residents_xy, residents_n, stores_xy)
+        new_locations_xy = refine_local(new_locations_xy, 1000, tree_residents, store_index, residents_n)
         new_locations_all = np.vstack([new_locations_all, new_locations_xy])
-        stores_xy = np.vstack([stores_xy, new_locations_xy])
 
         # when the locations are ready - calculate once again for visualisation
-        for iter in new_locations_xy:
-            cust_prox, store_prox, ratio = evaluate_score(iter, tree_residents, tree_store,
-                                                        residents_xy, residents_n, stores_xy)
-            score = float(1+ cust_prox + store_prox + ratio)
-            scores_detailed.append([cust_prox, store_prox, ratio, score, iteration_global+1])
+        cust_prox, store_prox, ratio, score = evaluate_score_batch(new_locations_xy, tree_residents,
+                                                                   store_index, residents_n)
+        for row in zip(cust_prox, store_prox, ratio, score):
+            scores_detailed.append([*map(float, row), iteration_global+1])
+        if cache is not None:
+            cache.save(key, location=new_locations_xy, scores=np.array(scores_detailed[-1][:4]))
+            cache.save(cache.key(eval_key, store_index.points),
+                       x=np.array(model.X)[-KNOWN_POINTS:], y=np.array(model.y)[-KNOWN_POINTS:])
+        store_index.add(new_locations_xy)
+    return new_locations_all, scores_detailed
 
-    new_locations_latlon = _xy_to_latlon(new_locations_all, ref_lat)
-    return np.column_stack([new_locations_latlon, scores_detailed])
-
-
-def random_search_local(new_locations_xy, distance, tree_residents, tree_store, residents_xy, residents_n, stores_xy):
-    best_search = []
-    for _, [lat_xy, lon_xy] in enumerate(new_locations_xy):
-        bound_x = [lat_xy - distance, lon_xy - distance]
-        bound_y = [lat_xy + distance, lon_xy + distance]
-        sobol_points = Sobol(600, bound_x, bound_y)
-        scores = [evaluate_fn(p,
-                              tree_residents,
-                              tree_store,
-                              residents_xy,
-                              residents_n,
-                              stores_xy)
-                              for p in sobol_points]
-        best_local_point = sobol_points[np.argmax(scores)]
-        best_search.append(best_local_point)
-    return best_search
+
+@timed("bayes_batch_locations")
+def bayes_batch_locations(candidates_xy, n, q, residents_xy, tree_residents, store_index, residents_n,
+                          scorer=None, surrogate="gp"):
+    """Places n stores in rounds of q with one SimpleBayesOpt run per round (instead of one
+    per store). The q sites of a round are picked by lazy_greedy_locations from the points
+    the model evaluated plus its top BATCH_POOL UCB suggestions: every pick is scored with
+    the stores picked before it, so other_store_proximity and the ratio term penalize
+    candidates next to them and the sites of one round do not crowd together.
+    """
+    surrogate = make_surrogate(surrogate)
+    bounds = list(zip(residents_xy.min(axis=0), residents_xy.max(axis=0)))
+    new_locations_all = np.empty((0,2))
+    scores_detailed = []
+    while len(new_locations_all) < n:
+        model = SimpleBayesOpt(bounds=bounds, residents_xy=residents_xy, residents_n=residents_n,
+                               tree_res=tree_residents, tree_store=store_index, scorer=scorer,
+                               surrogate=surrogate)
+        model.run(n_iter=2, first_data=candidates_xy)
+        pool_xy = np.vstack([np.array(model.X), model.suggest(n_best=BATCH_POOL)])
+        locations, scores = lazy_greedy_locations(pool_xy, min(q, n - len(new_locations_all)), tree_residents,
+                                                  store_index, residents_n, scorer=scorer)
+        new_locations_all = np.vstack([new_locations_all, locations])
+        scores_detailed.extend([*row[:4], row[4] + len(new_locations_all) - len(locations)] for row in scores)
+    return new_locations_all, scores_detailed
+
+
+@timed("grid_greedy_locations")
+def grid_greedy_locations(grid, n, tree_residents, store_index, residents_n):
+    """Greedy placement on a ScoreGrid: the best cell of the grid, refined exactly within
+    two cells around it, is the next store; then only the grid cells within MAX_RADIUS of
+    it are re-scored."""
+    new_locations_all = np.empty((0,2))
+    scores_detailed = []
+    for iteration_global in range(n):
+        center, _ = grid.best()
+        new_location_xy = refine_local(center[None], 2 * grid.cell_size, tree_residents, store_index,
+                                       residents_n)
+        cust_prox, store_prox, ratio, score = evaluate_score_batch(new_location_xy, tree_residents,
+                                                                   store_index, residents_n)
+        scores_detailed.append([float(cust_prox[0]), float(store_prox[0]), float(ratio[0]),
+                                float(score[0]), iteration_global+1])
+        new_locations_all = np.vstack([new_locations_all, new_location_xy])
+        store_index.add(new_location_xy)
+        grid.add_store(new_location_xy[0])
+    return new_locations_all, scores_detailed
+
+
+@timed("lazy_greedy_locations")
+def lazy_greedy_locations(pool_xy, n, tree_residents, store_index, residents_n, distance=1000,
+                          scorer=None):
+    """Greedy placement over a fixed candidate pool with cached scores.
+    A placed store only changes the score of candidates within MAX_RADIUS of it, so only
+    those are re-scored; stale heap entries are skipped lazily by their version.
+    With a ScoreSurface scorer the initial scores are estimates: a candidate is accepted
+    only once its exact score is on top of the heap (estimates reaching the top are
+    re-scored exactly, RESCORE_BLOCK at a time). Bilinear estimates are not upper bounds,
+    so a pick can differ from exact scoring, but its score is exact and at most the
+    surface's max_error below the best exact score of that step.
+    """
+    with timer("kdtree_build", items=len(pool_xy)):
+        pool_tree = KDTree(pool_xy)
+    if scorer is not None:
+        scores = scorer.evaluate_fn_batch(pool_xy, store_index)
+    else:
+        scores = evaluate_fn_batch(pool_xy, tree_residents, store_index, residents_n)
+    version = np.zeros(len(pool_xy), dtype=int)
+    exact = np.full(len(pool_xy), not isinstance(scorer, ScoreSurface))
+    heap = [(-s, i, 0) for i, s in enumerate(scores)]
+    heapq.heapify(heap)
+
+    new_locations_all = np.empty((0,2))
+    scores_detailed = []
+    for iteration_global in range(n):
+        while True:
+            while heap[0][2] != version[heap[0][1]]:
+                heapq.heappop(heap)
+            if exact[heap[0][1]]:
+                break
+            block = []
+            while heap and len(block) < RESCORE_BLOCK:
+                entry = heapq.heappop(heap)
+                if entry[2] != version[entry[1]]:
+                    continue
+                if exact[entry[1]]:
+                    heapq.heappush(heap, entry)
+                    break
+                block.append(entry[1])
+            exact[block] = True
+            for i, s in zip(block, evaluate_fn_batch(pool_xy[block], tree_residents, store_index, residents_n)):
+                heapq.heappush(heap, (-s, i, version[i]))
+        _, best_idx, _ = heap[0]
+        new_location_xy = refine_local(pool_xy[[best_idx]], distance, tree_residents, store_index,
+                                       residents_n)
+        cust_prox, store_prox, ratio, score = evaluate_score_batch(new_location_xy, tree_residents,
+                                                                   store_index, residents_n)
+        scores_detailed.append([float(cust_prox[0]), float(store_prox[0]), float(ratio[0]),
+                                float(score[0]), iteration_global+1])
+        new_locations_all = np.vstack([new_locations_all, new_location_xy])
+        store_index.add(new_location_xy)
+
+        # invalidate and re-score only the candidates that now see the new store
+        affected = np.union1d(pool_tree.query_radius(new_location_xy, r=MAX_RADIUS)[0], [best_idx])
+        version[affected] += 1
+        exact[affected] = True
+        new_scores = evaluate_fn_batch(pool_xy[affected], tree_residents, store_index, residents_n)
+        for i, s in zip(affected, new_scores):
+            heapq.heappush(heap, (-s, i, version[i]))
+    return new_locations_all, scores_detailed
+
+
+@timed("refine_local", items=lambda incumbents_xy, *args, **kwargs: len(incumbents_xy))
+def refine_local(incumbents_xy, distance, tree_residents, tree_store, residents_n,
+                 first_points=REFINE_FIRST_POINTS, points=REFINE_POINTS, shrink=0.5, tol=REFINE_TOL):
+    """Trust-region refinement of all incumbents at once. Every round scores a Sobol set of
+    offsets in a box of half-width r around each incumbent (plus the incumbent itself) in
+    one batched call, moves each incumbent to its best point and shrinks r by `shrink`.
+    Starts with r = distance and first_points offsets and stops once r < tol (meters),
+    e.g. 1 + 256 + 10 * 64 = 897 evaluations per incumbent for 1000 m -> below 0.5 m.
+    """
+    best_xy = np.array(incumbents_xy, dtype=float).reshape(-1, 2)
+    best_score = evaluate_fn_batch(best_xy, tree_residents, tree_store, residents_n)
+    radius, n_points = float(distance), first_points
+    while radius >= tol:
+        offsets = Sobol(n_points, [-radius, -radius], [radius, radius])
+        X = (best_xy[:, None, :] + offsets[None, :, :]).reshape(-1, 2)
+        scores = evaluate_fn_batch(X, tree_residents, tree_store, residents_n).reshape(len(best_xy), -1)
+        idx = np.argmax(scores, axis=1)
+        round_best = scores[np.arange(len(best_xy)), idx]
+        improved = round_best > best_score
+        best_xy[improved] = X.reshape(len(best_xy), -1, 2)[improved, idx[improved]]
+        best_score[improved] = round_best[improved]
+        radius *= shrink
+        n_points = points
+    return best_xy
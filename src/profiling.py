@@ -0,0 +1,98 @@
+"""Lightweight timers and counters for the pipeline stages.
+
+Stages are timed with `timer(name)` blocks or the `@timed(name)` decorator. Nothing is
+recorded unless profiling is on (inside `profile_run`), then the cost is one flag check:
+
+    with profile_run("results/profile.json", cprofile_path="results/profile.prof"):
+        run_city(...)
+"""
+import cProfile
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+_enabled = False
+_stats = {}
+_lock = threading.Lock()
+
+
+def record(name: str, seconds: float = 0.0, items: int = 0, calls: int = 1):
+    """Adds to the wall time, call and item counts of a stage."""
+    if not _enabled:
+        return
+    with _lock:
+        stage = _stats.setdefault(name, {"calls": 0, "seconds": 0.0, "items": 0})
+        stage["calls"] += calls
+        stage["seconds"] += seconds
+        stage["items"] += items
+
+
+@contextmanager
+def timer(name: str, items: int = 0):
+    """Times the block as one call of stage `name`; items - e.g. candidates scored in it."""
+    if not _enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start, items)
+
+
+def timed(name: str, items=None):
+    """Decorator version of timer; items(*args, **kwargs) gives the item count of a call."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start, items(*args, **kwargs) if items else 0)
+        return wrapper
+    return decorator
+
+
+def report() -> dict:
+    with _lock:
+        stages = {name: dict(stage) for name, stage in _stats.items()}
+    for stage in stages.values():
+        if stage["items"] and stage["seconds"] > 0:
+            stage["items_per_s"] = stage["items"] / stage["seconds"]
+    return stages
+
+
+@contextmanager
+def profile_run(json_path=None, cprofile_path=None):
+    """Records all stages of the block and writes them as JSON to json_path; with
+    cprofile_path the block also runs under cProfile and the stats are dumped there."""
+    global _enabled
+    with _lock:
+        _stats.clear()
+    _enabled = True
+    profiler = cProfile.Profile() if cprofile_path else None
+    start = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+        _enabled = False
+        total = time.perf_counter() - start
+        if json_path:
+            Path(json_path).parent.mkdir(parents=True, exist_ok=True)
+            Path(json_path).write_text(json.dumps({
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "total_seconds": total,
+                "stages": report(),
+            }, indent=2))
+        if profiler:
+            profiler.dump_stats(cprofile_path)
@@ -1,10 +1,18 @@
 import numpy as np
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from sklearn.neighbors import KDTree
+from src.profiling import timed, timer
 
 W_CUSTOM = 1.0
 W_STORE  = 1.0
 W_RATIO = 1.0
 MAX_RADIUS = 1000.0   # cutoff in meters
 EXPECTED_CUST_PER_STORE = 800
+CHUNK_SIZE = 4096  # candidates per task for ParallelScorer
+_weights_lock = threading.RLock()  # held by score_weights for the whole block
 
 
 def customers_proximity(distances, n_residents):
@@ -23,6 +31,25 @@ def ratio_customers_per_store(n_residents, dists_stores):
     return W_RATIO * np.min([customers_per_store/ EXPECTED_CUST_PER_STORE, 1])
 
 
+@contextmanager
+def score_weights(w_custom=None, w_store=None, w_ratio=None):
+    ''' Temporarily replaces W_CUSTOM / W_STORE / W_RATIO (None keeps the current value).
+    The weights are module globals, so the block holds a process-wide lock: blocks in other
+    threads wait for it, and nested blocks in the same thread restore in order. Code that
+    must not see another thread's weights runs inside score_weights() too. ParallelScorer
+    worker processes do not see the override.
+    '''
+    global W_CUSTOM, W_STORE, W_RATIO
+    with _weights_lock:
+        saved = W_CUSTOM, W_STORE, W_RATIO
+        W_CUSTOM, W_STORE, W_RATIO = (old if new is None else float(new)
+                                      for old, new in zip(saved, (w_custom, w_store, w_ratio)))
+        try:
+            yield
+        finally:
+            W_CUSTOM, W_STORE, W_RATIO = saved
+
+
 def evaluate_fn(x, tree_residents, tree_store, residents_xy, residents_n, stores_xy):
     cust_prox, store_prox, ratio = evaluate_score(x, tree_residents, tree_store, residents_xy, residents_n, stores_xy)
     return float(1 + cust_prox + store_prox + ratio)
@@ -41,3 +68,114 @@ def evaluate_score(x, tree_residents, tree_store, residents_xy, residents_n, sto
     store_prox = other_store_proximity(dists_stores) if len(dists_stores) > 0 else 0.0
     ratio = ratio_customers_per_store(residents_n[idx_res], dists_stores)
     return cust_prox, store_prox, ratio
+
+
+def evaluate_fn_batch(X, tree_residents, tree_store, residents_n):
+    *_, total = evaluate_score_batch(X, tree_residents, tree_store, residents_n)
+    return total
+
+
+@timed("evaluate_score_batch", items=lambda X, *args, **kwargs: len(np.atleast_2d(X)))
+def evaluate_score_batch(X, tree_residents, tree_store, residents_n):
+    ''' Vectorized evaluate_score for an (N, 2) array of candidates.
+    Returns arrays (cust_prox, store_prox, ratio, total), each of length N.
+    '''
+    X = np.atleast_2d(np.asarray(X, dtype=float))
+    n_points = len(X)
+    residents_n = np.asarray(residents_n, dtype=float).reshape(-1)
+
+    # one multi-point radius query, flattened into segments (one segment per candidate)
+    seg_res, idx_res, dists_res = _query_segments(tree_residents, X)
+
+    n_res = residents_n[idx_res]
+    sum_res = np.bincount(seg_res, weights=n_res, minlength=n_points)
+    count_res = np.bincount(seg_res, minlength=n_points)
+    weighted = np.bincount(seg_res, weights=(1 - (dists_res / MAX_RADIUS) ** (1/3)) * n_res,
+                           minlength=n_points)
+    return combine_scores_batch(X, tree_store, weighted, sum_res, count_res > 0)
+
+
+def combine_scores_batch(X, tree_store, weighted, sum_res, has_res):
+    ''' Turns per-candidate customer sums into the score components.
+    weighted - resident-weighted kernel sum, sum_res - residents in radius,
+    has_res - whether any building is in radius.
+    '''
+    n_points = len(X)
+    seg_store, _, dists_store = _query_segments(tree_store, X)
+    count_store = np.bincount(seg_store, minlength=n_points)
+    penalty = np.bincount(seg_store, weights=(1 - (dists_store / MAX_RADIUS)) ** (1/3), minlength=n_points)
+    return combine_terms(weighted, sum_res, has_res, penalty, count_store)
+
+
+def combine_terms(weighted, sum_res, has_res, penalty, count_store):
+    ''' Score components from the per-candidate sums (arrays of any shape):
+    penalty - sum of the other_store_proximity kernel, count_store - stores in radius.
+    '''
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cust_prox = np.where(has_res, W_CUSTOM * weighted / sum_res, 0.0)
+
+    store_prox = np.where(count_store > 0, -W_STORE * penalty / np.maximum(count_store, 1), 0.0)
+
+    customers_per_store = np.where(count_store > 0, sum_res / np.maximum(count_store, 1), sum_res * 2)
+    ratio = W_RATIO * np.minimum(customers_per_store / EXPECTED_CUST_PER_STORE, 1)
+
+    total = 1 + cust_prox + store_prox + ratio
+    return cust_prox, store_prox, ratio, total
+
+
+def _query_segments(tree, X):
+    # StoreIndex already answers in flat form, KDTree returns one array per candidate
+    if hasattr(tree, "query_flat"):
+        return tree.query_flat(X, MAX_RADIUS)
+    indices, distances = tree.query_radius(X, r=MAX_RADIUS, return_distance=True)
+    counts = np.fromiter((len(i) for i in indices), dtype=np.intp, count=len(indices))
+    segments = np.repeat(np.arange(len(indices)), counts)
+    if counts.sum() == 0:
+        return segments, np.empty(0, dtype=np.intp), np.empty(0, dtype=float)
+    return segments, np.concatenate(indices), np.concatenate(distances)
+
+
+class ParallelScorer:
+    ''' Shards candidate batches of evaluate_score_batch across worker processes.
+    Residents are sent to each worker once at startup and the KDTree is rebuilt there,
+    only the candidates and the (small) store tree travel with each task.
+    Results come back in input order, identical to the serial path.
+    '''
+    def __init__(self, residents_xy, residents_n, n_jobs=None, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self._pool = ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                                         initargs=(np.asarray(residents_xy, dtype=float),
+                                                   np.asarray(residents_n, dtype=float)))
+
+    @timed("evaluate_score_parallel", items=lambda self, X, *args, **kwargs: len(np.atleast_2d(X)))
+    def evaluate_score_batch(self, X, tree_store):
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+        chunks = [X[i:i + self.chunk_size] for i in range(0, len(X), self.chunk_size)]
+        parts = list(self._pool.map(_score_chunk, chunks, repeat(tree_store)))
+        return tuple(np.concatenate(component) for component in zip(*parts))
+
+    def evaluate_fn_batch(self, X, tree_store):
+        *_, total = self.evaluate_score_batch(X, tree_store)
+        return total
+
+    def close(self):
+        self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc):
+        self.close()
+
+
+_worker_state = {}
+
+
+def _init_worker(residents_xy, residents_n):
+    with timer("kdtree_build", items=len(residents_xy)):
+        _worker_state["tree_residents"] = KDTree(residents_xy)
+    _worker_state["residents_n"] = residents_n
+
+
+def _score_chunk(X, tree_store):
+    return evaluate_score_batch(X, _worker_state["tree_residents"], tree_store, _worker_state["residents_n"])
@@ -0,0 +1,91 @@
+"""Warm optimizer state of one city for repeated what-if queries.
+
+Loading, projecting and indexing the housing of a city happens once; every query then
+only pays for the optimizer itself:
+
+    session = OptimizationSession.from_city("Warszawa", "Polska", "Żabka")
+    session.place(n=5, weights={"w_store": 2.0}, exclude=["node/123"])
+    session.score([[52.2297, 21.0122]])
+
+serve.py exposes sessions over a local HTTP/JSON API.
+"""
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import KDTree
+
+from data.columnar import GoldenHousing
+from data.data_preprocessing import load_optimizer_data
+from data.utils import _latlon_to_xy
+from src.optimization import find_best_location
+from src.profiling import timed
+from src.score import evaluate_score_batch, score_weights
+
+LOCATION_COLUMNS = ["lat", "lon", "cust_prox", "store_prox", "ratio", "score", "rank"]
+SCORE_COLUMNS = ["lat", "lon", "cust_prox", "store_prox", "ratio", "score"]
+WEIGHTS = ["w_custom", "w_store", "w_ratio"]  # keyword names of score_weights
+
+
+class OptimizationSession:
+    ''' One city loaded and indexed once (GoldenHousing: projected residents and their
+    KD-tree, existing stores projected to the same plane), answering placement and
+    scoring queries with per-query weights and excluded stores.
+    Every query runs inside score_weights, so queries of all sessions in the process are
+    serialized by its lock (the weights are module globals).
+    '''
+    def __init__(self, housing, store_locations: pd.DataFrame, cache=None):
+        self.housing = housing if isinstance(housing, GoldenHousing) else GoldenHousing.from_dataframe(housing)
+        self.stores = store_locations.reset_index(drop=True)
+        self.stores_xy = _latlon_to_xy(self.stores[['lat', 'lon']].to_numpy(), self.housing.ref_lat)
+        self.cache = cache
+
+    @classmethod
+    def from_city(cls, city: str, country: str, store: str, cache=None):
+        return cls(*load_optimizer_data(city, country, store), cache=cache)
+
+    def _stores_mask(self, exclude):
+        ''' Boolean mask of the stores kept; exclude - osm_ids of the stores to leave out.'''
+        if not exclude:
+            return np.ones(len(self.stores), dtype=bool)
+        if "osm_id" not in self.stores:
+            raise ValueError("Stores cannot be excluded: the store data of this city has no osm_id, "
+                             "refresh it with a full ETL run first")
+        exclude = set(exclude)
+        unknown = exclude - set(self.stores["osm_id"])
+        if unknown:
+            raise ValueError(f"Unknown stores: {sorted(unknown)}")
+        return ~self.stores["osm_id"].isin(exclude).to_numpy()
+
+    @staticmethod
+    def _weights(weights):
+        weights = dict(weights or {})
+        unknown = set(weights) - set(WEIGHTS)
+        if unknown:
+            raise ValueError(f"Unknown weights: {sorted(unknown)}, expected some of {WEIGHTS}")
+        return weights
+
+    @timed("session_place")
+    def place(self, n=5, method="lazy_greedy", weights=None, exclude=None, **options) -> pd.DataFrame:
+        """Best n new locations (LOCATION_COLUMNS) with the given weights and without the
+        excluded stores. method and options go to find_best_location; the default is the
+        fast "lazy_greedy" method instead of "bayes"."""
+        weights = self._weights(weights)
+        if weights and options.get("n_jobs", 1) != 1:
+            raise ValueError("Custom weights need n_jobs=1, worker processes keep the default weights")
+        stores = self.stores[self._stores_mask(exclude)]
+        with score_weights(**weights):
+            locations = find_best_location(self.housing, stores, n=n, method=method, cache=self.cache,
+                                           **options)
+        locations = pd.DataFrame(locations, columns=LOCATION_COLUMNS)
+        locations["rank"] = locations["rank"].astype(int)
+        return locations
+
+    @timed("session_score", items=lambda self, points, *args, **kwargs: len(points))
+    def score(self, points, weights=None, exclude=None) -> pd.DataFrame:
+        """Score components (SCORE_COLUMNS) of candidate sites given as (lat, lon) pairs."""
+        weights = self._weights(weights)
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        tree_store = KDTree(self.stores_xy[self._stores_mask(exclude)])
+        with score_weights(**weights):
+            components = evaluate_score_batch(_latlon_to_xy(points, self.housing.ref_lat), self.housing.tree,
+                                              tree_store, self.housing.residents_n)
+        return pd.DataFrame(np.column_stack([points, *components]), columns=SCORE_COLUMNS)
@@ -0,0 +1,76 @@
+import numpy as np
+from sklearn.neighbors import KDTree
+from src.profiling import timer
+
+MAX_BUFFER = 256  # appended stores kept outside the tree before it is rebuilt
+CHUNK_SIZE = 8192  # candidates per brute-force block against the buffer
+
+
+class StoreIndex:
+    ''' Store locations index supporting cheap appends.
+    Existing stores live in a static KDTree, newly placed stores in a small
+    buffer that is searched brute-force and merged into the query results.
+    Indices refer to `points` (static stores first, then appended ones), so the
+    index can be used wherever a KDTree over stores_xy is expected.
+    '''
+    def __init__(self, stores_xy, max_buffer=MAX_BUFFER):
+        self.max_buffer = max_buffer
+        self._static = np.asarray(stores_xy, dtype=float).reshape(-1, 2)
+        self._tree = KDTree(self._static)
+        self._buffer = np.empty((0, 2))
+
+    @property
+    def points(self):
+        return np.vstack([self._static, self._buffer])
+
+    def __len__(self):
+        return len(self._static) + len(self._buffer)
+
+    def add(self, new_xy):
+        self._buffer = np.vstack([self._buffer, np.asarray(new_xy, dtype=float).reshape(-1, 2)])
+        if len(self._buffer) > self.max_buffer:
+            self._static = self.points
+            with timer("kdtree_build", items=len(self._static)):
+                self._tree = KDTree(self._static)
+            self._buffer = np.empty((0, 2))
+
+    def query_flat(self, X, r):
+        ''' Radius query returning flat (segment, index, distance) arrays, sorted by segment
+        (the row of X each neighbour belongs to).
+        '''
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+        idx, dists = self._tree.query_radius(X, r=r, return_distance=True)
+        counts = np.fromiter((len(i) for i in idx), dtype=np.intp, count=len(idx))
+        seg = np.repeat(np.arange(len(X)), counts)
+        idx = np.concatenate(idx).astype(np.intp) if counts.sum() else np.empty(0, dtype=np.intp)
+        dists = np.concatenate(dists) if counts.sum() else np.empty(0)
+        if len(self._buffer) == 0:
+            return seg, idx, dists
+
+        segs, idxs, distss = [seg], [idx], [dists]
+        for start in range(0, len(X), CHUNK_SIZE):
+            block = np.linalg.norm(X[start:start + CHUNK_SIZE, None, :] - self._buffer[None, :, :], axis=2)
+            rows, cols = np.nonzero(block <= r)
+            segs.append(rows + start)
+            idxs.append(cols + len(self._static))
+            distss.append(block[rows, cols])
+        seg, idx, dists = np.concatenate(segs), np.concatenate(idxs), np.concatenate(distss)
+        order = np.argsort(seg, kind="stable")
+        return seg[order], idx[order], dists[order]
+
+    def query_radius(self, X, r, return_distance=False):
+        ''' KDTree.query_radius compatible interface.'''
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+        seg, idx, dists = self.query_flat(X, r)
+        splits = np.cumsum(np.bincount(seg, minlength=len(X)))[:-1]
+        idx_out = _object_array(np.split(idx, splits))
+        if not return_distance:
+            return idx_out
+        return idx_out, _object_array(np.split(dists, splits))
+
+
+def _object_array(parts):
+    out = np.empty(len(parts), dtype=object)
+    for i, part in enumerate(parts):
+        out[i] = part
+    return out
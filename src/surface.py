@@ -0,0 +1,122 @@
+import numpy as np
+from scipy.ndimage import map_coordinates
+from scipy.signal import fftconvolve
+from src.profiling import timed
+from src.score import MAX_RADIUS, combine_scores_batch, combine_terms, evaluate_score_batch
+
+CELL_SIZE = 25.0  # raster resolution in meters
+GRID_CELL = 20.0  # ScoreGrid resolution in meters
+MIN_CELL = 5.0    # smaller cells make city-wide rasters of GBs
+
+
+def resident_rasters(residents_xy, residents_n, cell_size):
+    ''' Residents binned into cell_size cells and convolved (FFT) with the customers_proximity
+    kernel and with the MAX_RADIUS disk. Returns (origin, weighted, residents) - cell (i, j)
+    is centered at origin + (i, j) * cell_size.
+    '''
+    residents_xy = np.asarray(residents_xy, dtype=float)
+    residents_n = np.asarray(residents_n, dtype=float).reshape(-1)
+
+    # cell centers span the residents bounding box padded by MAX_RADIUS,
+    # outside of it no building is in range and both rasters are 0
+    origin = residents_xy.min(axis=0) - MAX_RADIUS
+    extent = residents_xy.max(axis=0) + MAX_RADIUS - origin
+    shape = np.ceil(extent / cell_size).astype(int) + 1
+    edges = [origin[i] - cell_size / 2 + np.arange(shape[i] + 1) * cell_size for i in range(2)]
+    density, _, _ = np.histogram2d(residents_xy[:, 0], residents_xy[:, 1], bins=edges, weights=residents_n)
+
+    r = int(np.ceil(MAX_RADIUS / cell_size))
+    offsets = np.arange(-r, r + 1) * cell_size
+    dist = np.hypot(*np.meshgrid(offsets, offsets, indexing="ij"))
+    in_radius = dist <= MAX_RADIUS
+    kernel = np.where(in_radius, 1 - (np.minimum(dist, MAX_RADIUS) / MAX_RADIUS) ** (1/3), 0.0)
+
+    # FFT leaves tiny negative round-off where the true sum is 0
+    weighted = np.clip(fftconvolve(density, kernel, mode="same"), 0, None)
+    residents = np.clip(fftconvolve(density, in_radius.astype(float), mode="same"), 0, None)
+    residents[residents < 1e-6] = 0.0
+    return origin, weighted, residents
+
+
+class ScoreSurface:
+    ''' Precomputed raster of the customer term for one city.
+    Residents are binned into a grid (cell_size meters), then convolved once with
+    the customers_proximity kernel and with the MAX_RADIUS disk. Candidates are
+    scored by bilinear lookup; only the store term is computed exactly.
+    '''
+    @timed("surface_build", items=lambda self, residents_xy, *args, **kwargs: len(residents_xy))
+    def __init__(self, residents_xy, residents_n, cell_size=CELL_SIZE):
+        self.cell_size = float(cell_size)
+        self.origin, self.weighted, self.residents = resident_rasters(residents_xy, residents_n, self.cell_size)
+
+    def lookup(self, X):
+        ''' Bilinear lookup of (weighted kernel sum, residents in radius) for an (N, 2) array.'''
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+        coords = ((X - self.origin) / self.cell_size).T
+        weighted = map_coordinates(self.weighted, coords, order=1, mode="constant", cval=0.0)
+        residents = map_coordinates(self.residents, coords, order=1, mode="constant", cval=0.0)
+        return weighted, residents
+
+    @timed("evaluate_score_surface", items=lambda self, X, *args, **kwargs: len(np.atleast_2d(X)))
+    def evaluate_score_batch(self, X, tree_store):
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+        weighted, residents = self.lookup(X)
+        return combine_scores_batch(X, tree_store, weighted, residents, residents > 0)
+
+    def evaluate_fn_batch(self, X, tree_store):
+        *_, total = self.evaluate_score_batch(X, tree_store)
+        return total
+
+    def max_error(self, X, tree_residents, tree_store, residents_n):
+        ''' Max absolute difference of the total score against the exact KD-tree scoring.'''
+        exact = evaluate_score_batch(X, tree_residents, tree_store, residents_n)[3]
+        approx = self.evaluate_fn_batch(X, tree_store)
+        return float(np.max(np.abs(approx - exact)))
+
+
+class ScoreGrid:
+    ''' The full objective on every cell center of a dense grid over the city.
+    The customer rasters come from resident_rasters (FFT). The store term is kept as two
+    more rasters, kernel sum and store count, stamped with exact distances from every
+    store; add_store only updates the cells within MAX_RADIUS of the new store, so each
+    greedy step costs one argmax over the grid.
+    rasters - resident_rasters(residents_xy, residents_n, cell_size) if already computed.
+    '''
+    @timed("grid_build", items=lambda self, residents_xy, *args, **kwargs: len(residents_xy))
+    def __init__(self, residents_xy, residents_n, stores_xy, cell_size=GRID_CELL, rasters=None):
+        self.cell_size = float(cell_size)
+        if rasters is None:
+            rasters = resident_rasters(residents_xy, residents_n, self.cell_size)
+        self.origin, self.weighted, self.residents = rasters  # only read, so they can be shared
+        self.penalty = np.zeros_like(self.weighted)
+        self.count = np.zeros_like(self.weighted)
+        for xy in np.asarray(stores_xy, dtype=float).reshape(-1, 2):
+            self._stamp(xy)
+        self.total = combine_terms(self.weighted, self.residents, self.residents > 0,
+                                   self.penalty, self.count)[3]
+
+    def _window(self, xy):
+        lo = np.maximum(np.floor((xy - MAX_RADIUS - self.origin) / self.cell_size).astype(int), 0)
+        hi = np.minimum(np.ceil((xy + MAX_RADIUS - self.origin) / self.cell_size).astype(int) + 1,
+                        self.weighted.shape)
+        return slice(lo[0], max(hi[0], lo[0])), slice(lo[1], max(hi[1], lo[1]))
+
+    def _stamp(self, xy):
+        win = self._window(xy)
+        cx = self.origin[0] + np.arange(win[0].start, win[0].stop) * self.cell_size
+        cy = self.origin[1] + np.arange(win[1].start, win[1].stop) * self.cell_size
+        dist = np.hypot(*np.meshgrid(cx - xy[0], cy - xy[1], indexing="ij"))
+        in_radius = dist <= MAX_RADIUS
+        self.penalty[win] += np.where(in_radius, (1 - np.minimum(dist, MAX_RADIUS) / MAX_RADIUS) ** (1/3), 0.0)
+        self.count[win] += in_radius
+        return win
+
+    def add_store(self, xy):
+        win = self._stamp(np.asarray(xy, dtype=float).reshape(2))
+        self.total[win] = combine_terms(self.weighted[win], self.residents[win], self.residents[win] > 0,
+                                        self.penalty[win], self.count[win])[3]
+
+    def best(self):
+        ''' Center (x, y) and score of the best cell.'''
+        i, j = np.unravel_index(np.argmax(self.total), self.total.shape)
+        return self.origin + np.array([i, j]) * self.cell_size, float(self.total[i, j])
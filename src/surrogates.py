@@ -0,0 +1,88 @@
+from sklearn.gaussian_process import GaussianProcessRegressor
+from sklearn.gaussian_process.kernels import Matern, ConstantKernel
+import numpy as np
+from scipy.linalg import cho_solve, solve_triangular
+from src.profiling import timed
+
+N_FEATURES = 512  # random Fourier features
+NOISE = 1e-2      # observation noise variance (on normalized y)
+
+
+class WarmStartGP:
+    ''' Exact GP (the original SimpleBayesOpt surrogate). Every fit starts the
+    hyperparameter search from the kernel fitted last time instead of the defaults.
+    '''
+    def __init__(self):
+        self.kernel = Matern(nu=2.5) * ConstantKernel(1.0, (1e-3, 1e3))
+        self.gp = None
+
+    @timed("surrogate_fit", items=lambda self, X, y: len(X))
+    def fit(self, X, y):
+        self.gp = GaussianProcessRegressor(kernel=self.kernel, normalize_y=True)
+        self.gp.fit(X, y)
+        self.kernel = self.gp.kernel_
+        return self
+
+    @timed("surrogate_predict", items=lambda self, X, return_std=False: len(X))
+    def predict(self, X, return_std=False):
+        return self.gp.predict(X, return_std=return_std)
+
+
+class RandomFourierGP:
+    ''' Approximate GP: Bayesian linear regression on random Fourier features of an RBF kernel.
+    Fit is O(n * D^2) and prediction O(m * D^2), independent of the training set size.
+    The length scale is set by the median heuristic on the first fit and kept afterwards.
+    '''
+    def __init__(self, n_features=N_FEATURES, noise=NOISE, random_state=0):
+        self.n_features = n_features
+        self.noise = noise
+        self.rng = np.random.default_rng(random_state)
+        self.length_scale = None
+        self._omega = self.rng.standard_normal((2, n_features))
+        self._phase = self.rng.uniform(0, 2 * np.pi, n_features)
+
+    def _features(self, X):
+        Z = (np.asarray(X, dtype=float) - self._x_mean) / self._x_std
+        return np.sqrt(2.0 / self.n_features) * np.cos(Z @ self._omega / self.length_scale + self._phase)
+
+    @timed("surrogate_fit", items=lambda self, X, y: len(X))
+    def fit(self, X, y):
+        X = np.asarray(X, dtype=float)
+        y = np.asarray(y, dtype=float).ravel()
+        self._x_mean, self._x_std = X.mean(axis=0), X.std(axis=0) + 1e-12
+        self._y_mean, self._y_std = y.mean(), y.std() + 1e-12
+        if self.length_scale is None:
+            Z = (X - self._x_mean) / self._x_std
+            sample = Z[self.rng.choice(len(Z), size=min(len(Z), 500), replace=False)]
+            dists = np.linalg.norm(sample[:, None] - sample[None, :], axis=2)
+            self.length_scale = float(np.median(dists[dists > 0])) if np.any(dists > 0) else 1.0
+
+        Phi = self._features(X)
+        A = Phi.T @ Phi / self.noise + np.eye(self.n_features)
+        self._chol = np.linalg.cholesky(A)  # lower triangular
+        self._w = cho_solve((self._chol, True), Phi.T @ ((y - self._y_mean) / self._y_std)) / self.noise
+        return self
+
+    @timed("surrogate_predict", items=lambda self, X, return_std=False: len(X))
+    def predict(self, X, return_std=False):
+        Phi = self._features(X)
+        mu = Phi @ self._w * self._y_std + self._y_mean
+        if not return_std:
+            return mu
+        v = solve_triangular(self._chol, Phi.T, lower=True)
+        return mu, np.sqrt(np.sum(v ** 2, axis=0)) * self._y_std
+
+
+SURROGATES = {"gp": WarmStartGP, "rff": RandomFourierGP}
+
+
+def make_surrogate(surrogate="gp"):
+    ''' Returns a surrogate instance, `surrogate` is a name from SURROGATES or an
+    object with fit(X, y) and predict(X, return_std=True).
+    '''
+    if isinstance(surrogate, str):
+        if surrogate not in SURROGATES:
+            raise ValueError(f"Unknown surrogate: {surrogate}")
+        return SURROGATES[surrogate]()
+    return surrogate
+
@@ -6,3 +6,12 @@ def Sobol(candidates, bound_x, bound_y):
     sample = sampler.random(int(2 ** np.ceil(np.log2(candidates))))
     scaled = qmc.scale(sample, bound_x, bound_y)
     return scaled
+
+
+def sobol_chunks(candidates, bound_x, bound_y, chunk_size):
+    """Like Sobol, but the points of one sequence are yielded in power-of-two sized chunks."""
+    sampler = qmc.Sobol(d=2, scramble=True)
+    total = int(2 ** np.ceil(np.log2(candidates)))
+    chunk_size = min(total, int(2 ** np.floor(np.log2(chunk_size))))
+    for _ in range(total // chunk_size):
+        yield qmc.scale(sampler.random(chunk_size), bound_x, bound_y)
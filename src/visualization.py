@@ -1,9 +1,17 @@
 # Code to visualize the results using folium
+import os
 import folium
+import numpy as np
+from folium.plugins import HeatMap
 from data.utils import _xy_to_latlon
+from src.profiling import timed
 import logging
 logger = logging.getLogger(__name__)
 
+MARKER_THRESHOLD = 5000    # above this many buildings housing is drawn as a heatmap
+MAX_HEAT_POINTS = 50000    # heatmap cells, keeps the HTML file at a few MB
+HEAT_CELL_DEG = 0.0005     # starting heatmap cell (~50 m)
+
 
 def show_candidates(candidates_xy, ref_lat=52.2297, city = "Warsaw"):
     # Center the map around the city
@@ -20,30 +28,33 @@ def show_candidates(candidates_xy, ref_lat=52.2297, city = "Warsaw"):
     logger.info("Map saved to candid.html")
 
 
-def generate_map(housing, zabka_locations, new_locations, city="Warszawa"):
+@timed("generate_map", items=lambda housing, *args, **kwargs: len(housing))
+def generate_map(housing, zabka_locations, new_locations, city="Warszawa",
+                 marker_threshold=MARKER_THRESHOLD, max_heat_points=MAX_HEAT_POINTS):
+    """Saves the map with housing, existing stores and the proposed locations.
+    Up to marker_threshold buildings are drawn as individual markers, larger cities
+    get a residents-weighted heatmap of at most max_heat_points grid cells, which
+    bounds the size of the HTML file. Stores and proposed locations are always markers.
+    """
     # Center the map around the city
     city_center = housing[['lat', 'lon']].mean(axis = 0).to_list()  # Coordinates for Warsaw
     m = folium.Map(location=city_center, zoom_start=12)
 
     # Add housing locations
-    for _, row in housing.iterrows():
-        popup_text = (
-            f"Type: {row['building_type']}, "
-            f"Area: {row['area_m2']:.1f} m², "
-            f"Residents: {row['residents']}"
-        )
-        folium.CircleMarker(location=[row['lat'], row['lon']],
-                            radius=1, color='blue', fill=True, fill_color='blue',
-                            fill_opacity=0.6,
-                            popup=popup_text
-                        ).add_to(m)
+    if len(housing) <= marker_threshold:
+        popups = ("Type: " + housing['building_type'].astype(str)
+                  + ", Area: " + housing['area_m2'].map('{:.1f}'.format) + " m²"
+                  + ", Residents: " + housing['residents'].astype(str))
+        points_layer(housing['lat'], housing['lon'], popups, color='blue', radius=1,
+                     fill_opacity=0.6, name="Housing").add_to(m)
+    else:
+        heat = aggregate_housing(housing, max_heat_points)
+        HeatMap(heat.tolist(), name="Residents", radius=12, blur=15).add_to(m)
+        logger.info(f"Aggregated {len(housing)} buildings into {len(heat)} heatmap cells")
 
     # Add existing Żabka locations
-    for _, row in zabka_locations.iterrows():
-        folium.CircleMarker(location=[row['lat'], row['lon']], radius=3,
-                            color="green", fill=True, fill_color="green",
-                            fill_opacity=0.9, popup="Żabka Location"
-                        ).add_to(m)
+    points_layer(zabka_locations['lat'], zabka_locations['lon'], ["Żabka Location"] * len(zabka_locations),
+                 color="green", radius=3, fill_opacity=0.9, name="Żabka").add_to(m)
     # Add new proposed locations
     for lat, lon, cust_prox, store_prox, ratio, score, idx in new_locations:
         popup_text = (
@@ -56,5 +67,40 @@ def generate_map(housing, zabka_locations, new_locations, city="Warszawa"):
         ).add_to(m)
 
     # Save the map to an HTML file
-    m.save(f"results/{city}_zabka_map.html")
-    logger.info(f"Map saved to {city}_zabka_map.html")
+    out_path = f"results/{city}_zabka_map.html"
+    m.save(out_path)
+    logger.info(f"Map saved to {city}_zabka_map.html ({os.path.getsize(out_path) / 2**20:.1f} MB)")
+
+
+def points_layer(lats, lons, popups, color, radius, fill_opacity, name):
+    """All points as one GeoJson layer of circle markers, each with its own popup.
+    Much faster to build and lighter in the HTML than one folium object per point."""
+    features = [
+        {"type": "Feature",
+         "geometry": {"type": "Point", "coordinates": [float(lon), float(lat)]},
+         "properties": {"info": popup}}
+        for lat, lon, popup in zip(lats, lons, popups)
+    ]
+    return folium.GeoJson(
+        {"type": "FeatureCollection", "features": features},
+        name=name,
+        marker=folium.CircleMarker(radius=radius, color=color, fill=True, fill_color=color,
+                                   fill_opacity=fill_opacity),
+        popup=folium.GeoJsonPopup(fields=["info"], labels=False),
+    )
+
+
+def aggregate_housing(housing, max_points=MAX_HEAT_POINTS):
+    """Sums residents on a lat/lon grid, coarsening the cell until at most max_points
+    cells are left. Returns an array of [lat, lon, weight] rows (cell centers)."""
+    latlon = housing[['lat', 'lon']].to_numpy(dtype=float)
+    residents = housing['residents'].to_numpy(dtype=float)
+    cell = HEAT_CELL_DEG
+    while True:
+        cells = np.floor(latlon / cell).astype(np.int64)
+        unique, inverse = np.unique(cells, axis=0, return_inverse=True)
+        if len(unique) <= max_points:
+            break
+        cell *= 2
+    weights = np.bincount(inverse.ravel(), weights=residents)
+    return np.column_stack([(unique + 0.5) * cell, weights / weights.max()])
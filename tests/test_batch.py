@@ -0,0 +1,47 @@
+import os
+
+import pandas as pd
+import pytest
+
+import batch
+
+
+def fake_run_city(city, country, store, n_locations, refresh=False, profile=None, name=None):
+    if city == "Failowo":
+        raise RuntimeError("no data")
+    if city == "Killowo":
+        os._exit(1)  # e.g. killed by the OOM killer
+    return [[52.0 + i, 21.0, 1.0, 1.0, 1.0, float(n_locations - i), i + 1] for i in range(n_locations)]
+
+
+def _job(city, store="Żabka", n=2):
+    return {"city": city, "country": "Polska", "store": store, "n_locations": n}
+
+
+@pytest.fixture
+def results(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(batch, "run_city", fake_run_city)  # inherited by the forked workers
+    return tmp_path / "results"
+
+
+def test_run_batch_isolates_failures_and_names_outputs_per_job(results):
+    jobs = [_job("Testowo"), _job("Testowo", store="Lewiatan"), _job("Failowo")]
+    summary = batch.run_batch(jobs, workers=2)
+
+    assert summary[["city", "store", "status"]].values.tolist() == [
+        ["Failowo", "Żabka", "failed"], ["Testowo", "Lewiatan", "ok"], ["Testowo", "Żabka", "ok"]]
+    assert "no data" in summary.loc[0, "error"]
+    assert pd.read_csv(results / "batch_summary.csv")["status"].tolist() == ["failed", "ok", "ok"]
+    for name in ("testowo_żabka_2", "testowo_lewiatan_2"):  # same city, no overwrite
+        assert len(pd.read_csv(results / f"{name}_new_locations.csv")) == 2
+    assert not (results / "failowo_żabka_2_new_locations.csv").exists()
+
+    with pytest.raises(ValueError, match="testowo_żabka_2"):
+        batch.run_batch([_job("Testowo"), _job("Testowo")])
+
+
+def test_run_batch_survives_a_killed_worker(results):
+    summary = batch.run_batch([_job("Killowo"), _job("Testowo")], workers=1)
+    assert pd.read_csv(results / "batch_summary.csv")["city"].tolist() == ["Killowo", "Testowo"]
+    assert summary.loc[0, "status"] == "failed" and "BrokenProcessPool" in summary.loc[0, "error"]
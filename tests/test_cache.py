@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+
+from src.SimpleBayesOpt import SimpleBayesOpt
+from src.surrogates import RandomFourierGP
+from src.cache import ResultCache, score_params
+from src.optimization import find_best_location
+
+
+def test_cache_roundtrip_invalidate_and_eviction(tmp_path):
+    cache = ResultCache(tmp_path, max_mb=1)
+    data = np.arange(10.0)
+    key = cache.key(data, {"n": 3}, score_params())
+    assert key == cache.key(data.copy(), {"n": 3}, score_params())
+    assert key != cache.key(data, {"n": 4}, score_params())
+
+    assert cache.load(key) is None
+    cache.save(key, locations=data)
+    assert np.array_equal(cache.load(key)["locations"], data)
+    assert ResultCache(tmp_path, refresh=True).load(key) is None
+
+    cache.invalidate(key)
+    assert cache.load(key) is None
+
+    # ~0.4 MB entries in a 1 MB cache - the oldest ones go
+    keys = [cache.key(i) for i in range(5)]
+    for k in keys:
+        cache.save(k, x=np.zeros(50_000))
+    assert cache.load(keys[0]) is None
+    assert cache.load(keys[-1]) is not None
+    cache.invalidate()
+    assert list(tmp_path.glob("*.npz")) == []
+
+
+def test_find_best_location_reuses_cached_run(tmp_path):
+    rng = np.random.default_rng(0)
+    housing = pd.DataFrame({"lat": 52.2 + rng.normal(0, 0.01, 500),
+                            "lon": 21.0 + rng.normal(0, 0.01, 500),
+                            "residents": rng.integers(1, 50, 500).astype(float)})
+    stores = pd.DataFrame({"lat": 52.2 + rng.normal(0, 0.01, 10),
+                           "lon": 21.0 + rng.normal(0, 0.01, 10)})
+    cache = ResultCache(tmp_path)
+
+    first = find_best_location(housing, stores, n=2, method="lazy_greedy", cache=cache)
+    second = find_best_location(housing, stores, n=2, method="lazy_greedy", cache=cache)
+    assert np.array_equal(first, second)
+
+
+def test_bayes_sweep_reuses_cached_evaluations(tmp_path, monkeypatch):
+    rng = np.random.default_rng(1)
+    housing = pd.DataFrame({"lat": 52.2 + rng.normal(0, 0.01, 500),
+                            "lon": 21.0 + rng.normal(0, 0.01, 500),
+                            "residents": rng.integers(1, 50, 500).astype(float)})
+    stores = pd.DataFrame({"lat": 52.2 + rng.normal(0, 0.01, 10),
+                           "lon": 21.0 + rng.normal(0, 0.01, 10)})
+    cache = ResultCache(tmp_path)
+    evaluated = []
+    add_points = SimpleBayesOpt.add_points
+    monkeypatch.setattr(SimpleBayesOpt, "add_points", lambda self, X: (evaluated.append(len(X)), add_points(self, X)))
+
+    find_best_location(housing, stores, n=1, method="bayes", surrogate="rff", cache=cache)
+    assert len(evaluated) == 2 and evaluated[0] > 50  # initial Sobol design, then 50 suggestions
+    evaluated.clear()
+    # another surrogate is another run, but the objective values of the same store set are reused
+    find_best_location(housing, stores, n=1, method="bayes", surrogate=RandomFourierGP(n_features=64), cache=cache)
+    assert evaluated == [50]
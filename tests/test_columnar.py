@@ -0,0 +1,75 @@
+from functools import partial
+
+import numpy as np
+import pytest
+from scipy.stats import qmc
+from sklearn.neighbors import KDTree
+
+import data.data_preprocessing as dp
+import data.local_etl as etl
+from benchmarks.synthetic import synthetic_city
+from data.columnar import GoldenHousing, columnar_path, load_columnar, write_columnar
+from data.utils import _latlon_to_xy
+from src.optimization import find_best_location
+
+
+def test_columnar_roundtrip_matches_projection(tmp_path):
+    housing, _ = synthetic_city(2000, 20, 3, seed=1)
+    path = columnar_path(tmp_path / "city_housing.parquet")
+    write_columnar(housing, path, source_hash="abc")
+
+    golden = load_columnar(path)
+    assert isinstance(golden.residents_xy, np.memmap)
+    ref_lat = float(housing.lat.mean())
+    expected_xy = _latlon_to_xy(housing[["lat", "lon"]].to_numpy(), ref_lat)
+    assert golden.ref_lat == ref_lat
+    np.testing.assert_array_equal(golden.residents_xy, expected_xy)
+    np.testing.assert_array_equal(golden.residents_n, housing[["residents"]].to_numpy(dtype=float))
+
+    X = expected_xy[:50] + 100.0
+    ind, dist = golden.tree.query_radius(X, 800, return_distance=True)
+    ind_ref, dist_ref = KDTree(expected_xy).query_radius(X, 800, return_distance=True)
+    for a, b, da, db in zip(ind, ind_ref, dist, dist_ref):
+        np.testing.assert_array_equal(np.sort(a), np.sort(b))
+        np.testing.assert_allclose(np.sort(da), np.sort(db))
+
+
+def test_find_best_location_same_from_columnar(tmp_path, monkeypatch):
+    monkeypatch.setattr(qmc, "Sobol", partial(qmc.Sobol, seed=0))
+    housing, stores = synthetic_city(1500, 15, 3, seed=2)
+    path = columnar_path(tmp_path / "city_housing.parquet")
+    write_columnar(housing, path)
+
+    from_frame = find_best_location(housing, stores, n=2, method="lazy_greedy")
+    from_columnar = find_best_location(load_columnar(path), stores, n=2, method="lazy_greedy")
+    np.testing.assert_allclose(from_columnar, from_frame)
+
+
+def test_grid_rasters_memo_is_bounded():
+    housing, stores = synthetic_city(2000, 20, 3, seed=2)
+    golden = GoldenHousing.from_dataframe(housing)
+    first = golden.grid_rasters(20.0)
+    assert golden.grid_rasters(20.0) is first
+    for cell in (25.0, 50.0, 100.0):
+        golden.grid_rasters(cell)
+    assert list(golden.rasters) == [50.0, 100.0]
+
+    with pytest.raises(ValueError):
+        find_best_location(golden, stores, n=1, method="grid", surface_cell=1.0)
+
+
+def test_optimizer_housing_follows_the_source_of_the_housing(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    local, _ = synthetic_city(500, 5, 3, seed=1)
+    etl.write_layer(local, etl.layer_path("golden", "Testowo", "housing"), source="test")
+    etl.sync_golden_columnar("Testowo")
+    snowflake = local.assign(residents=local.residents * 2)  # same row count, another residents formula
+
+    monkeypatch.setattr(dp, "get_pool", lambda: None)
+    assert isinstance(dp.optimizer_housing("Testowo", local).residents_xy, np.memmap)
+    monkeypatch.setattr(dp, "load_dataframe", None)  # the session load maps the arrays, no parquet read
+    assert isinstance(dp.load_housing_arrays("Testowo", "Polska").residents_xy, np.memmap)
+
+    monkeypatch.setattr(dp, "get_pool", lambda: object())
+    golden = dp.optimizer_housing("Testowo", snowflake)
+    np.testing.assert_array_equal(golden.residents_n, snowflake[["residents"]].to_numpy())
@@ -0,0 +1,120 @@
+import json
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import data.local_etl as etl
+from data.utils import OverpassError
+
+
+def _housing(ids, lat_shift=0.0, levels="2"):
+    rng = np.random.default_rng(len(ids))
+    return pd.DataFrame({
+        "osm_id": [f"way/{i}" for i in ids],
+        "housenumber": None, "street": None, "levels": levels,
+        "area_m2": 100.0,
+        "lon": 21.0 + rng.uniform(0, 0.01, len(ids)),
+        "lat": 52.2 + lat_shift + rng.uniform(0, 0.01, len(ids)),
+        "building_type": "house",
+    })
+
+
+def _age_layers(tmp_path, days):
+    for meta_file in (tmp_path / "data").rglob("*.meta.json"):
+        meta = json.loads(meta_file.read_text())
+        stamp = (pd.Timestamp.now(tz="UTC") - timedelta(days=days)).strftime(etl.TIME_FORMAT)
+        meta["fetched_at"] = stamp
+        meta["full_fetched_at"] = stamp
+        meta_file.write_text(json.dumps(meta))
+
+
+def test_incremental_refresh_upserts_only_changed_rows(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    calls = []
+
+    def fake_fetch(city, country, newer=None):
+        calls.append(newer)
+        if newer is None:
+            return _housing(range(100))
+        # building 5 gets more levels, 200 is new, 201 is an outlier far away
+        changed = pd.concat([_housing([5], levels="10"), _housing([200]), _housing([201], lat_shift=5.0)])
+        return changed.reset_index(drop=True)
+
+    monkeypatch.setattr(etl, "fetch_housing_data", fake_fetch)
+
+    assert etl.refresh_etl_housing("Testowo", "Polska") == "full"
+    assert etl.refresh_etl_housing("Testowo", "Polska") == "fresh"
+    full_meta = etl.read_meta(etl.layer_path("golden", "Testowo", "housing"))
+    assert full_meta["rows"] == 100 and len(full_meta["content_hash"]) == 64
+
+    _age_layers(tmp_path, days=10)
+    assert etl.refresh_etl_housing("Testowo", "Polska") == "incremental"
+    since = calls[-1]
+    assert since is not None
+
+    golden = pd.read_parquet(etl.layer_path("golden", "Testowo", "housing")).set_index("osm_id")
+    bronze = pd.read_parquet(etl.layer_path("bronze", "Testowo", "housing"))
+    assert len(bronze) == 102
+    assert len(golden) == 101  # the outlier is filtered with the stored IQR bounds
+    assert golden.loc["way/5", "residents"] == 10 * 4
+    assert golden.loc["way/200", "residents"] == 2 * 4
+    assert etl.read_meta(etl.layer_path("golden", "Testowo", "housing"))["rows"] == 101
+
+    _age_layers(tmp_path, days=40)
+    assert etl.refresh_etl_housing("Testowo", "Polska", full_refresh_age=timedelta(days=30)) == "full"
+    assert calls[-1] is None
+
+
+def test_chunked_transform_matches_whole_frame(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    bronze = pd.concat([_housing(range(500)), _housing([900], lat_shift=3.0)], ignore_index=True)
+    bronze.loc[3, "lat"] = None
+    bronze.loc[7, "area_m2"] = 0.0
+    bronze.loc[9, "levels"] = None
+    etl.write_layer(bronze, etl.layer_path("bronze", "Testowo", "housing"), source="test")
+
+    etl.transform_housing("Testowo", chunk_rows=64)
+
+    expected = bronze.dropna(subset=["lat", "lon"])
+    expected = etl.number_of_residents(etl.clean_housing(etl.clean_iqr(expected)))
+    golden_path = etl.layer_path("golden", "Testowo", "housing")
+    pd.testing.assert_frame_equal(pd.read_parquet(golden_path), expected)
+    assert etl.read_meta(golden_path)["content_hash"] == etl.write_layer(expected, tmp_path / "ref.parquet",
+                                                                         source="test")["content_hash"]
+    assert etl.read_meta(etl.layer_path("silver", "Testowo", "housing"))["iqr_bounds"] == \
+        etl.iqr_filter_bounds(bronze.dropna(subset=["lat", "lon"]))
+
+
+def test_failed_incremental_fetch_does_not_advance_metadata(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    calls = []
+
+    def fake_fetch(city, country, newer=None):
+        calls.append(newer)
+        if newer is None:
+            return _housing(range(10))
+        raise OverpassError("Housing types not fetched: ['apartments']")
+
+    monkeypatch.setattr(etl, "fetch_housing_data", fake_fetch)
+    etl.refresh_etl_housing("Testowo", "Polska")
+    _age_layers(tmp_path, days=10)
+    metas = {layer: etl.read_meta(etl.layer_path(layer, "Testowo", "housing")) for layer in ("bronze", "golden")}
+
+    for _ in range(2):
+        assert etl.refresh_etl_housing("Testowo", "Polska") == "stale"  # the existing golden is used
+    assert calls[1] == calls[2] == metas["bronze"]["fetched_at"]  # the retry asks for the same changes
+    for layer, meta in metas.items():
+        assert etl.read_meta(etl.layer_path(layer, "Testowo", "housing")) == meta
+
+
+def test_failed_fetch_without_golden_data_raises(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    def fake_fetch(city, country, newer=None):
+        raise OverpassError("Housing types not fetched: ['apartments']")
+
+    monkeypatch.setattr(etl, "fetch_housing_data", fake_fetch)
+    with pytest.raises(OverpassError):  # nothing to fall back on
+        etl.refresh_etl_housing("Testowo", "Polska")
@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+from sklearn.neighbors import KDTree
+
+from src.SimpleBayesOpt import SimpleBayesOpt
+from src.surrogates import RandomFourierGP
+from src.optimization import bayes_batch_locations, lazy_greedy_locations, refine_local
+from src.score import evaluate_fn_batch
+from src.store_index import StoreIndex
+from src.surface import ScoreSurface
+from src import optimization
+
+
+def test_lazy_greedy_places_n_distinct_stores():
+    rng = np.random.default_rng(0)
+    residents_xy = rng.uniform(0, 6000, size=(1500, 2))
+    residents_n = rng.integers(1, 50, size=(1500, 1)).astype(float)
+    stores_xy = rng.uniform(0, 6000, size=(15, 2))
+    pool_xy = rng.uniform(0, 6000, size=(512, 2))
+    store_index = StoreIndex(stores_xy)
+
+    locations, scores = lazy_greedy_locations(pool_xy, 4, KDTree(residents_xy), store_index, residents_n)
+
+    assert locations.shape == (4, 2)
+    assert len(store_index) == 19
+    assert [s[4] for s in scores] == [1, 2, 3, 4]
+    assert len(np.unique(np.round(locations), axis=0)) == 4
+
+
+def test_refine_local_improves_all_incumbents():
+    rng = np.random.default_rng(1)
+    residents_xy = np.vstack([rng.normal(2000, 300, size=(800, 2)), rng.normal(5000, 300, size=(800, 2))])
+    residents_n = rng.integers(1, 50, size=(1600, 1)).astype(float)
+    tree_residents, store_index = KDTree(residents_xy), StoreIndex(rng.uniform(0, 7000, size=(10, 2)))
+    incumbents = np.array([[1500.0, 2500.0], [5600.0, 4400.0], [3500.0, 3500.0]])
+
+    refined = refine_local(incumbents, 1000, tree_residents, store_index, residents_n)
+
+    before = evaluate_fn_batch(incumbents, tree_residents, store_index, residents_n)
+    after = evaluate_fn_batch(refined, tree_residents, store_index, residents_n)
+    assert refined.shape == incumbents.shape
+    assert np.all(after >= before) and np.any(after > before)
+    assert np.all(np.abs(refined - incumbents) < 2 * 1000)  # the box follows the incumbent, halving
+
+
+def test_bayes_batch_places_q_sites_per_round(monkeypatch):
+    rng = np.random.default_rng(2)
+    residents_xy = rng.uniform(0, 6000, size=(1500, 2))
+    residents_n = rng.integers(1, 50, size=(1500, 1)).astype(float)
+    store_index = StoreIndex(rng.uniform(0, 6000, size=(15, 2)))
+    runs = []
+    fit = SimpleBayesOpt.fit
+    monkeypatch.setattr(SimpleBayesOpt, "fit", lambda self, X: (runs.append(1), fit(self, X)))
+
+    locations, scores = bayes_batch_locations(rng.uniform(0, 6000, size=(256, 2)), 5, 3, residents_xy,
+                                              KDTree(residents_xy), store_index, residents_n,
+                                              surrogate=RandomFourierGP(n_features=64))
+
+    assert len(runs) == 2 * 2  # two rounds, n_iter=2 fits each
+    assert locations.shape == (5, 2) and len(store_index) == 20
+    assert [s[4] for s in scores] == [1, 2, 3, 4, 5]
+    dists = np.linalg.norm(locations[:, None] - locations[None], axis=2)
+    assert dists[np.triu_indices(5, 1)].min() > 100  # sites of one round do not pile up
+
+
+def test_lazy_greedy_with_surface_picks_within_the_surface_error(monkeypatch):
+    # without local refinement the picks are pool points
+    monkeypatch.setattr(optimization, "refine_local", lambda incumbents_xy, *args, **kwargs: incumbents_xy)
+    rng = np.random.default_rng(9)
+    residents_xy = np.vstack([rng.normal(c, 400, size=(1000, 2)) for c in (2000, 4500)])
+    residents_n = rng.integers(1, 50, size=(2000, 1)).astype(float)
+    stores_xy = rng.uniform(0, 6500, size=(20, 2))
+    pool_xy = rng.uniform(0, 6500, size=(1024, 2))
+    tree_residents = KDTree(residents_xy)
+
+    exact, _ = lazy_greedy_locations(pool_xy, 4, tree_residents, StoreIndex(stores_xy), residents_n)
+    surface = ScoreSurface(residents_xy, residents_n, cell_size=200.0)
+    approx, approx_scores = lazy_greedy_locations(pool_xy, 4, tree_residents, StoreIndex(stores_xy), residents_n,
+                                                  scorer=surface)
+    assert not np.allclose(approx, exact)  # the estimates are not upper bounds
+
+    store_index = StoreIndex(stores_xy)
+    for xy, row in zip(approx, approx_scores):
+        assert row[3] == pytest.approx(evaluate_fn_batch(xy[None], tree_residents, store_index, residents_n)[0])
+        best = evaluate_fn_batch(pool_xy, tree_residents, store_index, residents_n).max()
+        assert row[3] >= best - surface.max_error(pool_xy, tree_residents, store_index, residents_n)
+        store_index.add(xy[None])
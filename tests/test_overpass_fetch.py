@@ -0,0 +1,212 @@
+import json
+import os
+import re
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+import pytest
+
+import data.local_etl as etl
+import data.utils as utils
+from data.data_preprocessing import load_housing_data
+
+CITY_BOUNDS = {"minlat": 52.0, "minlon": 20.8, "maxlat": 52.4, "maxlon": 21.3}
+DISTRICT_BOUNDS = {"minlat": 52.1, "minlon": 20.9, "maxlat": 52.2, "maxlon": 21.0}  # inside the city
+TOWN_BOUNDS = {"minlat": 50.0, "minlon": 19.0, "maxlat": 50.1, "maxlon": 19.1}  # same name elsewhere
+D = 0.0002
+
+
+def _buildings(btype):
+    """Two square buildings per type, the first one straddles the 52.2 tile border."""
+    lon = 20.9 + 0.01 * utils.RESIDENTIAL_TYPES.index(btype)
+    return [(1, 52.2 - D / 2, lon), (2, 52.05, lon)]
+
+
+class OverpassStandIn(BaseHTTPRequestHandler):
+    """Mimics /api/interpreter for the bounding box and the housing queries."""
+    requests_seen = []
+    failing = set()
+    too_large = set()
+    relations = [CITY_BOUNDS]
+    bbox_queries = []
+    delay = 0.0
+    in_flight = max_in_flight = 0
+    lock = threading.Lock()
+
+    def _send(self, status, payload=None):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        if payload is not None:
+            self.wfile.write(json.dumps(payload).encode())
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+        try:
+            time.sleep(self.delay)
+            self._answer()
+        finally:
+            with cls.lock:
+                cls.in_flight -= 1
+
+    def _answer(self):
+        query = parse_qs(urlparse(self.path).query)["data"][0]
+        if "out bb" in query:
+            self.bbox_queries.append(query)
+            return self._send(200, {"elements": [{"type": "relation", "id": i, "bounds": bounds}
+                                                 for i, bounds in enumerate(self.relations)]})
+        if '"shop"="convenience"' in query:
+            return self._send(502 if "stores" in self.failing else 200, {"elements": []})
+
+        btype = re.search(r'way\["building"="(\w+)"\]', query).group(1)
+        south, west, north, east = map(float, re.search(
+            r"\(area\.searchArea\)\(([\d.-]+),([\d.-]+),([\d.-]+),([\d.-]+)\)", query).groups())
+        self.requests_seen.append(btype)
+        if btype in self.failing:
+            return self._send(502)
+        if btype in self.too_large and north - south > 0.15:
+            return self._send(200, {"elements": [], "remark": "runtime error: Query run out of memory"})
+
+        elements = []
+        for way_id, lat, lon in _buildings(btype):
+            corners = [(lat, lon), (lat, lon + D), (lat + D, lon + D), (lat + D, lon)]
+            if not any(south <= a <= north and west <= b <= east for a, b in corners):
+                continue
+            node_ids = [way_id * 10 + i for i in range(4)]
+            elements.append({"type": "way", "id": way_id, "nodes": node_ids + node_ids[:1],
+                             "tags": {"building": btype}})
+            elements += [{"type": "node", "id": n, "lat": a, "lon": b} for n, (a, b) in zip(node_ids, corners)]
+        self._send(200, {"elements": elements})
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def overpass(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), OverpassStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(utils, "OVERPASS_URL", f"http://127.0.0.1:{server.server_port}/api/interpreter")
+    monkeypatch.setattr(utils, "RETRY_DELAY", 0)
+    OverpassStandIn.requests_seen = []
+    OverpassStandIn.failing = set()
+    OverpassStandIn.too_large = set()
+    OverpassStandIn.relations = [CITY_BOUNDS]
+    OverpassStandIn.bbox_queries = []
+    OverpassStandIn.delay = 0.0
+    OverpassStandIn.max_in_flight = 0
+    yield OverpassStandIn
+    server.shutdown()
+
+
+def test_fetch_housing_data_is_concurrent_and_resumable(overpass, tmp_path):
+    overpass.failing = {"terrace"}
+    with pytest.raises(utils.OverpassError, match="terrace"):
+        utils.fetch_housing_data("Testowo", "Polska", max_workers=3, checkpoint_dir=tmp_path)
+    assert len(list(tmp_path.glob("*.parquet"))) == len(utils.RESIDENTIAL_TYPES) - 1
+
+    # the rerun only asks for the missing type and cleans up the checkpoints
+    overpass.failing = set()
+    overpass.requests_seen = []
+    housing = utils.fetch_housing_data("Testowo", "Polska", max_workers=3, checkpoint_dir=tmp_path)
+    assert set(overpass.requests_seen) == {"terrace"}
+    assert set(housing.building_type) == set(utils.RESIDENTIAL_TYPES)
+    assert housing.area_m2.between(300, 400).all()  # ~22 m x 14 m
+    assert list(tmp_path.glob("*.parquet")) == []
+
+
+def test_concurrent_fetches_share_the_overpass_limit(overpass, tmp_path):
+    # e.g. run_etl_snowflake_cities fetching several cities at once, each with its own thread pool
+    overpass.delay = 0.02
+    threads = [threading.Thread(target=utils.fetch_housing_data, args=(city, "Polska"),
+                                kwargs=dict(max_workers=4, checkpoint_dir=tmp_path / city))
+               for city in ("Testowo", "Probnik", "Wzorcowo")]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert overpass.max_in_flight == utils.MAX_CONCURRENCY
+
+
+def test_delta_checkpoints_of_another_newer_are_dropped(overpass, tmp_path):
+    overpass.failing = {"terrace"}
+    with pytest.raises(utils.OverpassError):
+        utils.fetch_housing_data("Testowo", "Polska", checkpoint_dir=tmp_path, newer="2026-01-01T00:00:00Z")
+    with pytest.raises(utils.OverpassError):
+        utils.fetch_housing_data("Probnik", "Polska", checkpoint_dir=tmp_path, newer="2026-01-01T00:00:00Z")
+
+    overpass.failing = set()
+    overpass.requests_seen = []
+    utils.fetch_housing_data("Testowo", "Polska", checkpoint_dir=tmp_path, newer="2026-02-01T00:00:00Z")
+    assert set(overpass.requests_seen) == set(utils.RESIDENTIAL_TYPES)  # nothing reused from the older run
+    assert list(tmp_path.glob("testowo_*.parquet")) == []  # nor left behind
+    assert len(list(tmp_path.glob("probnik_*20260101*.parquet"))) == len(utils.RESIDENTIAL_TYPES) - 1
+
+
+def test_stale_checkpoints_are_refetched(overpass, tmp_path):
+    overpass.failing = {"terrace"}
+    with pytest.raises(utils.OverpassError):
+        utils.fetch_housing_data("Testowo", "Polska", checkpoint_dir=tmp_path)
+    old = time.time() - utils.CHECKPOINT_MAX_AGE - 60
+    os.utime(tmp_path / "testowo_house.parquet", (old, old))
+
+    overpass.failing = set()
+    overpass.requests_seen = []
+    utils.fetch_housing_data("Testowo", "Polska", checkpoint_dir=tmp_path)
+    assert set(overpass.requests_seen) == {"terrace", "house"}
+
+
+def test_tiles_are_split_when_too_large_and_deduplicated(overpass):
+    # the city box (0.4 x 0.5 deg) is pre-split into 2 x 2 tiles, "apartments" tiles are split once more
+    overpass.too_large = {"apartments"}
+    bboxes = utils.fetch_city_bboxes("Testowo", "Polska")
+    for btype, n_queries in [("house", 4), ("apartments", 4 + 16)]:
+        df = utils.fetch_region(lambda tile: utils.load_housing_type("Testowo", btype, "Polska", bbox=tile), bboxes)
+        # building 1 is returned by the tiles on both sides of the border, but kept once
+        assert sorted(df.osm_id) == ["way/1", "way/2"]
+        assert overpass.requests_seen.count(btype) == n_queries
+
+
+def test_city_bboxes_are_limited_to_the_country_and_tiled_separately(overpass):
+    overpass.relations = [CITY_BOUNDS, DISTRICT_BOUNDS, TOWN_BOUNDS]
+    bboxes = utils.fetch_city_bboxes("Testowo", "Polska")
+    assert '(area.country)' in overpass.bbox_queries[-1] and '"name"="Polska"' in overpass.bbox_queries[-1]
+    assert bboxes == [(50.0, 19.0, 50.1, 19.1), (52.0, 20.8, 52.4, 21.3)]  # the district is inside the city
+
+    utils.fetch_region(lambda tile: utils.load_housing_type("Testowo", "house", "Polska", bbox=tile), bboxes)
+    assert overpass.requests_seen.count("house") == 1 + 4  # not the tiles of the union of both boxes
+
+
+def test_failing_store_fetch_raises_a_normal_exception(overpass):
+    # batch.run_job catches Exception, a SystemExit would take the whole batch down
+    overpass.failing = {"stores"}
+    with pytest.raises(utils.OverpassError):
+        utils.fetch_stores_data("Testowo", "Polska", "Żabka")
+
+
+def test_stale_golden_is_used_when_overpass_fails(overpass, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert etl.refresh_etl_housing("Testowo", "Polska") == "full"
+    golden = pd.read_parquet(etl.layer_path("golden", "Testowo", "housing"))
+
+    overpass.failing = set(utils.RESIDENTIAL_TYPES)
+    assert etl.refresh_etl_housing("Testowo", "Polska", max_age=timedelta(0)) == "stale"  # incremental
+    for layer in ("bronze", "silver", "golden"):  # golden files written before the metadata
+        etl.meta_path(etl.layer_path(layer, "Testowo", "housing")).unlink()
+    assert etl.refresh_etl_housing("Testowo", "Polska", max_age=timedelta(0)) == "stale"  # full
+    pd.testing.assert_frame_equal(load_housing_data("Testowo", "Polska", max_age=timedelta(0)), golden)
+
+
+def test_failing_tile_is_retried(overpass):
+    overpass.failing = {"house"}
+    with pytest.raises(utils.RequestException):
+        utils.fetch_tiled(lambda tile: utils.load_housing_type("Testowo", "house", "Polska", bbox=tile),
+                          (52.0, 20.8, 52.1, 20.9))
+    assert overpass.requests_seen.count("house") == utils.MAX_RETRIES
@@ -0,0 +1,45 @@
+import numpy as np
+
+from data.utils import calculate_area, polygon_area_centroid, read_ways
+
+
+def _random_polygon(rng):
+    # star-shaped (so simple) polygon of a building size around Warsaw, closed like OSM ways
+    n = rng.integers(3, 12)
+    angles = np.sort(rng.uniform(0, 2 * np.pi, n))
+    radius = rng.uniform(0.00005, 0.0003, n)
+    lon = 21.0 + rng.uniform(-0.1, 0.1) + radius * np.cos(angles)
+    lat = 52.2 + rng.uniform(-0.1, 0.1) + radius * np.sin(angles)
+    coords = list(zip(lon, lat))
+    return coords + coords[:1]
+
+
+def test_polygon_area_centroid_matches_shapely():
+    rng = np.random.default_rng(0)
+    polygons = [_random_polygon(rng) for _ in range(200)]
+    lon = np.array([c[0] for p in polygons for c in p])
+    lat = np.array([c[1] for p in polygons for c in p])
+    offsets = np.concatenate([[0], np.cumsum([len(p) for p in polygons])])
+
+    area, c_lon, c_lat = polygon_area_centroid(lon, lat, offsets)
+    for i, coords in enumerate(polygons):
+        expected_area, centroid = calculate_area(coords)
+        assert np.isclose(area[i], expected_area, rtol=1e-9)
+        assert np.isclose(c_lon[i], centroid.x, rtol=0, atol=1e-10)
+        assert np.isclose(c_lat[i], centroid.y, rtol=0, atol=1e-10)
+
+
+def test_read_ways_skips_ways_with_missing_nodes():
+    elements = [
+        {"type": "way", "id": 7, "nodes": [1, 2, 3, 1], "tags": {"addr:street": "Prosta", "building:levels": "4"}},
+        {"type": "way", "id": 8, "nodes": [1, 2, 99, 1], "tags": {}},
+        {"type": "way", "id": 9, "nodes": [3], "tags": {}},
+        {"type": "node", "id": 3, "lat": 52.0001, "lon": 21.0},
+        {"type": "node", "id": 1, "lat": 52.0, "lon": 21.0},
+        {"type": "node", "id": 2, "lat": 52.0, "lon": 21.0001},
+    ]
+    ways = read_ways(iter(elements))
+    assert list(ways.ids) == [7]
+    assert ways.street == ["Prosta"] and ways.levels == ["4"]
+    assert list(ways.offsets) == [0, 4]
+    assert list(ways.lat) == [52.0, 52.0, 52.0001, 52.0]
@@ -0,0 +1,28 @@
+import json
+
+import numpy as np
+from sklearn.neighbors import KDTree
+
+from src import profiling
+from src.score import evaluate_score_batch
+
+
+def test_profile_run_records_stages(tmp_path):
+    rng = np.random.default_rng(0)
+    residents_xy = rng.uniform(0, 3000, size=(500, 2))
+    residents_n = np.ones((500, 1))
+    tree_residents, tree_store = KDTree(residents_xy), KDTree(residents_xy[:5])
+
+    evaluate_score_batch(residents_xy, tree_residents, tree_store, residents_n)  # not recorded
+    with profiling.profile_run(tmp_path / "profile.json", cprofile_path=tmp_path / "profile.prof"):
+        for _ in range(3):
+            evaluate_score_batch(residents_xy[:100], tree_residents, tree_store, residents_n)
+        with profiling.timer("custom", items=7):
+            pass
+    evaluate_score_batch(residents_xy, tree_residents, tree_store, residents_n)
+
+    profile = json.loads((tmp_path / "profile.json").read_text())
+    stage = profile["stages"]["evaluate_score_batch"]
+    assert stage["calls"] == 3 and stage["items"] == 300 and stage["items_per_s"] > 0
+    assert profile["stages"]["custom"]["items"] == 7
+    assert (tmp_path / "profile.prof").stat().st_size > 0
@@ -0,0 +1,18 @@
+import numpy as np
+
+from data.quantiles import StreamingQuantiles
+
+
+def test_exact_below_size_and_close_above():
+    rng = np.random.default_rng(0)
+    values = rng.normal(52.2, 0.05, 400_000)
+
+    small = StreamingQuantiles(size=1024).update(values[:1000])
+    assert small.quantile(0.25) == np.quantile(values[:1000], 0.25)
+
+    sketch = StreamingQuantiles(size=1024)
+    for chunk in np.array_split(values, 37):
+        sketch.update(chunk)
+    assert sum(len(level) for level in sketch.levels) < 20 * 1024
+    for q in (0.01, 0.25, 0.5, 0.75, 0.99):
+        assert abs(np.mean(values < sketch.quantile(q)) - q) < 0.01
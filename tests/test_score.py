@@ -7,6 +7,9 @@ from src.score import (
     ratio_customers_per_store,
     evaluate_score,
     evaluate_fn,
+    evaluate_score_batch,
+    evaluate_fn_batch,
+    ParallelScorer,
     MAX_RADIUS,
 )
 
@@ -82,3 +85,38 @@ def test_evaluate_score_components_and_total_range():
     # evaluate_fn should give the same total
     fn_val = evaluate_fn(x, tree_residents, tree_stores, residents_xy, residents_n, stores_xy)
     assert np.isclose(fn_val, total)
+
+
+def test_evaluate_score_batch_matches_per_point():
+    rng = np.random.default_rng(0)
+    residents_xy = rng.uniform(0, 5000, size=(500, 2))
+    residents_n = rng.integers(1, 50, size=(500, 1)).astype(float)
+    stores_xy = rng.uniform(0, 5000, size=(20, 2))
+    tree_residents = KDTree(residents_xy)
+    tree_stores = KDTree(stores_xy)
+
+    # include a candidate far away from everything (empty neighbourhoods)
+    X = np.vstack([rng.uniform(-500, 5500, size=(64, 2)), [[20000.0, 20000.0]]])
+    cust, store, ratio, total = evaluate_score_batch(X, tree_residents, tree_stores, residents_n)
+
+    for i, x in enumerate(X):
+        expected = evaluate_score(x, tree_residents, tree_stores, residents_xy, residents_n, stores_xy)
+        assert np.allclose([cust[i], store[i], ratio[i]], expected, rtol=1e-12, atol=1e-12)
+        fn_val = evaluate_fn(x, tree_residents, tree_stores, residents_xy, residents_n, stores_xy)
+        assert np.isclose(total[i], fn_val, rtol=1e-12, atol=1e-12)
+
+    assert np.allclose(evaluate_fn_batch(X, tree_residents, tree_stores, residents_n), total)
+
+
+def test_parallel_scorer_matches_serial():
+    rng = np.random.default_rng(1)
+    residents_xy = rng.uniform(0, 5000, size=(800, 2))
+    residents_n = rng.integers(1, 50, size=(800, 1)).astype(float)
+    tree_stores = KDTree(rng.uniform(0, 5000, size=(20, 2)))
+    X = rng.uniform(0, 5000, size=(1000, 2))
+
+    serial = evaluate_score_batch(X, KDTree(residents_xy), tree_stores, residents_n)
+    with ParallelScorer(residents_xy, residents_n, n_jobs=2, chunk_size=128) as scorer:
+        parallel = scorer.evaluate_score_batch(X, tree_stores)
+    for a, b in zip(serial, parallel):
+        assert np.array_equal(a, b)
@@ -0,0 +1,152 @@
+import json
+import threading
+from functools import partial
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import qmc
+
+import serve
+from src import score
+from src.optimization import find_best_location
+from src.session import OptimizationSession
+
+
+@pytest.fixture
+def city():
+    rng = np.random.default_rng(0)
+    housing = pd.DataFrame({"lat": rng.uniform(52.20, 52.26, 2000), "lon": rng.uniform(20.95, 21.05, 2000),
+                            "residents": rng.integers(1, 60, 2000).astype(float)})
+    stores = pd.DataFrame({"osm_id": [f"node/{i}" for i in range(20)],
+                           "lat": rng.uniform(52.20, 52.26, 20), "lon": rng.uniform(20.95, 21.05, 20)})
+    return housing, stores
+
+
+def test_place_matches_find_best_location(city, monkeypatch):
+    monkeypatch.setattr(qmc, "Sobol", partial(qmc.Sobol, seed=0))
+    housing, stores = city
+    session = OptimizationSession(housing, stores)
+
+    placed = session.place(n=3)
+    direct = find_best_location(housing, stores, n=3, method="lazy_greedy")
+    np.testing.assert_allclose(placed.to_numpy(), direct)
+    assert placed["rank"].tolist() == [1, 2, 3]
+
+
+def test_weights_and_exclude_apply_per_query(city):
+    housing, stores = city
+    session = OptimizationSession(housing, stores)
+    points = stores[["lat", "lon"]].to_numpy()[:5]
+
+    base = session.score(points)
+    heavy = session.score(points, weights={"w_store": 3.0})
+    np.testing.assert_allclose(heavy["store_prox"], 3 * base["store_prox"])
+    assert (score.W_CUSTOM, score.W_STORE, score.W_RATIO) == (1.0, 1.0, 1.0)  # restored
+
+    # a site on top of an excluded store no longer sees it
+    alone = session.score(points[:1], exclude=["node/0"])
+    assert alone["store_prox"][0] > base["store_prox"][0]
+    with pytest.raises(ValueError):
+        session.score(points, exclude=["node/999"])
+    with pytest.raises(ValueError):
+        session.score(points, weights={"w_typo": 1.0})
+    with pytest.raises(ValueError, match="osm_id"):  # e.g. golden files written before osm_id
+        OptimizationSession(housing, stores.drop(columns="osm_id")).score(points, exclude=["node/0"])
+
+
+def test_weights_of_sessions_in_other_threads_do_not_mix(city):
+    housing, stores = city
+    points = stores[["lat", "lon"]].to_numpy()[:5]
+    expected = {w: OptimizationSession(housing, stores).score(points, weights={"w_store": w})["store_prox"]
+                for w in (1.0, 3.0)}
+    mixed = []
+
+    def query(w):
+        session = OptimizationSession(housing, stores)
+        for _ in range(20):
+            got = session.score(points, weights={"w_store": w})["store_prox"]
+            mixed.append(not np.allclose(got, expected[w]))
+
+    threads = [threading.Thread(target=query, args=(w,)) for w in (1.0, 3.0)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(mixed) == 40 and not any(mixed)
+    assert score.W_STORE == 1.0
+
+
+def test_service_answers_queued_queries(city):
+    housing, stores = city
+    loads = []
+    server = serve.make_server(port=0, load_session=lambda *key: (loads.append(key),
+                                                                  OptimizationSession(housing, stores))[1])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}"
+
+    def post(path, **body):
+        request = Request(url + path, data=json.dumps(dict(body, city="Warszawa", country="Polska",
+                                                           store="Żabka")).encode())
+        with urlopen(request) as response:
+            return json.loads(response.read())
+
+    try:
+        points = stores[["lat", "lon"]].to_numpy()[:2].tolist()
+        results = [None] * 4
+        threads = [threading.Thread(target=lambda i=i: results.__setitem__(i, post("/score", points=points)))
+                   for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        placed = post("/place", n=2, weights={"w_ratio": 0.5}, exclude=["node/1"])
+        with pytest.raises(HTTPError) as too_fine:
+            post("/place", n=2, method="grid", surface_cell=1)
+        with pytest.raises(HTTPError) as too_many:
+            post("/place", n=serve.MAX_N + 1)
+        with pytest.raises(HTTPError) as too_long:
+            post("/score", points=points * (serve.MAX_POINTS // 2 + 1))
+        with urlopen(url + "/health") as response:
+            health = json.loads(response.read())
+    finally:
+        server.shutdown()
+        server.server_close()
+        server.queries.close()
+
+    assert loads == [("Warszawa", "Polska", "Żabka")]  # loaded once, shared by all queries
+    assert all(r["scores"] == results[0]["scores"] for r in results)
+    assert [row["rank"] for row in placed["locations"]] == [1, 2]
+    assert too_fine.value.code == too_many.value.code == too_long.value.code == 400
+    assert health == {"queued": 0, "sessions": [["Warszawa", "Polska", "Żabka"]]}
+
+
+def test_worker_survives_a_failing_session_load(city, monkeypatch):
+    housing, stores = city
+    attempts = []
+
+    def load_session(*key):
+        attempts.append(key)
+        if len(attempts) == 1:
+            raise SystemExit  # what an Overpass failure used to raise
+        return OptimizationSession(housing, stores)
+
+    monkeypatch.setattr(serve, "REQUEST_TIMEOUT", 30)
+    server = serve.make_server(port=0, load_session=load_session)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    body = json.dumps({"city": "Warszawa", "country": "Polska", "store": "Żabka",
+                       "points": stores[["lat", "lon"]].to_numpy()[:1].tolist()}).encode()
+    url = f"http://127.0.0.1:{server.server_port}/score"
+    try:
+        with pytest.raises(HTTPError) as failed:
+            urlopen(Request(url, data=body), timeout=30)
+        with urlopen(Request(url, data=body), timeout=30) as response:
+            scores = json.loads(response.read())["scores"]
+    finally:
+        server.shutdown()
+        server.server_close()
+        server.queries.close()
+    assert failed.value.code == 500
+    assert len(scores) == 1 and len(attempts) == 2
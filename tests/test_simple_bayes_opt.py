@@ -0,0 +1,23 @@
+import numpy as np
+from sklearn.neighbors import KDTree
+
+from src.SimpleBayesOpt import SimpleBayesOpt
+
+
+def test_chunked_suggest_matches_full_ranking():
+    rng = np.random.default_rng(0)
+    residents_xy = rng.uniform(0, 3000, size=(300, 2))
+    residents_n = rng.integers(1, 50, size=(300, 1)).astype(float)
+    stores_xy = rng.uniform(0, 3000, size=(10, 2))
+    model = SimpleBayesOpt(bounds=[(0, 3000), (0, 3000)], tree_res=KDTree(residents_xy),
+                           tree_store=KDTree(stores_xy), residents_xy=residents_xy,
+                           residents_n=residents_n, surrogate="rff", memory_budget_mb=1)
+    model.fit(rng.uniform(0, 3000, size=(64, 2)))
+    assert model.chunk_size() == 1024
+
+    X_cand = rng.uniform(0, 3000, size=(5000, 2))
+    mu, sigma = model.surrogate.predict(X_cand, return_std=True)
+    expected = X_cand[np.argsort(mu + sigma)[-20:][::-1]]
+    assert np.array_equal(model.suggest_next(X_cand, 20), expected)
+
+    assert model.suggest(n_best=5, n_candidates=4096).shape == (5, 2)
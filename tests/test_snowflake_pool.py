@@ -0,0 +1,138 @@
+import os
+
+import pandas as pd
+import pytest
+
+import data.snowflake_functions as sf
+
+
+class FakeConnection:
+    def __init__(self, log, **params):
+        self.log, self.params = log, params
+        self.cursors = 0
+        self.closed = False
+
+    def cursor(self):
+        self.cursors += 1
+        return FakeCursor(self.log)
+
+    def is_closed(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+
+class FakeCursor:
+    def __init__(self, log):
+        self.log = log
+
+    def execute(self, query, params=None):
+        self.log.append(" ".join(query.split()))
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        pass
+
+
+def _pool(size):
+    log, connections = [], []
+
+    def connect(**params):
+        connections.append(FakeConnection(log, **params))
+        return connections[-1]
+    return sf.SnowflakePool(size, connect=connect, user="u"), log, connections
+
+
+def test_pool_reuses_connections_and_sets_up_once():
+    pool, log, connections = _pool(2)
+    for _ in range(3):
+        with pool.connection() as conn:
+            conn.cursor().execute("SELECT 1")
+            conn.cursor().execute("SELECT 2")
+
+    assert len(connections) == 1 and connections[0].cursors == 2  # setup cursor + one shared cursor
+    assert sum(q.startswith("CREATE DATABASE") for q in log) == 1
+    assert log.count("SELECT 1") == 3
+
+
+def test_nightly_batch_does_one_round_of_warehouse_work(monkeypatch):
+    pool, log, connections = _pool(4)
+    uploads = []
+
+    def fetch(city, country, store=None):
+        if city == "Atlantyda":
+            raise RuntimeError("no such city")
+        return pd.DataFrame({"lat": [52.0], "lon": [21.0]})
+
+    def fake_write_pandas(conn, df, table_name, schema, **kwargs):
+        uploads.append((schema, table_name, sorted(df.city.unique()), kwargs["overwrite"]))
+        return True, 1, len(df), None
+
+    monkeypatch.setattr(sf, "fetch_stores_data", fetch)
+    monkeypatch.setattr(sf, "fetch_housing_data", fetch)
+    monkeypatch.setattr(sf, "write_pandas", fake_write_pandas)
+    jobs = [{"city": c, "country": "Polska", "store": "Żabka"} for c in ("Warszawa", "Kraków", "Atlantyda")]
+
+    errors = sf.run_etl_snowflake_cities(pool, jobs)
+
+    assert isinstance(errors["Atlantyda", "housing"], RuntimeError)
+    assert errors["Warszawa", "stores"] is None and errors["Kraków", "housing"] is None
+    assert sorted(uploads) == [("HOUSE_LOC", "L1_RAW_UPLOAD", ["Kraków", "Warszawa"], True),
+                               ("STORE_LOC", "L1_RAW_UPLOAD", ["Kraków", "Warszawa"], True)]
+    inserts = [q for q in log if q.startswith("INSERT INTO")]
+    assert sorted(q.split()[2] for q in inserts) == ["HOUSE_LOC.L1_RAW", "HOUSE_LOC.L2_CLEANED", "HOUSE_LOC.L3_GOLDEN",
+                                                   "STORE_LOC.L1_RAW", "STORE_LOC.L2_CLEANED", "STORE_LOC.L3_GOLDEN"]
+    assert all('"city" IN (%(city0)s, %(city1)s)' in q for q in inserts)
+    assert len(connections) <= 4
+
+
+class SingleCityCursor(FakeCursor):
+    """Tables as the single-city ETL left them: L1_RAW exists without a "city" column."""
+    def execute(self, query, params=None):
+        super().execute(query, params)
+        self.rows = [("L1_RAW",)] if query.startswith("SHOW TABLES LIKE 'L1_RAW'") else \
+            [("lat",), ("lon",)] if query.startswith("DESCRIBE TABLE") else []
+
+    def fetchall(self):
+        return self.rows
+
+
+def test_upload_recreates_single_city_tables_and_keeps_rows_on_failure(monkeypatch):
+    log = []
+    conn = FakeConnection(log)
+    conn.cursor = lambda: SingleCityCursor(log)
+    df = pd.DataFrame({"lat": [52.0], "lon": [21.0], "city": ["Warszawa"]})
+    monkeypatch.setattr(sf, "write_pandas", lambda conn, df, **kwargs: (True, 1, len(df), None))
+
+    sf.upload_to_snowflake(conn, df, "STORE_LOC", "L1_RAW", cities=["Warszawa"])
+    drop = log.index("DROP TABLE STORE_LOC.L1_RAW")
+    assert log[drop + 1].startswith("CREATE TABLE IF NOT EXISTS STORE_LOC.L1_RAW")
+    assert 'INSERT INTO STORE_LOC.L1_RAW ("lat", "lon", "city") SELECT' in log[drop + 4]
+
+    def failing_write_pandas(conn, df, **kwargs):
+        raise RuntimeError("upload failed")
+
+    log.clear()
+    monkeypatch.setattr(sf, "write_pandas", failing_write_pandas)
+    with pytest.raises(RuntimeError):
+        sf.upload_to_snowflake(conn, df, "STORE_LOC", "L1_RAW", cities=["Warszawa"])
+    assert not any(q.startswith(("DELETE", "DROP TABLE STORE_LOC.L1_RAW")) for q in log)  # raw rows kept
+
+
+def test_pool_inherited_through_fork_is_not_reused(monkeypatch):
+    inherited, _, connections = _pool(2)
+    with inherited.connection():
+        pass
+    fresh = _pool(2)[0]
+    monkeypatch.setattr(sf, "_pool", inherited)
+    monkeypatch.setattr(sf, "_pool_pid", -1)  # opened by another (parent) process
+    monkeypatch.setattr(sf, "_pool_failed", False)
+    monkeypatch.setattr(sf, "SnowflakePool", lambda size: fresh)
+
+    pool = sf.get_pool()
+    assert pool is fresh and sf._pool_pid == os.getpid()
+    sf.close_pool()
+    assert sf._pool is None and not any(c.closed for c in connections)  # the parent's sockets stay open
@@ -0,0 +1,127 @@
+import re
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+import data.data_preprocessing as dp
+from data.data_preprocessing import load_snowflake_stores
+from data.snowflake_functions import read_housing_arrays, read_table
+from data.utils import _latlon_to_xy
+
+
+class FakeCursor:
+    """Offline stand-in for the connector's cursor, backed by sqlite."""
+    def __init__(self, db, batch_size):
+        self.db, self.batch_size = db, batch_size
+        self.queries = []
+
+    def execute(self, query, params=None):
+        self.queries.append(query)
+        # the connector's pyformat placeholders -> sqlite named placeholders, SCHEMA.TABLE -> SCHEMA_TABLE
+        query = re.sub(r"%\((\w+)\)s", r":\1", query)
+        query = re.sub(r"FROM (\w+)\.(\w+)", r"FROM \1_\2", query)
+        self._cur = self.db.execute(query, params or {})
+
+    def fetchone(self):
+        return self._cur.fetchone()
+
+    def fetch_pandas_batches(self):
+        columns = [desc[0] for desc in self._cur.description]
+        while rows := self._cur.fetchmany(self.batch_size):
+            yield pd.DataFrame(rows, columns=columns)
+
+    def fetch_pandas_all(self):
+        return pd.concat(list(self.fetch_pandas_batches()), ignore_index=True)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, tables, batch_size=100):
+        self.db = sqlite3.connect(":memory:")
+        for name, df in tables.items():
+            df.to_sql(name.replace(".", "_"), self.db, index=False)
+        self.cursors = []
+        self.batch_size = batch_size
+
+    def cursor(self):
+        self.cursors.append(FakeCursor(self.db, self.batch_size))
+        return self.cursors[-1]
+
+
+def _golden(n=1000):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        "city": np.where(np.arange(n) % 2 == 0, "Warszawa", "Kraków"),
+        "lat": 52.2 + rng.uniform(0, 0.1, n), "lon": 21.0 + rng.uniform(0, 0.1, n),
+        "residents": rng.integers(1, 50, n).astype(float), "building_type": "house",
+    })
+
+
+def test_read_table_pushes_down_columns_and_filters():
+    golden = _golden()
+    conn = FakeConnection({"HOUSE_LOC.L3_GOLDEN": golden})
+
+    df = read_table(conn, "HOUSE_LOC", "L3_GOLDEN", columns=["lat", "lon"], city="Warszawa",
+                    bbox=(52.2, 21.0, 52.25, 21.05))
+
+    expected = golden[(golden.city == "Warszawa") & golden.lat.between(52.2, 52.25)
+                      & golden.lon.between(21.0, 21.05)]
+    assert list(df.columns) == ["lat", "lon"]
+    assert len(df) == len(expected) > 0
+    assert "SELECT *" not in conn.cursors[0].queries[0]
+    assert read_table(conn, "HOUSE_LOC", "MISSING") is None
+
+
+def test_read_housing_arrays_streams_batches():
+    golden = _golden()
+    conn = FakeConnection({"HOUSE_LOC.L3_GOLDEN": golden}, batch_size=64)
+
+    housing = read_housing_arrays(conn, "HOUSE_LOC", "L3_GOLDEN", city="Kraków")
+
+    krakow = golden[golden.city == "Kraków"]
+    ref_lat = krakow.lat.mean()
+    assert np.isclose(housing.ref_lat, ref_lat)
+    np.testing.assert_allclose(housing.residents_xy, _latlon_to_xy(krakow[["lat", "lon"]].to_numpy(), housing.ref_lat))
+    np.testing.assert_array_equal(housing.residents_n, krakow[["residents"]].to_numpy())
+    assert housing.tree.query(housing.residents_xy[:3], k=1)[0].max() == 0
+    assert read_housing_arrays(conn, "HOUSE_LOC", "L3_GOLDEN", city="Gdańsk") is None
+    assert read_housing_arrays(conn, "HOUSE_LOC", "MISSING") is None
+
+
+def test_session_load_streams_snowflake_housing(monkeypatch):
+    golden = _golden()
+    conn = FakeConnection({"HOUSE_LOC.L3_GOLDEN": golden}, batch_size=64)
+    monkeypatch.setattr(dp, "read_table", None)  # never the whole table
+
+    housing = dp.load_snowflake_housing_arrays(conn, "Kraków", "Polska")
+    np.testing.assert_array_equal(housing.residents_n, golden[golden.city == "Kraków"][["residents"]].to_numpy())
+
+    # a city that is not loaded yet runs the ETL and uses its result
+    etl_runs = []
+    monkeypatch.setattr(dp, "run_etl_snowflake_housing",
+                        lambda conn, city, country, schema: etl_runs.append(city) or golden[golden.city == "Kraków"])
+    assert len(dp.load_snowflake_housing_arrays(conn, "Gdańsk", "Polska")) == len(housing)
+    assert etl_runs == ["Gdańsk"]
+
+
+def test_snowflake_stores_keep_osm_id_for_exclusion():
+    stores = pd.DataFrame({"city": ["Warszawa", "Kraków"], "osm_id": ["node/1", "node/2"],
+                           "lat": [52.2, 50.1], "lon": [21.0, 19.9], "name": ["a", "b"]})
+    conn = FakeConnection({"STORE_LOC.L3_GOLDEN": stores})
+    golden = load_snowflake_stores(conn, "Warszawa", "Polska", "Żabka")
+    assert golden.to_dict(orient="list") == {"osm_id": ["node/1"], "lat": [52.2], "lon": [21.0]}
+
+    # tables loaded before stores had osm_id are still read (sqlite would take the
+    # unknown "osm_id" for a string literal, Snowflake fails with invalid identifier)
+    class NoOsmIdCursor(FakeCursor):
+        def execute(self, query, params=None):
+            if '"osm_id"' in query:
+                raise ValueError("invalid identifier '\"osm_id\"'")
+            super().execute(query, params)
+
+    conn = FakeConnection({"STORE_LOC.L3_GOLDEN": stores.drop(columns="osm_id")})
+    conn.cursor = lambda: NoOsmIdCursor(conn.db, conn.batch_size)
+    assert list(load_snowflake_stores(conn, "Warszawa", "Polska", "Żabka").columns) == ["lat", "lon"]
@@ -0,0 +1,33 @@
+import numpy as np
+from sklearn.neighbors import KDTree
+
+from src.store_index import StoreIndex
+from src.score import evaluate_score_batch, MAX_RADIUS
+
+
+def test_store_index_matches_rebuilt_kdtree():
+    rng = np.random.default_rng(0)
+    stores_xy = rng.uniform(0, 5000, size=(40, 2))
+    new_xy = rng.uniform(0, 5000, size=(10, 2))
+    X = rng.uniform(0, 5000, size=(100, 2))
+
+    index = StoreIndex(stores_xy, max_buffer=4)
+    for p in new_xy[:7]:
+        index.add(p)  # passes the rebuild threshold once
+    index.add(new_xy[7:])
+    all_xy = np.vstack([stores_xy, new_xy])
+    assert np.array_equal(index.points, all_xy)
+
+    tree = KDTree(all_xy)
+    idx_tree, dist_tree = tree.query_radius(X, r=MAX_RADIUS, return_distance=True)
+    idx_index, dist_index = index.query_radius(X, r=MAX_RADIUS, return_distance=True)
+    for a, b, da, db in zip(idx_tree, idx_index, dist_tree, dist_index):
+        assert np.array_equal(np.sort(a), np.sort(b))
+        assert np.allclose(np.sort(da), np.sort(db))
+
+    residents_xy = rng.uniform(0, 5000, size=(300, 2))
+    residents_n = rng.integers(1, 50, size=300).astype(float)
+    tree_res = KDTree(residents_xy)
+    expected = evaluate_score_batch(X, tree_res, tree, residents_n)
+    got = evaluate_score_batch(X, tree_res, index, residents_n)
+    assert np.allclose(expected, got)
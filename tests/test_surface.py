@@ -0,0 +1,47 @@
+import numpy as np
+from sklearn.neighbors import KDTree
+
+from src.score import evaluate_score_batch
+from src.surface import ScoreGrid, ScoreSurface
+
+
+def test_score_surface_close_to_exact_score():
+    rng = np.random.default_rng(0)
+    residents_xy = rng.uniform(0, 4000, size=(2000, 2))
+    residents_n = rng.integers(1, 50, size=(2000, 1)).astype(float)
+    stores_xy = rng.uniform(0, 4000, size=(30, 2))
+    tree_residents = KDTree(residents_xy)
+    tree_stores = KDTree(stores_xy)
+
+    surface = ScoreSurface(residents_xy, residents_n, cell_size=25.0)
+    X = rng.uniform(0, 4000, size=(256, 2))
+    assert surface.max_error(X, tree_residents, tree_stores, residents_n) < 0.05
+
+    # far outside the city there are no customers at all
+    cust, _, ratio, _ = surface.evaluate_score_batch(np.array([[50000.0, 50000.0]]), tree_stores)
+    assert cust[0] == 0.0 and ratio[0] == 0.0
+
+
+def test_score_grid_matches_exact_score_at_cell_centers():
+    rng = np.random.default_rng(1)
+    cell = 50.0
+    # residents on cell centers, so binning loses nothing
+    residents_xy = rng.integers(0, 80, size=(1500, 2)) * cell
+    residents_n = rng.integers(1, 50, size=(1500, 1)).astype(float)
+    stores_xy = rng.uniform(0, 4000, size=(20, 2))
+    tree_residents = KDTree(residents_xy)
+
+    grid = ScoreGrid(residents_xy, residents_n, stores_xy, cell_size=cell)
+    new_store = np.array([2000.0, 2000.0])
+    grid.add_store(new_store)
+    all_stores = np.vstack([stores_xy, new_store])
+
+    ij = rng.integers(0, grid.total.shape, size=(300, 2))
+    centers = grid.origin + ij * cell
+    exact = evaluate_score_batch(centers, tree_residents, KDTree(all_stores), residents_n)[3]
+    np.testing.assert_allclose(grid.total[ij[:, 0], ij[:, 1]], exact, atol=1e-9)
+
+    rebuilt = ScoreGrid(residents_xy, residents_n, all_stores, cell_size=cell)
+    np.testing.assert_allclose(grid.total, rebuilt.total, atol=1e-12)
+    best_xy, best = grid.best()
+    assert best == grid.total.max() and np.all(best_xy >= grid.origin)
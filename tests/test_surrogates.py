@@ -0,0 +1,30 @@
+import numpy as np
+
+from src.surrogates import RandomFourierGP, WarmStartGP, make_surrogate
+
+
+def test_random_fourier_gp_fits_smooth_function():
+    rng = np.random.default_rng(0)
+    X = rng.uniform(0, 5000, size=(400, 2))
+    y = np.sin(X[:, 0] / 1000) + np.cos(X[:, 1] / 1500)
+
+    model = RandomFourierGP().fit(X, y)
+    mu, std = model.predict(X, return_std=True)
+    assert np.mean(np.abs(mu - y)) < 0.05
+    assert np.all(std >= 0)
+
+    # uncertainty grows away from the data
+    _, std_far = model.predict(np.array([[50000.0, 50000.0]]), return_std=True)
+    assert std_far[0] > std.mean()
+
+
+def test_warm_start_gp_reuses_fitted_kernel():
+    rng = np.random.default_rng(0)
+    X = rng.uniform(0, 10, size=(30, 2))
+    y = np.sin(X[:, 0])
+
+    model = make_surrogate("gp")
+    assert isinstance(model, WarmStartGP)
+    model.fit(X, y)
+    assert model.kernel is model.gp.kernel_
+    assert model.predict(X).shape == (30,)
@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+
+from src.visualization import aggregate_housing, generate_map
+
+
+def _housing(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({"lat": 52.2 + rng.normal(0, 0.02, n), "lon": 21.0 + rng.normal(0, 0.03, n),
+                         "building_type": "house", "area_m2": rng.uniform(50, 500, n),
+                         "residents": rng.integers(1, 50, n).astype(float)})
+
+
+def test_aggregate_housing_respects_point_budget():
+    heat = aggregate_housing(_housing(20000), max_points=500)
+    assert len(heat) <= 500
+    assert heat[:, 2].max() == 1.0
+
+
+def test_generate_map_switches_to_heatmap(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "results").mkdir()
+    stores = pd.DataFrame({"lat": [52.2, 52.21], "lon": [21.0, 21.01]})
+    new_locations = np.array([[52.205, 21.005, 0.3, -0.1, 1.0, 2.2, 1]])
+
+    generate_map(_housing(300), stores, new_locations, city="small", marker_threshold=1000)
+    generate_map(_housing(3000), stores, new_locations, city="large", marker_threshold=1000)
+    small = (tmp_path / "results/small_zabka_map.html").read_text()
+    large = (tmp_path / "results/large_zabka_map.html").read_text()
+    assert "Residents: " in small and "heatLayer" not in small
+    assert "heatLayer" in large and "abka Location" in large